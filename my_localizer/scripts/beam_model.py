@@ -0,0 +1,223 @@
+""" A ray casting (beam) laser model.  The expected range of every beam is found by marching a
+    ray through the occupancy grid, or by looking it up in a precomputed RangeLookupTable, and
+    the measured range is scored against it with the standard beam model mixture """
+
+import math
+
+import numpy as np
+
+from laser_model import COMBINATIONS, combine_beams
+
+
+def cast_rays(occupancy_field, x, y, theta, max_range, step=None, max_batch=2**18):
+    """ Compute the distance from each (x, y) along the heading theta to the first occupied cell of
+        occupancy_field.  x, y and theta are broadcast against each other.  Rays that leave the map or
+        travel further than max_range report max_range.  Rays are marched in increments of step (one
+        map cell by default) """
+    info = occupancy_field.map.info
+    grid = occupancy_field.grid
+    if step is None:
+        step = info.resolution
+    x, y, theta = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                      np.asarray(y, dtype=np.float64),
+                                      np.asarray(theta, dtype=np.float64))
+    shape = x.shape
+    x = x.ravel()
+    y = y.ravel()
+    theta = theta.ravel()
+    ranges = np.full(len(x), max_range, dtype=np.float64)
+    n_steps = int(math.ceil(max_range/step))
+
+    for start in range(0, len(x), max_batch):
+        stop = min(start + max_batch, len(x))
+        # the ray origins in (fractional) cell coordinates and the per step increment along each ray
+        cx = (x[start:stop] - info.origin.position.x)/info.resolution
+        cy = (y[start:stop] - info.origin.position.y)/info.resolution
+        dx = np.cos(theta[start:stop])*step/info.resolution
+        dy = np.sin(theta[start:stop])*step/info.resolution
+        active = np.arange(stop - start)
+        for k in range(n_steps + 1):
+            col = np.floor(cx[active] + k*dx[active]).astype(np.intp)
+            row = np.floor(cy[active] + k*dy[active]).astype(np.intp)
+            inside = (col >= 0) & (col < info.width) & (row >= 0) & (row < info.height)
+            hit = np.zeros(len(active), dtype=bool)
+            # only the cells the rays reached are thresholded, not the whole map on every call
+            hit[inside] = grid[row[inside], col[inside]] > 0
+            ranges[start + active[hit]] = min(k*step, max_range)
+            # stop marching rays that hit something or left the map
+            active = active[inside & ~hit]
+            if not len(active):
+                break
+    return ranges.reshape(shape)
+
+
+class RangeLookupTable(object):
+    """ Precomputed expected ranges over a discretized (x, y, theta) grid of the free space of a map
+        Attributes:
+            occupancy_field: the OccupancyField the table was computed for
+            max_range: the largest range stored in the table
+            xy_stride: the table spacing in x and y, in map cells
+            n_theta: the number of heading bins covering a full turn
+            table: the expected ranges in millimetres as a uint16 array indexed as [row, column, heading].
+                   Entries of cells that are not free are 0
+            version: the OccupancyField.version the table is up to date with (see refresh)
+    """
+    RANGE_SCALE = 1000.0    # table entries are millimetres
+
+    def __init__(self, occupancy_field, max_range, xy_stride=4, n_theta=120, cache=None):
+        """ Build the table for occupancy_field, or load it from cache (a MapCache) if it has been built before """
+        if max_range*self.RANGE_SCALE > np.iinfo(np.uint16).max:
+            raise ValueError("max_range %.1f m does not fit the uint16 range table" % max_range)
+        self.occupancy_field = occupancy_field
+        self.max_range = max_range
+        self.xy_stride = int(xy_stride)
+        self.n_theta = int(n_theta)
+
+        info = occupancy_field.map.info
+        self.cell_size = info.resolution*self.xy_stride
+        self.rows = int(math.ceil(info.height/float(self.xy_stride)))
+        self.columns = int(math.ceil(info.width/float(self.xy_stride)))
+
+        # the cache is keyed by the static map, so a field that was updated already needs its own table
+        name = 'range_table_s%d_t%d_r%d' % (self.xy_stride, self.n_theta, int(round(max_range*self.RANGE_SCALE)))
+        self.table = cache.load(occupancy_field.map_hash, name) if cache and not occupancy_field.version else None
+        if self.table is None:
+            self.table = self.compute_table()
+            if cache and not occupancy_field.version:
+                self.table = cache.store(occupancy_field.map_hash, name, self.table)
+        self.version = occupancy_field.version
+
+    def refresh(self):
+        """ Bring the table up to date with the updates of the occupancy field since it was computed.  Only the
+            table cells within max_range of the changed cells are ray cast again.  The entries are written in
+            place, so processes sharing the table (see parallel_scoring.share_array) see them """
+        window = self.occupancy_field.changed_window(self.version)
+        self.version = self.occupancy_field.version
+        if window is None:
+            return
+        margin = int(math.ceil(self.max_range/self.occupancy_field.map.info.resolution))
+        rows = slice(max((window[0].start - margin)//self.xy_stride, 0),
+                     min(-(-(window[0].stop + margin)//self.xy_stride), self.rows))
+        columns = slice(max((window[1].start - margin)//self.xy_stride, 0),
+                        min(-(-(window[1].stop + margin)//self.xy_stride), self.columns))
+        if not self.table.flags.writeable:
+            # a memory map of the cache, which keeps describing the static map
+            self.table = np.array(self.table)
+        self.table[rows, columns] = self.compute_table(rows, columns)
+
+    def compute_table(self, rows=slice(None), columns=slice(None)):
+        """ Ray cast from the center of every free table cell along every heading bin, over the table cells
+            rows x columns (slices) """
+        info = self.occupancy_field.map.info
+        rows, columns = np.meshgrid(np.arange(self.rows)[rows], np.arange(self.columns)[columns], indexing='ij')
+        # the map cell at the center of each table cell decides whether it is free
+        map_rows = np.minimum(rows*self.xy_stride + self.xy_stride//2, info.height - 1)
+        map_columns = np.minimum(columns*self.xy_stride + self.xy_stride//2, info.width - 1)
+        free = self.occupancy_field.grid[map_rows, map_columns] == 0
+
+        table = np.zeros(rows.shape + (self.n_theta,), dtype=np.uint16)
+        x = info.origin.position.x + (columns[free] + 0.5)*self.cell_size
+        y = info.origin.position.y + (rows[free] + 0.5)*self.cell_size
+        headings = np.arange(self.n_theta)*2*math.pi/self.n_theta
+        ranges = cast_rays(self.occupancy_field, x[:, np.newaxis], y[:, np.newaxis], headings, self.max_range)
+        table[free] = np.round(ranges*self.RANGE_SCALE).astype(np.uint16)
+        return table
+
+    def lookup(self, x, y, theta):
+        """ Return the expected ranges for arrays of (x, y, theta).  Poses outside the table or in cells that
+            are not free are returned as nan """
+        info = self.occupancy_field.map.info
+        x, y, theta = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                          np.asarray(y, dtype=np.float64),
+                                          np.asarray(theta, dtype=np.float64))
+        column = np.floor((x - info.origin.position.x)/self.cell_size)
+        row = np.floor((y - info.origin.position.y)/self.cell_size)
+        heading = np.round(theta*self.n_theta/(2*math.pi)).astype(np.intp) % self.n_theta
+        valid = (column >= 0) & (column < self.columns) & (row >= 0) & (row < self.rows)
+
+        expected = np.zeros(valid.shape, dtype=np.uint16)
+        expected[valid] = self.table[row[valid].astype(np.intp), column[valid].astype(np.intp), heading[valid]]
+        ranges = expected/self.RANGE_SCALE
+        ranges[expected == 0] = np.nan
+        return ranges
+
+
+class BeamModel(object):
+    """ The beam model for range finders (Probabilistic Robotics, table 6.1).  Each measured range is scored
+        against the expected range with a mixture of a Gaussian around the expected range, an exponential for
+        unexpected short readings, a point mass at max_range for missed obstacles and a uniform floor for
+        random readings.  As with the likelihood field model, each beam probability is raised to power and
+        the beams are combined in the log domain (see laser_model.combine_beams).
+        Attributes:
+            occupancy_field: the OccupancyField to ray cast in
+            max_range: the largest range the model considers
+            range_table: an optional RangeLookupTable replacing ray casting with a lookup
+            z_hit, z_short, z_max, z_rand: the mixture weights
+            sigma_hit: the standard deviation of the hit Gaussian
+            lambda_short: the rate of the exponential for short readings
+            power: the exponent applied to each beam probability
+            combine: how beams are combined, "sum" or "product"
+            max_batch: the maximum number of beams to evaluate in one array operation
+    """
+
+    def __init__(self, occupancy_field, max_range, range_table=None, z_hit=0.8, z_short=0.1, z_max=0.0, z_rand=0.1,
+                 sigma_hit=0.1, lambda_short=0.5, power=3, combine="sum", max_batch=2**18):
+        if combine not in COMBINATIONS:
+            raise ValueError("unknown beam combination %r, expected one of %s" % (combine, ", ".join(COMBINATIONS)))
+        self.occupancy_field = occupancy_field
+        self.max_range = max_range
+        self.range_table = range_table
+        self.z_hit = z_hit
+        self.z_short = z_short
+        self.z_max = z_max
+        self.z_rand = z_rand
+        self.sigma_hit = sigma_hit
+        self.lambda_short = lambda_short
+        self.power = power
+        self.combine = combine
+        self.max_batch = max_batch
+
+    def refresh(self):
+        """ Bring what the model derived from the occupancy field up to date with its updates """
+        if self.range_table is not None:
+            self.range_table.refresh()
+
+    def expected_ranges(self, x, y, theta):
+        """ The expected range of beams starting at (x, y) with heading theta (arrays).  Beams starting outside
+            of the free space of the map see max_range """
+        if self.range_table is not None:
+            ranges = self.range_table.lookup(x, y, theta)
+            ranges[np.isnan(ranges)] = self.max_range
+            return ranges
+        return cast_rays(self.occupancy_field, x, y, theta, self.max_range)
+
+    def beam_probabilities(self, measured, expected):
+        """ The mixture probability of measuring the range measured when expecting expected """
+        p_hit = np.exp(-0.5*((measured - expected)/self.sigma_hit)**2)/(self.sigma_hit*math.sqrt(2*math.pi))
+        p_short = np.where(measured < expected, self.lambda_short*np.exp(-self.lambda_short*measured), 0.0)
+        p_max = np.where(measured >= self.max_range, 1.0, 0.0)
+        p_rand = np.where(measured < self.max_range, 1.0/self.max_range, 0.0)
+        return self.z_hit*p_hit + self.z_short*p_short + self.z_max*p_max + self.z_rand*p_rand
+
+    def log_weights(self, particles, scan):
+        """ Compute the log-likelihood of every particle in the ParticleSet particles given scan (a
+            PreparedScan).  Returns an array with one log-likelihood per particle """
+        log_weights = np.zeros(len(particles))
+        if not len(scan):
+            return log_weights
+        self.refresh()
+        measured = np.minimum(scan.ranges, self.max_range)
+        step = max(1, self.max_batch // len(scan))
+        for start in range(0, len(particles), step):
+            stop = min(start + step, len(particles))
+            theta = particles.theta[start:stop, np.newaxis]
+            cos_theta = np.cos(theta)
+            sin_theta = np.sin(theta)
+            # every beam starts at the laser, which sits at an offset from the particle
+            laser_x = particles.x[start:stop, np.newaxis] + cos_theta*scan.laser_x - sin_theta*scan.laser_y
+            laser_y = particles.y[start:stop, np.newaxis] + sin_theta*scan.laser_x + cos_theta*scan.laser_y
+            expected = self.expected_ranges(laser_x, laser_y, theta + scan.angles)
+            with np.errstate(divide='ignore'):
+                log_p = self.power*np.log(self.beam_probabilities(measured, expected))
+            log_weights[start:stop] = combine_beams(log_p, self.combine)
+        return log_weights
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+""" Benchmarks the particle filter offline across particle counts, reporting the update rate, the latency
+    of each stage and the localization error.  Every run replays the same sequence with the same seed.
+    To run, type the following in terminal
+        rosrun my_localizer benchmark.py --map path to the yaml file [--particles 100 300 1000 3000]
+"""
+
+import argparse
+
+import numpy as np
+
+from filter_core import ParticleFilterCore
+from replay import Sequence, STAGES, load_field, replay, synthesize_sequence
+
+
+def run_benchmark(occupancy_field, sequence, particle_counts, seed=0, **params):
+    """ Replay sequence once for every number of particles in particle_counts, with KLD-sampling disabled
+        so the cloud keeps its size.  params are passed on to ParticleFilterCore.  Returns a list of
+        (particle count, ReplayResult) pairs """
+    results = []
+    for n in particle_counts:
+        core = ParticleFilterCore(occupancy_field, n_particles=n, adaptive_particles=False, random_seed=seed, **params)
+        try:
+            results.append((n, replay(core, sequence)))
+        finally:
+            core.close()
+    return results
+
+
+def format_table(results):
+    """ Format the results of run_benchmark as a text table """
+    header = ["particles", "updates/s"] + ["%s ms" % stage for stage in STAGES] + ["mean err m", "final err m"]
+    rows = [header]
+    for n, result in results:
+        row = [str(n), "%.1f" % result.updates_per_second()]
+        row += ["%.2f" % (1000*np.mean(result.stage_times[stage])) if result.stage_times[stage] else "-"
+                for stage in STAGES]
+        if result.errors:
+            row += ["%.3f" % np.mean(result.errors), "%.3f" % result.errors[-1]]
+        else:
+            row += ["-", "-"]
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--map', required=True, help="the map_server YAML file of the map")
+    parser.add_argument('--sequence', help="a recording saved by replay.py, a synthetic run is generated if omitted")
+    parser.add_argument('--steps', type=int, default=200, help="the length of a synthetic run")
+    parser.add_argument('--particles', type=int, nargs='+', default=[100, 300, 1000, 3000],
+                        help="the particle counts to benchmark")
+    parser.add_argument('--sensor-model', default="likelihood_field", choices=["likelihood_field", "beam"])
+    parser.add_argument('--workers', type=int, default=1, help="worker processes scoring the laser update")
+    parser.add_argument('--seed', type=int, default=0, help="the random seed of the run and the filters")
+    args = parser.parse_args()
+
+    field = load_field(args.map)
+    if args.sequence:
+        sequence = Sequence.load(args.sequence)
+    else:
+        sequence = synthesize_sequence(field, args.steps, np.random.RandomState(args.seed))
+    results = run_benchmark(field, sequence, args.particles, args.seed,
+                            sensor_model=args.sensor_model, laser_workers=args.workers)
+    print format_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+""" Checkpoints of the filter state, so a restarted node picks up where the previous one left off instead
+    of re-initializing around the odometry.  A checkpoint holds the particle arrays, the odometry pose of
+    the last update and the map to odom transform in a small binary file: a fixed header followed by the
+    raw float64 arrays and a CRC32 of everything before it.  Checkpoints are written by a background
+    thread, so the filter loop only pays for copying the arrays """
+
+import errno
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from particle_set import ParticleSet
+from scan_pipeline import LatestOnlySlot
+
+# a child of rospy's logger, so inside a node the messages reach rosout
+logger = logging.getLogger("rosout." + __name__)
+
+MAGIC = b'PFCKPT\x00\x02'
+# magic, map hash, odometry frame, time written, number of particles, odometry (x, y, theta), translation
+# (x, y, z) and rotation (x, y, z, w) of the map to odom transform
+_HEADER = struct.Struct('<8s40s64sdI3d3d4d')
+_CRC = struct.Struct('<I')
+
+
+class Checkpoint(object):
+    """ The state of a filter worth restoring
+        Attributes:
+            map_hash: the OccupancyField.map_hash of the map the particles are in
+            stamp: the time the checkpoint was taken, in seconds since the epoch
+            particles: the ParticleSet of the filter
+            odom_frame: the odometry frame odom_xy_theta is in
+            odom_xy_theta: the odometry pose of the last filter update (x, y, theta)
+            translation, rotation: the map to odom transform as a translation and a quaternion
+    """
+
+    def __init__(self, map_hash, stamp, particles, odom_frame, odom_xy_theta, translation, rotation):
+        self.map_hash = map_hash
+        self.stamp = stamp
+        self.particles = particles
+        self.odom_frame = odom_frame
+        # stored as plain floats, whatever sequence or array type they are given as
+        self.odom_xy_theta = tuple(np.asarray(odom_xy_theta, dtype=np.float64).ravel().tolist())
+        self.translation = tuple(np.asarray(translation, dtype=np.float64).ravel().tolist())
+        self.rotation = tuple(np.asarray(rotation, dtype=np.float64).ravel().tolist())
+
+    def to_bytes(self):
+        """ Serialize the checkpoint """
+        particles = self.particles
+        header = _HEADER.pack(MAGIC, self.map_hash.encode('ascii'), self.odom_frame.encode('utf-8'), self.stamp,
+                              len(particles), *(self.odom_xy_theta + self.translation + self.rotation))
+        payload = header + b''.join(np.ascontiguousarray(a, dtype='<f8').tobytes()
+                                    for a in (particles.x, particles.y, particles.theta, particles.w))
+        return payload + _CRC.pack(zlib.crc32(payload) & 0xffffffff)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Deserialize a checkpoint written by to_bytes.  Raises ValueError if data is not a valid checkpoint """
+        if len(data) < _HEADER.size + _CRC.size:
+            raise ValueError("truncated checkpoint")
+        payload, (crc,) = data[:-_CRC.size], _CRC.unpack(data[-_CRC.size:])
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise ValueError("corrupted checkpoint")
+        fields = _HEADER.unpack(payload[:_HEADER.size])
+        magic, map_hash, odom_frame, stamp, n = fields[:5]
+        if magic != MAGIC:
+            raise ValueError("not a checkpoint or a checkpoint of another version")
+        if len(payload) != _HEADER.size + 4*8*n:
+            raise ValueError("checkpoint of the wrong size")
+        arrays = np.frombuffer(payload, dtype='<f8', offset=_HEADER.size).reshape((4, n)).astype(np.float64)
+        return cls(map_hash.decode('ascii'), stamp, ParticleSet(arrays[0], arrays[1], arrays[2], arrays[3]),
+                   odom_frame.rstrip(b'\x00').decode('utf-8'), fields[5:8], fields[8:11], fields[11:15])
+
+
+def write_checkpoint(path, checkpoint):
+    """ Write checkpoint to path.  The file is written to a temporary name and renamed into place, so a crash
+        while writing leaves the previous checkpoint intact """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(checkpoint.to_bytes())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def read_checkpoint(path, map_hash=None):
+    """ Read the checkpoint at path.  Returns None if there is none, it is unreadable or it was taken in
+        another map than the one with map_hash (if given) """
+    try:
+        with open(path, 'rb') as f:
+            checkpoint = Checkpoint.from_bytes(f.read())
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            logger.warning("could not read the checkpoint %s: %s", path, e)
+        return None
+    except ValueError as e:
+        logger.warning("ignoring the checkpoint %s: %s", path, e)
+        return None
+    if map_hash is not None and checkpoint.map_hash != map_hash:
+        logger.info("ignoring the checkpoint %s, it was taken in another map", path)
+        return None
+    return checkpoint
+
+
+class CheckpointWriter(object):
+    """ Writes checkpoints to a file on a background thread, at most once every period seconds.  When the
+        thread falls behind only the latest checkpoint is written
+        Attributes:
+            path: the file the checkpoints are written to
+            period: the smallest number of seconds between checkpoints
+            slot: the LatestOnlySlot between submit() and the writer thread
+            thread: the writer thread
+    """
+
+    def __init__(self, path, period=1.0):
+        self.path = path
+        self.period = period
+        self.last_submit = 0.0
+        self.slot = LatestOnlySlot()
+        self.thread = threading.Thread(target=self._run, name="checkpoint_writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def due(self):
+        """ Whether a period has passed since the last checkpoint, so the next one should be taken """
+        return time.time() - self.last_submit >= self.period
+
+    def submit(self, checkpoint):
+        """ Hand checkpoint to the writer thread.  It must not share arrays with the running filter """
+        self.last_submit = time.time()
+        self.slot.put(checkpoint)
+
+    def _run(self):
+        while True:
+            checkpoint = self.slot.get()
+            if checkpoint is None:
+                return
+            try:
+                write_checkpoint(self.path, checkpoint)
+            except Exception:
+                logger.exception("writing the checkpoint %s failed", self.path)
+
+    def stop(self, timeout=None):
+        """ Stop the writer thread once it has written the checkpoint it is working on """
+        self.slot.close()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
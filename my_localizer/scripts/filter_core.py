@@ -0,0 +1,508 @@
+""" The particle filter itself, separated from the ROS node.  ParticleFilterCore works on plain
+    (x, y, theta) tuples and LaserScan-like messages, so it runs without a ROS master, e.g. in the
+    replay and benchmark tools """
+
+import logging
+import math
+
+import numpy as np
+from scipy.special import logsumexp
+
+from laser_model import LikelihoodFieldModel
+from beam_model import BeamModel, RangeLookupTable, cast_rays
+from parallel_scoring import ParallelScorer
+from global_localization import GlobalLocalizer
+from scan_matching import CorrelativeScanMatcher
+from motion_model import OdometryMotionModel
+from pose_clustering import PoseClusterer, weighted_pose_statistics
+from scan_processing import ScanPreprocessor
+from particle_set import ParticleSet
+from kld_sampling import KLDSampler
+from resampling import effective_sample_size, get_resampler
+from stage_timing import StageTimer
+
+# a child of rospy's logger, so inside a node the messages reach rosout with the node's log level
+logger = logging.getLogger("rosout." + __name__)
+
+
+class ParticleFilterCore(object):
+    """ The odometry update, laser update, resampling and pose estimate of the particle filter
+        Attributes list:
+            occupancy_field: the OccupancyField of the map we are localizing in
+            map_cache: the on-disk cache of arrays computed from the map (see MapCache), or None
+            n_particles: the number of particles in the filter (adapted on every resample when adaptive_particles is set)
+            resampler: the name of the resampling scheme (see resampling.RESAMPLERS)
+            rng: the numpy RandomState every random draw of the filter comes from
+            motion_model: the OdometryMotionModel moving the particles
+            kld_sampler: the KLDSampler choosing the number of particles, or None for a fixed size cloud
+            d_thresh: the amount of linear movement before triggering a filter update
+            a_thresh: the amount of angular movement before triggering a filter update
+            laser_max_distance: the maximum distance to an obstacle we should use in a likelihood calculation
+            laser_model: the batched measurement model (LikelihoodFieldModel or BeamModel) used to weight particles against a scan
+            laser_scorer: what the laser update calls to score particles, either laser_model or a ParallelScorer wrapping it
+            scan_preprocessor: prepares each scan for the laser update
+            particle_cloud: a ParticleSet representing a probability distribution over robot poses
+            current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
+                                   The pose is expressed as a list [x,y,theta] (where theta is the yaw)
+            odom_history: the odometry poses seen since the last filter update (see add_odometry)
+            pose: the current estimate of the robot pose in the map frame as an (x, y, theta) tuple, or None
+            pose_covariance: the 3x3 covariance of (x, y, theta) around pose
+            pose_clusterer: the PoseClusterer grouping the particles for the "cluster" pose estimate
+            log_w_slow, log_w_fast: the logs of the long and short-term averages of the scan likelihood
+                                    (see weight_particles), which start from zero (a log of -inf)
+            last_scan: the PreparedScan of the last laser update, which the injected particles are scored against
+            timer: the StageTimer timing the stages of update()
+        Any of the parameters set in the constructor can be overridden by passing it as a keyword argument.
+    """
+
+    def __init__(self, occupancy_field, map_cache=None, timer=None, **params):
+        self.occupancy_field = occupancy_field
+        self.map_cache = map_cache
+        self.timer = timer or StageTimer(enabled=False)
+
+        self.n_particles = 100          # the number of particles to use
+
+        self.resampler = "systematic"   # the resampling scheme: "systematic", "stratified", "residual" or "multinomial"
+        self.resample_ess_ratio = 0.5   # resample once the effective sample size drops below this fraction of the cloud
+        #Good sigma_scale: 0.2, increase or decrease this based on confidence in odom
+        self.resample_sigma_xy = 0.2    # the noise added to x and y of the resampled particles
+        self.resample_sigma_theta = 0.1 # the noise added to theta of the resampled particles
+        self.random_seed = None         # seed of the random number generator, None seeds from the OS
+
+        # augmented MCL: when the short-term average likelihood of the scans drops below the long-term average,
+        # resampling replaces a fraction 1 - w_fast/w_slow of the particles with poses drawn from the free space,
+        # so the filter recovers from converging on the wrong pose.  A rate of 0 disables the recovery
+        self.recovery_alpha_slow = 0.001    # the rate of the long-term average w_slow
+        self.recovery_alpha_fast = 0.1      # the rate of the short-term average w_fast
+        self.recovery_candidates = 10   # random poses scored against the last scan for each one injected, the best is kept
+
+        # KLD-sampling adapts the number of particles to how spread out the posterior is
+        self.adaptive_particles = True
+        self.min_particles = 100        # the smallest cloud KLD-sampling will shrink to
+        self.max_particles = 2000       # the largest cloud, used when the filter is (re)initialized
+        self.kld_epsilon = 0.05         # bound on the KL-divergence between the particle and the true posterior
+        self.kld_z = 2.326              # upper 1-delta quantile of the standard normal (delta = 0.01)
+
+        # the noise of the odometry motion model (see OdometryMotionModel), amcl's defaults
+        self.odom_alpha1 = 0.2          # rotation noise from rotation
+        self.odom_alpha2 = 0.2          # rotation noise from translation
+        self.odom_alpha3 = 0.2          # translation noise from translation
+        self.odom_alpha4 = 0.2          # translation noise from rotation
+
+        #Good d_thresh: 0.2
+        self.d_thresh = 0.2             # the amount of linear movement before performing an update
+        self.a_thresh = math.pi/6       # the amount of angular movement before performing an update
+        self.odom_history_step = 0.02   # the distance between the odometry poses recorded between updates
+        self.odom_history_max = 20      # the most odometry poses recorded between updates
+
+        self.laser_max_distance = 2.5   # maximum penalty to assess in the likelihood field model
+        #Good p_measurement standard deviation: 0.005
+        self.laser_sigma = 0.005        # the standard deviation of the likelihood field Gaussian
+        self.laser_power = 3            # each beam probability is raised to this power
+        self.laser_combine = "sum"      # combine beams by adding ("sum") or multiplying ("product") their probabilities
+        # the likelihood field mixture: a hit near an obstacle, a random reading anywhere in range, or no return
+        self.laser_z_hit = 0.95
+        self.laser_z_rand = 0.05
+        self.laser_z_max = 0.0          # no-return beams are only kept for scoring if this is above zero
+
+        # the measurement model: "likelihood_field" or the ray casting "beam" model
+        self.sensor_model = "likelihood_field"
+        self.beam_max_range = 5.0       # the largest range the beam model ray casts to
+        self.use_range_table = True     # precompute beam model ranges over (x, y, theta) instead of ray casting per update
+        self.range_table_stride = 4     # range table spacing in map cells
+        self.range_table_headings = 120 # number of heading bins of the range table
+
+        self.laser_workers = 1          # worker processes scoring the laser update, 1 scores in the filter process
+
+        # how the pose is estimated from the particles: "cluster", "mean" or "mode" (see update_robot_pose)
+        self.pose_estimate = "cluster"
+        self.cluster_cell_size = 0.25   # the x and y size of the cells particles are hashed into for clustering
+        self.cluster_cell_angle = math.radians(30)  # the theta size of the clustering cells
+        self.cluster_hysteresis = 1.5   # how much heavier another cluster has to be to take over the pose estimate
+
+        # global localization searches the whole map coarse-to-fine over a pyramid of the occupancy field
+        self.global_levels = 4          # the number of pyramid levels, each halving the resolution of the previous one
+        self.global_headings = 36       # the number of headings tried at the coarsest level
+        self.global_hypotheses = 256    # the number of hypotheses refined at each level and seeding the cloud
+        self.global_beams = 60          # the number of beams of the scan scored during the search
+        self.global_sigma = 0.05        # the standard deviation of the hit Gaussian used by the search
+
+        # refine the pose estimate with a correlative scan match in a window around it (see CorrelativeScanMatcher)
+        self.scan_matching = False
+        self.match_window_xy = 0.1      # how far the match searches either side of the estimate in x and y
+        self.match_window_theta = math.radians(5)   # how far the match searches either side of the estimate in theta
+        self.match_angular_step = math.radians(0.5) # the heading resolution of the match
+        self.match_levels = 3           # the number of pyramid levels the match searches, coarse to fine
+        self.match_candidates = 16      # the number of candidates refined at each level
+        self.match_beams = 90           # the number of beams of the scan scored by the match
+        self.match_sigma = 0.02         # the standard deviation of the hit Gaussian used by the match
+
+        # which beams of each scan take part in the laser update: "none", "stride", "uniform" or "informative"
+        self.scan_decimation = "none"
+        self.scan_stride = 2            # keep every scan_stride-th beam with the "stride" decimation
+        self.scan_max_beams = 90        # the number of beams kept by the "uniform" and "informative" decimations
+
+        for name, value in params.items():
+            if not hasattr(self, name):
+                raise TypeError("unknown particle filter parameter %r" % name)
+            setattr(self, name, value)
+
+        self.rng = np.random.RandomState(self.random_seed)
+        self.motion_model = OdometryMotionModel(self.odom_alpha1, self.odom_alpha2, self.odom_alpha3, self.odom_alpha4)
+
+        self.kld_sampler = None
+        if self.adaptive_particles:
+            self.kld_sampler = KLDSampler(self.min_particles, self.max_particles, self.kld_epsilon, self.kld_z)
+
+        # prepares each scan for the laser update, caching the beam angle tables of the scan geometry
+        self.scan_preprocessor = ScanPreprocessor(self.scan_decimation, self.scan_stride, self.scan_max_beams,
+                                                  keep_max_range=self.laser_z_max > 0)
+
+        # the laser model scores the whole particle cloud against a scan in one batch
+        if self.sensor_model == "beam":
+            range_table = None
+            if self.use_range_table:
+                range_table = RangeLookupTable(self.occupancy_field, self.beam_max_range,
+                                               self.range_table_stride, self.range_table_headings, cache=self.map_cache)
+            self.laser_model = BeamModel(self.occupancy_field, self.beam_max_range, range_table, z_max=self.laser_z_max,
+                                         power=self.laser_power, combine=self.laser_combine)
+        else:
+            self.laser_model = LikelihoodFieldModel(self.occupancy_field, sigma=self.laser_sigma, power=self.laser_power,
+                                                    z_hit=self.laser_z_hit, z_rand=self.laser_z_rand,
+                                                    z_max=self.laser_z_max, max_range=self.beam_max_range,
+                                                    max_distance=self.laser_max_distance, combine=self.laser_combine)
+
+        # optionally spread the laser update over a pool of processes sharing the occupancy field
+        self.laser_scorer = self.laser_model
+        if self.laser_workers > 1:
+            self.laser_scorer = ParallelScorer(self.laser_model, self.laser_workers, seed=self.random_seed or 0)
+
+        # built on the first global localization, it holds the pyramid of the occupancy field
+        self.global_localizer = None
+        self.global_scan_preprocessor = ScanPreprocessor("uniform", max_beams=self.global_beams)
+
+        # built on the first refinement, like the global localizer
+        self.scan_matcher = None
+        self.match_scan_preprocessor = ScanPreprocessor("uniform", max_beams=self.match_beams)
+
+        self.pose_clusterer = PoseClusterer(self.cluster_cell_size, self.cluster_cell_angle, self.cluster_hysteresis)
+
+        self.particle_cloud = ParticleSet()
+        self.current_odom_xy_theta = []     #current position of ourself in odom frame
+        self.odom_history = []
+        self.pose = None
+        self.pose_covariance = np.zeros((3, 3))
+        self.log_w_slow = -np.inf
+        self.log_w_fast = -np.inf
+        self.last_scan = None
+
+    def close(self):
+        """ Release the resources held by the filter (the worker pool of a parallel laser scorer) """
+        if self.laser_scorer is not self.laser_model:
+            self.laser_scorer.close()
+
+    def moved_enough(self, new_odom_xy_theta):
+        """ Whether the robot moved more than d_thresh or a_thresh since the last update """
+        return (math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh or
+                math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh or
+                math.fabs(new_odom_xy_theta[2] - self.current_odom_xy_theta[2]) > self.a_thresh)
+
+    def update(self, new_odom_xy_theta, msg, laser_xy_theta=(0.0, 0.0, 0.0)):
+        """ Run one filter update for the odometry pose new_odom_xy_theta and the LaserScan msg if the robot
+            moved far enough since the last one.  laser_xy_theta is the pose of the laser relative to the
+            robot base.  Returns True if an update was performed """
+        if not self.moved_enough(new_odom_xy_theta):
+            self.add_odometry(new_odom_xy_theta)
+            return False
+        with self.timer.stage("odom"):
+            self.update_particles_with_odom(new_odom_xy_theta)      # update based on odometry
+        with self.timer.stage("laser"):
+            self.update_particles_with_laser(msg, laser_xy_theta)   # update based on laser scan
+        with self.timer.stage("pose"):
+            self.update_robot_pose()                                # update robot's pose
+        if self.scan_matching:
+            with self.timer.stage("scan_match"):
+                self.refine_pose(msg, laser_xy_theta)               # refine it against the map
+        with self.timer.stage("resample"):
+            self.resample_particles()                               # resample particles to focus on areas of high density
+        return True
+
+    def update_robot_pose(self):
+        """ Update the estimate of the robot's pose given the updated particles.
+            There are several logical methods for this, chosen by self.pose_estimate:
+                (1) "mean": compute the mean pose
+                (2) "mode": compute the most likely pose (i.e. the mode of the distribution)
+                (3): Above a likelihood threshold, compute the mean of those
+                (4) "cluster": Differentiate between clusters, compute mean in most likely cluster <--- the default
+            The covariance of the estimate is kept in self.pose_covariance
+        """
+        # first make sure that the particle weights are normalized
+        self.normalize_particles()
+        choose = self.pose_estimate  #Which strategy to use
+
+        if choose == "cluster":
+            #Use the weighted mean of the most likely cluster, see PoseClusterer
+            cluster = self.pose_clusterer.estimate(self.particle_cloud)
+            (mmPos_x, mmPos_y, average_angle) = cluster.pose
+            self.pose_covariance = cluster.covariance
+        elif choose =="mode":
+            #Use the pose of the most likely particle
+            idx = np.argmax(self.particle_cloud.w)
+            mmPos_x = self.particle_cloud.x[idx]
+            mmPos_y = self.particle_cloud.y[idx]
+            average_angle = self.particle_cloud.theta[idx]
+            _, self.pose_covariance = weighted_pose_statistics(self.particle_cloud.x, self.particle_cloud.y,
+                                                               self.particle_cloud.theta, self.particle_cloud.w)
+        elif choose == "mean":
+            #Use the mean of all particles:
+            most_common_particles = self.particle_cloud[self.particle_cloud.w != 0] #if the particle exists..... change me later to account for modes!
+            mmPos_x = np.mean(most_common_particles.x)        #mean of modes of x positions
+            mmPos_y = np.mean(most_common_particles.y)        #mean of modes of y positions
+
+            #Can not just average angles because (350, 10) would give 180. Thus, converting them to x,y
+            #and adding up x and y instead then converting back
+            angle_x = np.mean(np.cos(most_common_particles.theta))    #particle.theta is in radians
+            angle_y = np.mean(np.sin(most_common_particles.theta))    #particle.theta is in radians
+            average_angle = math.atan2(angle_y, angle_x)
+            _, self.pose_covariance = weighted_pose_statistics(most_common_particles.x, most_common_particles.y,
+                                                               most_common_particles.theta,
+                                                               np.ones(len(most_common_particles)))
+        else:
+            raise ValueError("unknown pose estimate %r, expected cluster, mean or mode" % choose)
+
+        self.pose = (float(mmPos_x), float(mmPos_y), float(average_angle))
+
+    def refine_pose(self, msg, laser_xy_theta=(0.0, 0.0, 0.0)):
+        """ Refine self.pose with a correlative scan match of the LaserScan msg in a small window around it.
+            The particles are left alone, only the estimate moves.  Returns whether the pose was refined """
+        if self.pose is None:
+            return False
+        if self.scan_matcher is None:
+            # updates of the occupancy field are applied to its pyramid on every match
+            self.scan_matcher = CorrelativeScanMatcher(self.occupancy_field, self.match_window_xy, self.match_window_theta,
+                                                       self.match_angular_step, self.match_levels, self.match_candidates,
+                                                       self.match_sigma, self.laser_z_hit, self.laser_z_rand,
+                                                       self.beam_max_range)
+        scan = self.match_scan_preprocessor.prepare(msg, laser_xy_theta)
+        if not len(scan):
+            return False
+        pose, _, improved = self.scan_matcher.match(scan, self.pose)
+        if improved:
+            self.pose = (pose[0], pose[1], math.atan2(math.sin(pose[2]), math.cos(pose[2])))
+        return improved
+
+    def add_odometry(self, odom_xy_theta):
+        """ Record an odometry pose seen between filter updates.  The next update_particles_with_odom moves the
+            particles along the whole recorded path rather than straight to its end, which follows curved
+            motion more closely.  A pose is only recorded once it is odom_history_step away from the last one,
+            so a robot standing still records nothing, and when odom_history_max poses are recorded every other
+            one is dropped """
+        if not self.current_odom_xy_theta:
+            return
+        last = self.odom_history[-1] if self.odom_history else self.current_odom_xy_theta
+        if math.hypot(odom_xy_theta[0] - last[0], odom_xy_theta[1] - last[1]) < self.odom_history_step:
+            return
+        self.odom_history.append(odom_xy_theta)
+        if len(self.odom_history) > self.odom_history_max:
+            # keep the whole path, at a coarser resolution
+            self.odom_history = self.odom_history[1::2]
+
+    def update_particles_with_odom(self, new_odom_xy_theta):
+        """ Update the particles using the newly given odometry pose.
+            The motion from the odometry pose of the last update, through the poses recorded with
+            add_odometry, to new_odom_xy_theta is sampled for every particle at once with the
+            sample_motion_odometry model (Prob Rob p 136), see OdometryMotionModel.
+        """
+        if not self.current_odom_xy_theta:
+            self.current_odom_xy_theta = new_odom_xy_theta
+            return
+
+        odom_poses = [self.current_odom_xy_theta] + self.odom_history + [new_odom_xy_theta]
+        self.motion_model.sample(self.particle_cloud, odom_poses, self.rng)
+        self.current_odom_xy_theta = new_odom_xy_theta
+        self.odom_history = []
+
+    def map_calc_range(self,x,y,theta):
+        """ Compute the range a beam starting at (x,y) with heading theta would measure in the map, capped at
+            beam_max_range.  x, y and theta may be arrays, in which case an array of ranges is returned """
+        return cast_rays(self.occupancy_field, x, y, theta, self.beam_max_range)
+
+    def resample_particles(self):
+        """ Resample the particles according to the new particle weights.
+            The weights stored with each particle define the probability that a particular particle is
+            selected.  Resampling only happens once the effective sample size of the cloud drops below
+            resample_ess_ratio of its size, otherwise the weights keep accumulating evidence.  The scheme
+            (self.resampler) returns the indices of the survivors, which are gathered in one step.
+            When the recent scans fit the cloud worse than usual (see recovery_probability), some of the
+            survivors are replaced with random poses from the free space of the map, and the cloud is
+            resampled for them whatever its effective sample size.
+        """
+        # make sure the distribution is normalized
+        self.normalize_particles()
+        n_candidates = self.kld_sampler.max_particles if self.kld_sampler else self.n_particles
+        p_random = self.recovery_probability()
+        n_random = self.rng.binomial(n_candidates, p_random) if p_random > 0 else 0
+        if not n_random and effective_sample_size(self.particle_cloud.w) >= self.resample_ess_ratio*len(self.particle_cloud):
+            return
+
+        resample = get_resampler(self.resampler)
+        candidates = resample(self.particle_cloud.w, n_candidates, self.rng)
+        if self.kld_sampler:
+            # shuffling makes every prefix of the ordered schemes an unbiased draw
+            candidates = self.rng.permutation(candidates)
+        candidates = self.particle_cloud.take(candidates)
+
+        if n_random:
+            x, y, theta = self.sample_random_particles(n_random)
+            replaced = self.rng.choice(n_candidates, len(x), replace=False)
+            candidates.x[replaced], candidates.y[replaced], candidates.theta[replaced] = x, y, theta
+            logger.info("injected %d random particles (w_fast/w_slow %.3g)", len(x), 1.0 - p_random)
+            # start the averages over from zero like amcl, so the next injection waits for w_slow to build up again
+            self.reset_recovery()
+
+        if self.kld_sampler:
+            # draw as many particles as we could ever want and see how many of them KLD-sampling needs.
+            # Random particles occupy new bins, so the cloud grows to cover them
+            self.n_particles = self.kld_sampler.select(candidates)
+            candidates = candidates.take(np.arange(self.n_particles))
+        self.particle_cloud = candidates
+        self.particle_cloud.w[:] = 1.0/len(self.particle_cloud)
+
+        logger.debug("length of particle cloud %d", len(self.particle_cloud))
+
+        #Add noise: modify particles using sigma
+        n = len(self.particle_cloud)
+        self.particle_cloud.x += self.rng.normal(0, self.resample_sigma_xy, n)
+        self.particle_cloud.y += self.rng.normal(0, self.resample_sigma_xy, n)
+        self.particle_cloud.theta += self.rng.normal(0, self.resample_sigma_theta, n)
+
+    def update_particles_with_laser(self, msg, laser_xy_theta=(0.0, 0.0, 0.0)):
+        """ Updates the particle weights in response to the scan contained in the msg
+            msg: Laser scan message (or anything with the same ranges and angle fields)
+            laser_xy_theta: the pose of the laser relative to the robot base """
+        #Every beam of every particle is scored against the occupancy field in one batch
+        scan = self.prepare_scan(msg, laser_xy_theta)
+        self.weight_particles(self.laser_scorer.log_weights(self.particle_cloud, scan))
+
+    def prepare_scan(self, msg, laser_xy_theta=(0.0, 0.0, 0.0)):
+        """ Turn the LaserScan msg into the PreparedScan scored by the laser update """
+        # drop invalid returns and decimate once per scan, using the scan geometry and the laser offset
+        self.last_scan = self.scan_preprocessor.prepare(msg, laser_xy_theta)
+        return self.last_scan
+
+    def weight_particles(self, log_likelihoods):
+        """ Update the particle weights with the log-likelihood of a scan for each particle, as computed by
+            laser_scorer.log_weights (or scored together with other filters, see laser_model.score_batch) """
+        #Weights are only reset by resampling, so the likelihood of this scan is combined with the evidence
+        #collected so far.  Both are combined as logs and normalized with log-sum-exp, so a scan that fits
+        #every particle badly does not underflow the whole cloud to zero
+        with np.errstate(divide='ignore'):
+            log_w = np.log(self.particle_cloud.w) + log_likelihoods
+            log_total = logsumexp(log_w)
+
+        #The weights are normalized, so log_total is the log of the average likelihood of the scan, which the
+        #recovery averages follow.  They are kept as logs too, a single scan can be far below the float range,
+        #and an impossible scan (a log_total of -inf) is the strongest sign the cloud is lost
+        if self.recovery_alpha_slow > 0 and self.recovery_alpha_fast > 0 and not np.isnan(log_total):
+            self.log_w_slow = self.log_running_average(self.log_w_slow, log_total, self.recovery_alpha_slow)
+            self.log_w_fast = self.log_running_average(self.log_w_fast, log_total, self.recovery_alpha_fast)
+
+        if not np.isfinite(log_total):
+            logger.warning("the scan is impossible for every particle, ignoring it")
+            return
+        self.particle_cloud.w[:] = np.exp(log_w - log_total)
+
+    @staticmethod
+    def log_running_average(log_average, log_value, alpha):
+        """ The log of the exponential running average exp(log_average) + alpha*(exp(log_value) - exp(log_average)) """
+        return np.logaddexp(log_average + math.log1p(-alpha), log_value + math.log(alpha))
+
+    def recovery_probability(self):
+        """ The probability with which each resampled particle is replaced by a random pose, max(0, 1 - w_fast/w_slow).
+            Both averages start from zero, so w_fast stays ahead until w_slow has seen enough scans """
+        if self.log_w_slow == -np.inf:
+            return 0.0
+        return max(0.0, 1.0 - math.exp(min(self.log_w_fast - self.log_w_slow, 0.0)))
+
+    def sample_random_particles(self, n):
+        """ Draw n poses from the free space of the map (see OccupancyField.sample_free_poses).  With
+            recovery_candidates above 1, that many poses are drawn for each one returned and the one fitting
+            the last scan best is kept.  Returns the (x, y, theta) arrays, which may be empty """
+        k = max(int(self.recovery_candidates), 1)
+        x, y, theta = self.occupancy_field.sample_free_poses(n*k, self.rng)
+        if k == 1 or self.last_scan is None or not len(x):
+            return x, y, theta
+        log_likelihoods = self.laser_scorer.log_weights(ParticleSet(x, y, theta), self.last_scan)
+        best = np.arange(n)*k + np.argmax(log_likelihoods.reshape((n, k)), axis=1)
+        return x[best], y[best], theta[best]
+
+    def reset_recovery(self):
+        """ Forget the likelihood averages, e.g. because the cloud was replaced """
+        self.log_w_slow = -np.inf
+        self.log_w_fast = -np.inf
+
+    def initialize_particle_cloud(self, xy_theta):
+        """ Initialize the particle cloud.
+            Arguments
+            xy_theta: a triple consisting of the mean x, y, and theta (yaw) to initialize the
+                      particle cloud around.
+            Particles are created based on a normal distribution around the initial position using standard deviation of sigma for x and y
+            and sigma_theta for theta"""
+        if self.kld_sampler:
+            # start wide, KLD-sampling shrinks the cloud again once the filter converges
+            self.n_particles = self.kld_sampler.max_particles
+
+        sigma = 1
+        sigma_theta = 1
+        self.particle_cloud = ParticleSet(self.rng.normal(xy_theta[0], sigma, self.n_particles),
+                                          self.rng.normal(xy_theta[1], sigma, self.n_particles),
+                                          self.rng.normal(xy_theta[2], sigma_theta, self.n_particles))
+        self.odom_history = []
+        self.reset_recovery()
+
+        self.normalize_particles()
+        self.update_robot_pose()
+
+    def global_localize(self, msg, laser_xy_theta=(0.0, 0.0, 0.0)):
+        """ Initialize the particle cloud without a guess of the pose, from the poses anywhere in the map that
+            best explain the scan msg.  The cloud is spread evenly over the hypotheses surviving the
+            coarse-to-fine search (see GlobalLocalizer), leaving it to the laser updates to tell them apart.
+            Returns the number of hypotheses """
+        if self.global_localizer is None:
+            # updates of the occupancy field are applied to the pyramid by each search (see LikelihoodPyramid.refresh)
+            self.global_localizer = GlobalLocalizer(self.occupancy_field, self.global_levels, self.global_headings,
+                                                    self.global_hypotheses, self.global_sigma, self.laser_z_hit,
+                                                    self.laser_z_rand, self.beam_max_range)
+        scan = self.global_scan_preprocessor.prepare(msg, laser_xy_theta)
+        x, y, theta, scores, heading_step = self.global_localizer.localize(scan)
+        if not len(x):
+            logger.warning("global localization found no free space to search")
+            return 0
+
+        if self.kld_sampler:
+            self.n_particles = self.kld_sampler.max_particles
+        # every hypothesis stands for a map cell and a heading interval, spread its particles over them
+        seeds = np.arange(self.n_particles) % len(x)
+        half_cell = 0.5*self.occupancy_field.map.info.resolution
+        self.particle_cloud = ParticleSet(x[seeds] + self.rng.uniform(-half_cell, half_cell, self.n_particles),
+                                          y[seeds] + self.rng.uniform(-half_cell, half_cell, self.n_particles),
+                                          theta[seeds] + self.rng.uniform(-0.5*heading_step, 0.5*heading_step,
+                                                                          self.n_particles))
+        logger.info("global localization kept %d hypotheses, best at (%.2f, %.2f, %.2f)",
+                    len(x), x[0], y[0], theta[0])
+        self.reset_recovery()
+
+        self.normalize_particles()
+        self.update_robot_pose()
+        return len(x)
+
+    def normalize_particles(self):
+        """ Make sure the particle weights define a valid distribution (i.e. sum to 1.0) """
+        weight_sum = np.sum(self.particle_cloud.w)
+        logger.debug("weight sum %g", weight_sum)
+        if not (weight_sum > 0 and np.isfinite(weight_sum)):
+            # nothing to normalize against, fall back to treating every particle alike
+            logger.warning("particle weights sum to %g, resetting them to uniform", weight_sum)
+            self.particle_cloud.w[:] = 1.0/len(self.particle_cloud) if len(self.particle_cloud) else 0.0
+            return
+        self.particle_cloud.w *= 1.0 / weight_sum
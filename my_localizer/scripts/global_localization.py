@@ -0,0 +1,218 @@
+""" Global localization by a coarse-to-fine search over the whole map.  The distance field of the
+    OccupancyField is downsampled into a pyramid, every free cell of the coarsest level is scored
+    against a scan at a set of headings, and only the best hypotheses are refined at each finer level.
+    The number of scored hypotheses is bounded by the size of the coarsest level plus a fixed amount
+    per level, so the search takes a bounded time however lost the robot is """
+
+import math
+
+import numpy as np
+from scipy.ndimage import minimum_filter
+
+import se2
+
+
+class PyramidLevel(object):
+    """ One level of a LikelihoodPyramid
+        Attributes:
+            factor: the number of map cells along each side of a cell of this level
+            cell_size: the size of a cell of this level in meters
+            closest_occ: the smallest distance to an obstacle over each cell and its neighbors (float32)
+            free: whether each cell contains any free map cell
+    """
+
+    def __init__(self, factor, cell_size, closest_occ, free):
+        self.factor = factor
+        self.cell_size = cell_size
+        self.closest_occ = closest_occ
+        self.free = free
+
+
+def _min_pool(array, factor, fill):
+    """ Reduce every factor x factor block of array to its minimum, padding the edges with fill """
+    height, width = array.shape
+    padded_height = -(-height // factor)*factor
+    padded_width = -(-width // factor)*factor
+    padded = np.full((padded_height, padded_width), fill, dtype=array.dtype)
+    padded[:height, :width] = array
+    return padded.reshape(padded_height // factor, factor, padded_width // factor, factor).min(axis=(1, 3))
+
+
+def _coarse_level(closest_occ, free, factor, rows, columns):
+    """ The closest_occ and free arrays of the pyramid level with factor over its cells rows x columns (slices
+        of the cells of that level), from the full resolution closest_occ and free arrays """
+    height, width = closest_occ.shape
+    n_rows = -(-height // factor)
+    n_columns = -(-width // factor)
+    # the neighbor minimum needs one more cell of the level all around
+    row_start, row_stop = max(rows.start - 1, 0), min(rows.stop + 1, n_rows)
+    column_start, column_stop = max(columns.start - 1, 0), min(columns.stop + 1, n_columns)
+    pooled = _min_pool(closest_occ[row_start*factor:row_stop*factor, column_start*factor:column_stop*factor],
+                       factor, np.float32(np.inf))
+    # a refined pose moves its beam endpoints by up to a coarse cell, so take the neighbors in too
+    pooled = minimum_filter(pooled, size=3, mode='nearest')
+    level_closest_occ = pooled[rows.start - row_start:rows.stop - row_start,
+                               columns.start - column_start:columns.stop - column_start]
+    level_free = _min_pool(~free[rows.start*factor:rows.stop*factor, columns.start*factor:columns.stop*factor],
+                           factor, True) == 0
+    return level_closest_occ, level_free
+
+
+class LikelihoodPyramid(object):
+    """ Downsampled copies of an OccupancyField for scoring poses at decreasing resolutions.  A coarse cell
+        holds the smallest distance to an obstacle over itself and its neighbors, so a pose scored at a
+        coarse level does at least as well as any pose refined from it (an optimistic bound)
+        Attributes:
+            occupancy_field: the OccupancyField the pyramid is built from
+            levels: the PyramidLevels, from the full resolution (levels[0]) to the coarsest
+            origin_x, origin_y: the map frame coordinates of the corner of the grid
+            version: the OccupancyField.version the pyramid is up to date with (see refresh)
+    """
+
+    def __init__(self, occupancy_field, n_levels=4):
+        self.occupancy_field = occupancy_field
+        info = occupancy_field.map.info
+        self.origin_x = info.origin.position.x
+        self.origin_y = info.origin.position.y
+        self.version = occupancy_field.version
+
+        free = occupancy_field.grid == 0
+        self.levels = [PyramidLevel(1, info.resolution, np.asarray(occupancy_field.closest_occ), free)]
+        for k in range(1, n_levels):
+            factor = 2**k
+            rows = slice(0, -(-info.height // factor))
+            columns = slice(0, -(-info.width // factor))
+            closest_occ, level_free = _coarse_level(occupancy_field.closest_occ, free, factor, rows, columns)
+            self.levels.append(PyramidLevel(factor, info.resolution*factor, closest_occ, level_free))
+
+    def refresh(self):
+        """ Bring the pyramid up to date with the updates of the occupancy field since it was built.  Only the
+            cells of each level over the changed window and its neighbors are recomputed """
+        window = self.occupancy_field.changed_window(self.version)
+        self.version = self.occupancy_field.version
+        if window is None:
+            return
+        field = self.occupancy_field
+        full = self.levels[0]
+        # the field may have swapped its arrays for writable copies
+        full.closest_occ = np.asarray(field.closest_occ)
+        full.free[window] = field.grid[window] == 0
+        for level in self.levels[1:]:
+            factor = level.factor
+            # the cells over the window, and their neighbors whose minimum takes them in
+            rows = slice(max(window[0].start // factor - 1, 0),
+                         min(-(-window[0].stop // factor) + 1, level.free.shape[0]))
+            columns = slice(max(window[1].start // factor - 1, 0),
+                            min(-(-window[1].stop // factor) + 1, level.free.shape[1]))
+            level.closest_occ[rows, columns], level.free[rows, columns] = _coarse_level(
+                full.closest_occ, full.free, factor, rows, columns)
+
+    def distances(self, level, x, y):
+        """ The distance to the closest obstacle at (x, y) (arrays) at a level, NaN off the map """
+        level = self.levels[level]
+        column = np.floor((x - self.origin_x)/level.cell_size)
+        row = np.floor((y - self.origin_y)/level.cell_size)
+        height, width = level.closest_occ.shape
+        valid = (column >= 0) & (column < width) & (row >= 0) & (row < height)
+        distances = np.full(valid.shape, np.nan, dtype=np.float32)
+        distances[valid] = level.closest_occ[row[valid].astype(np.intp), column[valid].astype(np.intp)]
+        return distances
+
+    def free_cells(self, level):
+        """ The map frame (x, y) centers of the free cells of a level """
+        level = self.levels[level]
+        rows, columns = np.nonzero(level.free)
+        return (self.origin_x + (columns + 0.5)*level.cell_size,
+                self.origin_y + (rows + 0.5)*level.cell_size)
+
+
+class GlobalLocalizer(object):
+    """ Finds the poses in the whole map that best explain a scan
+        Attributes:
+            pyramid: the LikelihoodPyramid searched
+            n_headings: the number of headings tried at every free cell of the coarsest level
+            n_hypotheses: the number of hypotheses kept at each level
+            sigma: the standard deviation of the hit Gaussian at full resolution.  It is widened by half the
+                   cell size of coarser levels, and for every beam by the distance its endpoint sweeps over
+                   half the heading step still to be refined
+            z_hit, z_rand, max_range: the likelihood field mixture (see LikelihoodFieldModel)
+            max_batch: the maximum number of beam endpoints to evaluate in one array operation
+    """
+
+    def __init__(self, occupancy_field, n_levels=4, n_headings=36, n_hypotheses=256, sigma=0.05,
+                 z_hit=0.95, z_rand=0.05, max_range=5.0, max_batch=2**20):
+        self.pyramid = LikelihoodPyramid(occupancy_field, n_levels)
+        self.n_headings = n_headings
+        self.n_hypotheses = n_hypotheses
+        self.sigma = sigma
+        self.z_hit = z_hit
+        self.z_rand = z_rand
+        self.max_range = max_range
+        self.max_batch = max_batch
+
+    def score(self, level, x, y, theta, scan, heading_step):
+        """ The log-likelihood of the poses (x, y, theta) (arrays) given scan (a PreparedScan) at a level of
+            the pyramid, multiplying the beam probabilities.  heading_step is the spacing of the headings
+            searched at this level """
+        sigma = self.sigma + 0.5*self.pyramid.levels[level].cell_size + 0.5*heading_step*scan.ranges
+        log_norm = np.log(self.z_hit/(sigma*math.sqrt(2*math.pi)))
+        log_rand = math.log(self.z_rand/self.max_range)
+        scores = np.zeros(len(x))
+        step = max(1, self.max_batch // max(1, len(scan)))
+        for start in range(0, len(x), step):
+            stop = min(start + step, len(x))
+            poses = (x[start:stop, np.newaxis], y[start:stop, np.newaxis], theta[start:stop, np.newaxis])
+            end_x, end_y = se2.transform_points(poses, scan.x, scan.y)
+            distances = self.pyramid.distances(level, end_x, end_y).astype(np.float64)
+            # endpoints off the map are only explained by a random reading
+            distances[np.isnan(distances)] = np.inf
+            log_p = np.logaddexp(log_norm - 0.5*(distances/sigma)**2, log_rand)
+            scores[start:stop] = log_p.sum(axis=1)
+        return scores
+
+    def localize(self, scan):
+        """ Search the map for the poses best explaining scan (a PreparedScan).  Returns the (x, y, theta, score)
+            arrays of the surviving hypotheses at full resolution, best first, and the heading step they
+            were refined to """
+        self.pyramid.refresh()
+        top = len(self.pyramid.levels) - 1
+        x, y = self.pyramid.free_cells(top)
+        heading_step = 2*math.pi/self.n_headings
+        x = np.repeat(x, self.n_headings)
+        y = np.repeat(y, self.n_headings)
+        theta = np.tile(np.arange(self.n_headings)*heading_step, len(x) // self.n_headings)
+        scores = self.score(top, x, y, theta, scan, heading_step)
+
+        for level in range(top - 1, -1, -1):
+            best = self._best(scores)
+            x, y, theta = x[best], y[best], theta[best]
+            # split every hypothesis into the 2 x 2 cells below it and 2 headings either side of it
+            offset = 0.25*self.pyramid.levels[level + 1].cell_size
+            heading_step *= 0.5
+            dx = np.repeat([-offset, offset, -offset, offset], 2)
+            dy = np.repeat([-offset, -offset, offset, offset], 2)
+            dtheta = np.tile([-0.5*heading_step, 0.5*heading_step], 4)
+            x = np.repeat(x, 8) + np.tile(dx, len(x))
+            y = np.repeat(y, 8) + np.tile(dy, len(y))
+            theta = np.repeat(theta, 8) + np.tile(dtheta, len(theta))
+
+            # drop refinements landing in cells without free space
+            cells = self.pyramid.levels[level]
+            column = np.floor((x - self.pyramid.origin_x)/cells.cell_size).astype(np.intp)
+            row = np.floor((y - self.pyramid.origin_y)/cells.cell_size).astype(np.intp)
+            height, width = cells.free.shape
+            inside = (column >= 0) & (column < width) & (row >= 0) & (row < height)
+            inside[inside] = cells.free[row[inside], column[inside]]
+            x, y, theta = x[inside], y[inside], theta[inside]
+            scores = self.score(level, x, y, theta, scan, heading_step)
+
+        best = self._best(scores)
+        return x[best], y[best], np.mod(theta[best], 2*math.pi), scores[best], heading_step
+
+    def _best(self, scores):
+        """ The indices of the n_hypotheses best scores, best first """
+        if len(scores) > self.n_hypotheses:
+            keep = np.argpartition(-scores, self.n_hypotheses - 1)[:self.n_hypotheses]
+        else:
+            keep = np.arange(len(scores))
+        return keep[np.argsort(-scores[keep], kind='mergesort')]
@@ -12,7 +12,7 @@ from copy import deepcopy
 import tf
 from tf import TransformListener
 from tf import TransformBroadcaster
-from tf.transformations import euler_from_quaternion, rotation_matrix, quaternion_from_matrix
+from tf.transformations import euler_from_quaternion
 from random import gauss
 
 import math
@@ -20,28 +20,18 @@ import time
 
 import numpy as np
 from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
+
+import se2
 
 def convert_translation_rotation_to_pose(translation, rotation):
     """ Convert from representation of a pose as translation and rotation (Quaternion) tuples to a geometry_msgs/Pose message """
     return Pose(position=Point(x=translation[0],y=translation[1],z=translation[2]), orientation=Quaternion(x=rotation[0],y=rotation[1],z=rotation[2],w=rotation[3]))
 
 def convert_pose_inverse_transform(pose):
-    """ Helper method to invert a transform (this is built into the tf C++ classes, but ommitted from Python) """
-    translation = np.zeros((4,1))
-    translation[0] = -pose.position.x
-    translation[1] = -pose.position.y
-    translation[2] = -pose.position.z
-    translation[3] = 1.0
-
-    rotation = (pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w)
-    euler_angle = euler_from_quaternion(rotation)
-    rotation = np.transpose(rotation_matrix(euler_angle[2], [0,0,1]))       # the angle is a yaw
-    transformed_translation = rotation.dot(translation)
-
-    translation = (transformed_translation[0], transformed_translation[1], transformed_translation[2])
-    rotation = quaternion_from_matrix(rotation)
-    return (translation, rotation)
+    """ Helper method to invert a transform (this is built into the tf C++ classes, but ommitted from Python).
+        Only the yaw of the pose is taken into account, so the inverse is computed in the plane (see se2) """
+    inverse = se2.invert(convert_pose_to_xy_and_theta(pose))
+    return se2.to_translation_rotation(inverse, -pose.position.z)
 
 def convert_pose_to_xy_and_theta(pose):
     """ Convert pose (geometry_msgs.Pose) to a (x,y,yaw) tuple """
@@ -0,0 +1,69 @@
+""" KLD-sampling (Fox, 2003): pick the number of particles for each update from how spread out the
+    posterior is.  Particles are dropped into a histogram over (x, y, theta) and the sample size is
+    chosen so that, with probability 1-delta, the KL-divergence between the sample-based estimate and
+    the true posterior stays below epsilon """
+
+import math
+
+import numpy as np
+
+
+def kld_sample_size(k, epsilon=0.05, z=2.326):
+    """ Return the number of samples needed for k occupied histogram bins (k may be an array)
+        epsilon: the bound on the KL-divergence
+        z: the upper 1-delta quantile of the standard normal distribution """
+    k = np.asarray(k, dtype=np.float64)
+    a = 2.0/(9.0*np.maximum(k - 1, 1))
+    n = (k - 1)/(2.0*epsilon)*(1 - a + np.sqrt(a)*z)**3
+    return np.where(k > 1, np.ceil(n), 1).astype(np.intp)
+
+
+class KLDSampler(object):
+    """ Chooses the size of the particle cloud for each update
+        Attributes:
+            min_particles: the smallest cloud to keep
+            max_particles: the largest cloud to keep
+            epsilon: the bound on the KL-divergence between the sample-based and the true posterior
+            z: the upper 1-delta quantile of the standard normal distribution (2.326 for delta = 0.01)
+            bin_size: the x and y size of a histogram bin in meters
+            bin_angle: the theta size of a histogram bin in radians
+    """
+
+    def __init__(self, min_particles, max_particles, epsilon=0.05, z=2.326, bin_size=0.5, bin_angle=math.radians(10)):
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.epsilon = epsilon
+        self.z = z
+        self.bin_size = bin_size
+        self.bin_angle = bin_angle
+
+    def histogram_bins(self, particles):
+        """ Return the histogram bin of each particle in the ParticleSet particles as an integer key """
+        bx = np.floor(particles.x/self.bin_size).astype(np.int64)
+        by = np.floor(particles.y/self.bin_size).astype(np.int64)
+        bt = np.floor(np.mod(particles.theta, 2*math.pi)/self.bin_angle).astype(np.int64)
+        bx -= bx.min()
+        by -= by.min()
+        return (bx*(by.max() + 1) + by)*(bt.max() + 1) + bt
+
+    def sample_size(self, particles):
+        """ The number of particles needed to represent the distribution the ParticleSet particles is drawn from """
+        k = len(np.unique(self.histogram_bins(particles)))
+        return int(np.clip(kld_sample_size(k, self.epsilon, self.z), self.min_particles, self.max_particles))
+
+    def select(self, candidates):
+        """ Given max_particles candidates drawn independently from the posterior (a ParticleSet), return how
+            many of them to keep.  This is the smallest prefix of the candidates whose length covers the sample
+            size required by the number of bins the prefix occupies, which is exactly where sequential KLD
+            sampling would stop drawing """
+        if not len(candidates):
+            return self.min_particles
+        bins = self.histogram_bins(candidates)
+        # the number of distinct bins occupied by every prefix of the candidates
+        is_new = np.zeros(len(bins), dtype=np.intp)
+        is_new[np.unique(bins, return_index=True)[1]] = 1
+        k = np.cumsum(is_new)
+        required = np.maximum(kld_sample_size(k, self.epsilon, self.z), self.min_particles)
+        done = np.flatnonzero(np.arange(1, len(bins) + 1) >= required)
+        n = done[0] + 1 if len(done) else len(bins)
+        return int(min(max(n, self.min_particles), self.max_particles))
@@ -0,0 +1,174 @@
+""" A batched implementation of the likelihood field laser model.  Rather than looping over
+    particles and beams, every beam of every particle is projected into the map in a single
+    array operation and scored against the occupancy field.
+
+    Scores are log-likelihoods: the probability of a single beam is tiny for a particle that is
+    slightly off, and multiplying or summing such probabilities underflows to zero for the whole
+    cloud.  In the log domain the filter only ever works with differences between particles """
+
+import math
+
+import numpy as np
+from scipy.special import logsumexp
+
+import se2
+
+# how the beams of a scan are combined into the likelihood of a particle
+COMBINATIONS = ("sum", "product")
+
+
+def combine_beams(log_p, combine):
+    """ Combine per-beam log probabilities (particles x beams) into one log-likelihood per particle.
+        "sum" adds the beam probabilities, as amcl's likelihood field does, while "product" multiplies
+        them, treating the beams as independent measurements """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if combine == "sum":
+            return logsumexp(log_p, axis=1)
+        return log_p.sum(axis=1)
+
+
+class LikelihoodFieldModel(object):
+    """ Scores a whole particle cloud against a laser scan (Probabilistic Robotics, table 6.3).  Each beam
+        endpoint is looked up in the occupancy field, and the distance d to the closest obstacle is scored
+        with the mixture z_hit*N(d; 0, sigma) + z_rand/max_range.  Beams reporting no return are scored
+        with z_max instead, and endpoints off the map only with the random term.  Each beam probability is
+        raised to power before the beams are combined (see combine_beams).
+
+        log(probability) is tabulated once over distances quantized to resolution, so scoring a beam is a
+        lookup and a linear interpolation between neighboring entries.  Distances beyond max_distance are
+        scored as max_distance.
+        Attributes:
+            occupancy_field: the OccupancyField to score beam endpoints against
+            sigma: the standard deviation of the Gaussian over the closest obstacle distance
+            power: the exponent applied to each beam probability
+            z_hit, z_rand, z_max: the weights of the hit, random and max-range terms of the mixture
+            max_range: the range of the laser, spreading the random term
+            max_distance: the largest distance to an obstacle that is told apart from larger ones
+            resolution: the quantization of the distance in the lookup table
+            combine: how beams are combined, "sum" or "product"
+            max_batch: the maximum number of beam endpoints to evaluate in one array operation
+            log_table: power*log(probability) of each quantized distance
+            log_slopes: the change of log_table to the next entry, for interpolation
+            log_off_map: power*log(probability) of an endpoint off the map
+            log_max_range: power*log(probability) of a beam reporting no return
+    """
+
+    def __init__(self, occupancy_field, sigma=0.005, power=3, z_hit=1.0, z_rand=0.0, z_max=0.0, max_range=5.0,
+                 max_distance=2.5, resolution=None, combine="sum", max_batch=2**20):
+        if combine not in COMBINATIONS:
+            raise ValueError("unknown beam combination %r, expected one of %s" % (combine, ", ".join(COMBINATIONS)))
+        self.occupancy_field = occupancy_field
+        self.sigma = sigma
+        self.power = power
+        self.z_hit = z_hit
+        self.z_rand = z_rand
+        self.z_max = z_max
+        self.max_range = max_range
+        self.max_distance = max_distance
+        self.resolution = resolution or sigma/8.0
+        self.combine = combine
+        self.max_batch = max_batch
+
+        distances = np.arange(int(math.ceil(max_distance/self.resolution)) + 1)*self.resolution
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.log_table = self.power*self.mixture_log_probabilities(distances)
+            self.log_slopes = np.append(np.diff(self.log_table), 0.0)
+            self.log_off_map = self.power*np.log(self.z_rand/self.max_range)
+            self.log_max_range = self.power*np.log(self.z_max)
+        # only a z_hit of zero leaves infinite entries, which must stay infinite when interpolating
+        self.log_slopes[~np.isfinite(self.log_slopes)] = 0.0
+
+    def mixture_log_probabilities(self, distances):
+        """ The log of the mixture probability of a beam ending distances away from the closest obstacle.
+            It is computed from the log of each term, so it stays finite where the Gaussian underflows """
+        log_hit = -0.5*(distances/self.sigma)**2 - math.log(self.sigma*math.sqrt(2*math.pi))
+        with np.errstate(divide='ignore'):
+            return np.logaddexp(np.log(self.z_hit) + log_hit, np.log(self.z_rand/self.max_range))
+
+    def beam_log_probabilities(self, distances):
+        """ Look up power*log(probability) of the beams ending distances away from the closest obstacle.
+            NaN distances (endpoints off the map) get the random term only """
+        quantized = np.minimum(distances*(1.0/self.resolution), len(self.log_table) - 1)
+        # NaN fails the comparison quantized == quantized
+        off_map = quantized != quantized
+        quantized[off_map] = 0
+        index = quantized.astype(np.intp)
+        log_p = self.log_table[index] + (quantized - index)*self.log_slopes[index]
+        log_p[off_map] = self.log_off_map
+        return log_p
+
+    def refresh(self):
+        """ The model reads the distance field of the occupancy field directly, so updates of the field need
+            nothing brought up to date (see BeamModel.refresh) """
+
+    def log_weights(self, particles, scan):
+        """ Compute the log-likelihood of every particle in the ParticleSet particles given scan (a
+            PreparedScan).  Returns an array with one log-likelihood per particle """
+        log_weights = np.zeros(len(particles))
+        if not len(scan):
+            return log_weights
+        step = max(1, self.max_batch // len(scan))
+        for start in range(0, len(particles), step):
+            stop = min(start + step, len(particles))
+            x, y = self.endpoints(particles, scan, start, stop)
+            closest_dist = self.occupancy_field.get_closest_obstacle_distance(x, y)
+            log_weights[start:stop] = self.combine_log_probabilities(self.beam_log_probabilities(closest_dist), scan)
+        return log_weights
+
+    @staticmethod
+    def endpoints(particles, scan, start=0, stop=None):
+        """ The map frame (x, y) of each beam endpoint of scan (a PreparedScan) for the particles start to stop
+            of the ParticleSet particles, as (particles x beams) arrays """
+        # the endpoints are already in the base frame, so only the particle poses are left to apply
+        poses = (particles.x[start:stop, np.newaxis], particles.y[start:stop, np.newaxis],
+                 particles.theta[start:stop, np.newaxis])
+        return se2.transform_points(poses, scan.x, scan.y)
+
+    def combine_log_probabilities(self, log_p, scan):
+        """ Score the no-return beams of scan in the beam log probabilities log_p (particles x beams) and
+            combine the beams of each particle """
+        log_p[:, scan.at_max] = self.log_max_range
+        return combine_beams(log_p, self.combine)
+
+    def batch_key(self):
+        """ Models with equal keys score alike, so their requests can share one lookup (see score_batch) """
+        return (id(self.occupancy_field), self.sigma, self.power, self.z_hit, self.z_rand, self.z_max,
+                self.max_range, self.max_distance, self.resolution, self.combine)
+
+    def log_weights_batch(self, requests):
+        """ Score a list of (particles, scan) requests, such as the laser updates of several robots, looking
+            all of their beam endpoints up in the occupancy field at once.  Returns the list of their
+            log-likelihood arrays """
+        sizes = [len(particles)*len(scan) for particles, scan in requests]
+        if len(requests) < 2 or sum(sizes) > self.max_batch:
+            return [self.log_weights(particles, scan) for particles, scan in requests]
+        endpoints = [self.endpoints(particles, scan) for particles, scan in requests]
+        closest_dist = self.occupancy_field.get_closest_obstacle_distance(
+            np.concatenate([x.ravel() for x, _ in endpoints]), np.concatenate([y.ravel() for _, y in endpoints]))
+        log_p = self.beam_log_probabilities(closest_dist)
+        results = []
+        for (particles, scan), start, stop in zip(requests, np.cumsum([0] + sizes[:-1]), np.cumsum(sizes)):
+            if not len(scan):
+                results.append(np.zeros(len(particles)))
+                continue
+            results.append(self.combine_log_probabilities(log_p[start:stop].reshape((len(particles), len(scan))), scan))
+        return results
+
+
+def score_batch(requests):
+    """ Score a list of (scorer, particles, scan) requests, where scorer is anything with a log_weights method.
+        Requests whose scorers are LikelihoodFieldModels with the same batch_key are scored together (see
+        LikelihoodFieldModel.log_weights_batch), the others one at a time.  Returns the list of their
+        log-likelihood arrays """
+    results = [None]*len(requests)
+    groups = {}
+    for i, (scorer, particles, scan) in enumerate(requests):
+        if isinstance(scorer, LikelihoodFieldModel):
+            groups.setdefault(scorer.batch_key(), []).append(i)
+        else:
+            results[i] = scorer.log_weights(particles, scan)
+    for indices in groups.values():
+        scorer = requests[indices[0]][0]
+        for i, log_weights in zip(indices, scorer.log_weights_batch([requests[i][1:] for i in indices])):
+            results[i] = log_weights
+    return results
@@ -0,0 +1,133 @@
+""" An on-disk cache for arrays that are expensive to derive from a map (such as the distance
+    field of an OccupancyField).  Entries are keyed by a hash of the map content and are loaded
+    back with memory mapping, so restarts are fast and processes on one host share the pages """
+
+import errno
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+def default_cache_dir():
+    """ The default location of the cache: a my_localizer directory inside ROS_HOME (~/.ros) """
+    ros_home = os.environ.get('ROS_HOME', os.path.join(os.path.expanduser('~'), '.ros'))
+    return os.path.join(ros_home, 'my_localizer')
+
+
+class MapCache(object):
+    """ Stores numpy arrays on disk, keyed by the content of the map they were computed from
+        Attributes:
+            cache_dir: the directory holding the cache files
+            max_bytes: the cap on the total size of the cache directory.  When it is exceeded the least
+                       recently used entries are evicted.  None disables the cap.
+    """
+    # bump this whenever the contents of cached arrays change meaning, so stale entries are not reused
+    FORMAT_VERSION = 1
+    SUFFIX = '.npy'
+
+    def __init__(self, cache_dir=None, max_bytes=512*1024*1024):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def map_key(cls, info, grid, *extra):
+        """ Compute the cache key of a map
+            info: the map metadata (nav_msgs/MapMetaData)
+            grid: the occupancy values of the map as a numpy array
+            extra: any additional parameters the cached array depends on """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(grid, dtype=np.int8).tobytes())
+        params = (cls.FORMAT_VERSION, info.width, info.height, info.resolution,
+                  info.origin.position.x, info.origin.position.y,
+                  info.origin.orientation.z, info.origin.orientation.w) + extra
+        h.update(repr(params).encode('ascii'))
+        return h.hexdigest()
+
+    def path(self, key, name):
+        """ The file that stores the array name for the map with the given key """
+        return os.path.join(self.cache_dir, '%s_%s%s' % (name, key, self.SUFFIX))
+
+    def load(self, key, name):
+        """ Return the cached array name for key as a read-only memory map, or None if it is not cached """
+        path = self.path(key, name)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT and os.path.exists(path):
+                # a truncated or corrupted entry, drop it so that it gets rebuilt
+                self._remove(path)
+            return None
+        # refresh the modification time so that eviction is least recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return array
+
+    def store(self, key, name, array):
+        """ Write array to the cache under key and return it loaded back as a memory map.  The file is
+            written to a temporary name and renamed into place, so readers never see a partial entry """
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = self.path(key, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.rename(tmp_path, path)
+        except:
+            self._remove(tmp_path)
+            raise
+        self.prune(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def invalidate(self, key=None):
+        """ Remove all cache entries of the map with the given key, or every entry if key is None """
+        for path, _, _ in self._entries():
+            if key is None or os.path.basename(path).endswith('_%s%s' % (key, self.SUFFIX)):
+                self._remove(path)
+
+    def prune(self, keep=None):
+        """ Evict the least recently used entries until the cache fits in max_bytes.  The entry at
+            path keep is never evicted """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self._remove(path)
+            total -= size
+
+    def _entries(self):
+        """ List the (path, size, modification time) of every cache entry """
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,85 @@
+""" The odometry motion model (Probabilistic Robotics, table 5.6, sample_motion_odometry) over the
+    particle arrays.  The motion between two odometry poses is decomposed into a rotation towards the
+    direction of travel (rot1), a translation (trans) and a final rotation (rot2), and each of them is
+    perturbed independently for every particle.  Several odometry increments can be applied in one call:
+    the noise of all of them is drawn at once and the particle headings are accumulated with a cumulative
+    sum, so a finer motion history costs no Python loop per increment """
+
+import numpy as np
+
+
+def odometry_increments(odom_poses, min_trans=0.01):
+    """ Decompose the motion along the sequence of odometry poses odom_poses (an (n, 3) array of x, y, theta)
+        into the (rot1, trans, rot2) arrays of its increments.  Poses closer than min_trans to the previous
+        one are merged into the next increment, so only a motion shorter than min_trans altogether is taken
+        as turning on the spot.  Driving backwards gives a negative trans rather than a half turn in rot1 """
+    odom_poses = np.asarray(odom_poses, dtype=np.float64).reshape((-1, 3))
+    if len(odom_poses) < 2:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+
+    def distance(i, j):
+        return np.hypot(odom_poses[i, 0] - odom_poses[j, 0], odom_poses[i, 1] - odom_poses[j, 1])
+    # the direction of travel of a short step is mostly noise, so steps are merged until they are long enough
+    keep = [0]
+    for i in range(1, len(odom_poses) - 1):
+        if distance(i, keep[-1]) >= min_trans:
+            keep.append(i)
+    if len(keep) > 1 and distance(len(odom_poses) - 1, keep[-1]) < min_trans:
+        # a short last step joins the one before it
+        keep.pop()
+    keep.append(len(odom_poses) - 1)
+    odom_poses = odom_poses[keep]
+
+    dx = np.diff(odom_poses[:, 0])
+    dy = np.diff(odom_poses[:, 1])
+    dtheta = np.angle(np.exp(1j*np.diff(odom_poses[:, 2])))
+    trans = np.hypot(dx, dy)
+    # turning on the spot has no direction of travel, count it all as the final rotation
+    rot1 = np.where(trans < min_trans, 0.0, np.arctan2(dy, dx) - odom_poses[:-1, 2])
+    rot1 = np.angle(np.exp(1j*rot1))
+    # travelling away from the heading is driving backwards, not turning around
+    backwards = np.abs(rot1) > np.pi/2
+    rot1 = np.where(backwards, np.angle(np.exp(1j*(rot1 - np.pi))), rot1)
+    trans = np.where(backwards, -trans, trans)
+    rot2 = np.angle(np.exp(1j*(dtheta - rot1)))
+    return rot1, trans, rot2
+
+
+class OdometryMotionModel(object):
+    """ Samples particle motion from odometry
+        Attributes:
+            alpha1: rotation noise caused by rotation
+            alpha2: rotation noise caused by translation
+            alpha3: translation noise caused by translation
+            alpha4: translation noise caused by rotation
+        The standard deviations are sqrt(alpha1*rot**2 + alpha2*trans**2) for the rotations and
+        sqrt(alpha3*trans**2 + alpha4*(rot1**2 + rot2**2)) for the translation, as in amcl
+    """
+
+    def __init__(self, alpha1=0.2, alpha2=0.2, alpha3=0.2, alpha4=0.2):
+        self.alpha1 = alpha1
+        self.alpha2 = alpha2
+        self.alpha3 = alpha3
+        self.alpha4 = alpha4
+
+    def sample(self, particles, odom_poses, rng=np.random):
+        """ Move every particle of the ParticleSet particles (in place) by the motion along the sequence of
+            odometry poses odom_poses, drawing the noise from the numpy RandomState rng """
+        rot1, trans, rot2 = odometry_increments(odom_poses)
+        if not len(trans) or not len(particles):
+            return
+        shape = (len(trans), len(particles))
+        rot1_sigma = np.sqrt(self.alpha1*rot1**2 + self.alpha2*trans**2)[:, np.newaxis]
+        trans_sigma = np.sqrt(self.alpha3*trans**2 + self.alpha4*(rot1**2 + rot2**2))[:, np.newaxis]
+        rot2_sigma = np.sqrt(self.alpha1*rot2**2 + self.alpha2*trans**2)[:, np.newaxis]
+        rot1_hat = rot1[:, np.newaxis] - rot1_sigma*rng.standard_normal(shape)
+        trans_hat = trans[:, np.newaxis] - trans_sigma*rng.standard_normal(shape)
+        rot2_hat = rot2[:, np.newaxis] - rot2_sigma*rng.standard_normal(shape)
+
+        # the heading of every particle before each increment, then the direction it travels in
+        turned = np.cumsum(rot1_hat + rot2_hat, axis=0)
+        heading = particles.theta + np.vstack((np.zeros((1, len(particles))), turned[:-1]))
+        direction = heading + rot1_hat
+        particles.x += (trans_hat*np.cos(direction)).sum(axis=0)
+        particles.y += (trans_hat*np.sin(direction)).sum(axis=0)
+        particles.theta += turned[-1]
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+""" Localizes several robots in one node.  Every robot gets its own particle filter, with its topics, frames
+    and parameters under its name (robot1/scan, robot1/odom, ~robot1/filter, ...), while the map, the
+    occupancy field, the on-disk cache and the tf listener are loaded once and shared.  The scans of all
+    robots go through one worker thread, which scores the laser updates of the robots waiting together.
+    To run, type the following in terminal
+    roslaunch my_localizer multi.launch map_file:=path to the yaml file robots:="[robot1, robot2]"
+"""
+
+import time
+
+import rospy
+
+from tf import TransformListener
+from tf import TransformBroadcaster
+
+from laser_model import score_batch
+from pf import ParticleFilter, SharedMap
+from scan_pipeline import BatchPipeline
+
+
+class MultiRobotLocalizer(object):
+    """ The node hosting the ParticleFilters of several robots
+        Attributes:
+            robots: the names of the robots, which prefix their topics, frames and parameters
+            shared_map: the SharedMap every filter localizes in
+            pipeline: the BatchPipeline the scans of all robots are processed on
+            filters: the ParticleFilter of each robot, in the order of robots
+    """
+
+    def __init__(self):
+        rospy.init_node('multi_pf')
+        self.robots = rospy.get_param('~robots')
+        self.shared_map = SharedMap(rospy.get_param('~map_file', ''))
+        tf_listener = TransformListener()
+        tf_broadcaster = TransformBroadcaster()
+        self.pipeline = BatchPipeline(self.process_batch, len(self.robots))
+        rospy.on_shutdown(self.pipeline.stop)
+        self.filters = [ParticleFilter(robot, self.shared_map, tf_listener, tf_broadcaster, self.pipeline.submitter(i))
+                        for i, robot in enumerate(self.robots)]
+        rospy.loginfo("localizing %s", ", ".join(self.robots))
+
+    def process_batch(self, batch):
+        """ Run the filter updates of a batch of (robot index, scan) pairs, where a scan is what
+            ParticleFilter.process_scan takes.  The laser updates of the robots due for one are scored together
+            (see laser_model.score_batch) """
+        batch = sorted(batch, key=lambda entry: entry[0])
+        filters = [self.filters[index] for index, _ in batch]
+        # the locks are always taken in robot order, so nothing else holding several of them can deadlock with this
+        for pf in filters:
+            pf.filter_lock.acquire()
+        # every robot reads the shared occupancy field, which the obstacle callbacks may be updating
+        self.shared_map.field_lock.acquire()
+        try:
+            updates = []
+            for pf, (_, (msg, laser_pose, odom_pose)) in zip(filters, batch):
+                pf.laser_pose, pf.odom_pose = laser_pose, odom_pose
+                scan = pf.begin_update(msg)
+                if scan is not None:
+                    updates.append((pf, msg, scan))
+            start = time.time()
+            log_likelihoods = score_batch([(pf.filter.laser_scorer, pf.particle_cloud, scan) for pf, _, scan in updates])
+            elapsed = time.time() - start
+            for pf, _, _ in updates:
+                if pf.timer.enabled:
+                    # the time of the whole batch, which is what each robot waited for
+                    pf.timer.record("laser", elapsed)
+            for (pf, msg, _), robot_log_likelihoods in zip(updates, log_likelihoods):
+                pf.finish_update(msg, robot_log_likelihoods)
+            for pf in filters:
+                pf.checkpoint()
+        finally:
+            self.shared_map.field_lock.release()
+            for pf in filters:
+                pf.filter_lock.release()
+        for pf, (_, (msg, _, _)) in zip(filters, batch):
+            with pf.timer.stage("publish"):
+                pf.publish_particles(msg)
+
+
+if __name__ == '__main__':
+    n = MultiRobotLocalizer()
+    r = rospy.Rate(5)
+
+    while not(rospy.is_shutdown()):
+        # in the main loop all we do is continuously broadcast the latest map to odom transforms
+        for pf in n.filters:
+            pf.broadcast_last_transform()
+            pf.publish_metrics()
+        r.sleep()
@@ -20,71 +20,235 @@ import time
 
 import numpy as np
 from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
+from scipy.ndimage import distance_transform_edt
+
+from map_cache import MapCache
+
+class FieldUpdate(object):
+    """ A change of the occupancy of some cells of an OccupancyField, with the part of the distance field it
+        changes already computed (see OccupancyField.prepare_update)
+        Attributes:
+            rows, columns: the cells whose occupancy changes
+            values: the new occupancy values of those cells
+            window: the (row slice, column slice) of the distance field that is replaced
+            closest_occ: the new distances inside window
+    """
+
+    def __init__(self, rows, columns, values, window, closest_occ):
+        self.rows = rows
+        self.columns = columns
+        self.values = values
+        self.window = window
+        self.closest_occ = closest_occ
+
 
 class OccupancyField(object):
     """ Stores an occupancy field for an input map.  An occupancy field returns the distance to the closest
-        obstacle for any coordinate in the map
+        obstacle for any coordinate in the map.
+
+        Cells can be marked occupied or free after the field is built (for doors and pallets that come and
+        go).  Only the distances within update_radius of the changed cells are recomputed, from the
+        obstacles within update_radius of those, so an update costs the same however large the map is.
+        Distances below update_radius stay exact, larger ones are only kept at least update_radius, which
+        the laser models cannot tell apart as long as update_radius is at least their max_distance
         Attributes:
             map: the map to localize against (nav_msgs/OccupancyGrid)
-            closest_occ: the distance for each entry in the OccupancyGrid to the closest obstacle
+            closest_occ: the distance from each cell of the OccupancyGrid to the closest obstacle, stored as
+                         a dense float32 array indexed as closest_occ[row, column] (i.e. [y, x])
+            grid: the occupancy values of the map as an int8 array indexed as grid[row, column]
+            static_grid: the occupancy values of the static map, which updates leave alone
+            map_hash: the key identifying the content of the static map (see MapCache.map_key), it does not
+                      change when cells are updated
+            update_radius: the distance in meters up to which updates keep the distance field exact
+            shared_memory: whether grid and closest_occ were moved into memory shared with worker processes
+                           (see parallel_scoring.share_field)
+            version: the number of updates applied, for anything derived from the field to notice it is stale
+            change_log: the (version, window) of the latest updates, see changed_window
+            free_cells: the flat indices (row*width + column) of the free cells of grid in no particular order,
+                        the index random poses are drawn from (see sample_free_poses).  It is the start of
+                        free_cell_buffer, so cells freed by updates are appended without copying the index
+            free_cell_position: where each cell is in free_cells, -1 for cells that are not free, indexed by
+                                the flat index of the cell.  It lets updates edit free_cells in place
     """
 
-    def __init__(self, map):
+    MAX_CHANGE_LOG = 64     # the number of updates changed_window can look back over
+
+    def __init__(self, map, cache=None, update_radius=2.5):
+        """ Build the occupancy field for map.  If cache (a MapCache) is given, the distance field is loaded
+            from it as a read-only memory map when available and written to it otherwise """
         self.map = map      # save this for later
-        # build up a numpy array of the coordinates of each grid cell in the map
-        X = np.zeros((self.map.info.width*self.map.info.height,2))
-
-        # while we're at it let's count the number of occupied cells
-        total_occupied = 0
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order, if you go through this right, you might be able to use curr
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    total_occupied += 1
-                X[curr,0] = float(i)
-                X[curr,1] = float(j)
-                curr += 1
-
-        # build up a numpy array of the coordinates of each occupied grid cell in the map
-        O = np.zeros((total_occupied,2))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order, if you go through this right, you might be able to use curr
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    O[curr,0] = float(i)
-                    O[curr,1] = float(j)
-                    curr += 1
-
-        # use super fast scikit learn nearest neighbor algorithm
-        nbrs = NearestNeighbors(n_neighbors=1,algorithm="ball_tree").fit(O)
-        distances, indices = nbrs.kneighbors(X)
-
-        self.closest_occ = {}
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                ind = i + j*self.map.info.width
-                self.closest_occ[ind] = distances[curr][0]*self.map.info.resolution
-                curr += 1
+        self.update_radius = update_radius
+        self.version = 0
+        self.change_log = []
+        # occupancy grids are stored in row major order, so the flat data reshapes straight into rows of y
+        self.grid = np.asarray(self.map.data, dtype=np.int8).reshape((self.map.info.height, self.map.info.width))
+        # the grid may be a view of the map message, which keeps describing the static map, so the first update
+        # copies it.  A grid moved into shared memory (see parallel_scoring.share_field) is owned and written in place
+        self._owns_grid = False
+        self.shared_memory = False
+        self.static_grid = self.grid
+        self.map_hash = MapCache.map_key(self.map.info, self.grid)
+
+        self.closest_occ = cache.load(self.map_hash, 'occupancy_field') if cache else None
+        if self.closest_occ is None:
+            self.closest_occ = self.compute_closest_occ(self.grid, self.map.info.resolution)
+            if cache:
+                self.closest_occ = cache.store(self.map_hash, 'occupancy_field', self.closest_occ)
+        self.free_cell_buffer = np.flatnonzero(self.grid.ravel() == 0)
+        self.free_cells = self.free_cell_buffer[:]
+        self.free_cell_position = np.full(self.grid.size, -1, dtype=np.int32)
+        self.free_cell_position[self.free_cells] = np.arange(len(self.free_cells), dtype=np.int32)
+
+    @staticmethod
+    def compute_closest_occ(grid, resolution):
+        """ Compute the distance from every cell of grid to the closest occupied cell """
+        occupied = grid > 0
+        if not occupied.any():
+            # without any obstacles there is nothing to be close to
+            return np.full(grid.shape, np.inf, dtype=np.float32)
+        # exact euclidean distance (in cells) from every cell to the closest occupied cell
+        distances = distance_transform_edt(~occupied)
+        return (distances*resolution).astype(np.float32)
 
     def get_closest_obstacle_distance(self,x,y):
-        """ Compute the closest obstacle to the specified (x,y) coordinate in the map.  If the (x,y) coordinate
-            is out of the map boundaries, nan will be returned. """
-        x_coord = int((x - self.map.info.origin.position.x)/self.map.info.resolution)
-        y_coord = int((y - self.map.info.origin.position.y)/self.map.info.resolution)
-
-        # check if we are in bounds
-        if x_coord > self.map.info.width or x_coord < 0:
-            return float('nan')
-        if y_coord > self.map.info.height or y_coord < 0:
-            return float('nan')
-
-        ind = x_coord + y_coord*self.map.info.width
-        if ind >= self.map.info.width*self.map.info.height or ind < 0:
-            return float('nan')
-        return self.closest_occ[ind]
\ No newline at end of file
+        """ Compute the closest obstacle to the specified (x,y) coordinate in the map.  x and y may be
+            scalars or arrays of coordinates, in which case an array of distances is returned.  If an (x,y)
+            coordinate is out of the map boundaries, nan will be returned for it. """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        x_coord = np.floor((x - self.map.info.origin.position.x)/self.map.info.resolution)
+        y_coord = np.floor((y - self.map.info.origin.position.y)/self.map.info.resolution)
+
+        # check if we are in bounds (nan coordinates fail every comparison)
+        valid = ((x_coord >= 0) & (x_coord < self.map.info.width) &
+                 (y_coord >= 0) & (y_coord < self.map.info.height))
+
+        distances = np.full(valid.shape, np.nan, dtype=np.float32)
+        distances[valid] = self.closest_occ[y_coord[valid].astype(np.intp), x_coord[valid].astype(np.intp)]
+        if distances.ndim == 0:
+            return float(distances)
+        return distances
+
+    def map_cells(self, x, y):
+        """ The cells containing the map coordinates (x, y) (arrays).  Returns (rows, columns, valid) where valid
+            tells which coordinates are on the map, and rows and columns hold the cells of those only """
+        info = self.map.info
+        columns = np.floor((np.asarray(x, dtype=np.float64) - info.origin.position.x)/info.resolution)
+        rows = np.floor((np.asarray(y, dtype=np.float64) - info.origin.position.y)/info.resolution)
+        valid = (columns >= 0) & (columns < info.width) & (rows >= 0) & (rows < info.height)
+        return rows[valid].astype(np.intp), columns[valid].astype(np.intp), valid
+
+    def prepare_update(self, rows, columns, values):
+        """ Compute the change of the distance field caused by setting the occupancy of the cells (rows,
+            columns) to values (100 for occupied, 0 for free, broadcast against the cells), without changing
+            the field yet.  Returns a FieldUpdate for apply_update, or None if no cell changes """
+        rows = np.asarray(rows, dtype=np.intp).ravel()
+        columns = np.asarray(columns, dtype=np.intp).ravel()
+        values = np.broadcast_to(np.asarray(values, dtype=np.int8), rows.shape)
+        changed = self.grid[rows, columns] != values
+        rows, columns, values = rows[changed], columns[changed], values[changed]
+        if not len(rows):
+            return None
+
+        # the distances that can change lie within the update radius of a changed cell, and the obstacles they
+        # can be measured to within the update radius of those
+        margin = int(math.ceil(self.update_radius/self.map.info.resolution))
+        height, width = self.grid.shape
+        inner = (slice(max(rows.min() - margin, 0), min(rows.max() + margin + 1, height)),
+                 slice(max(columns.min() - margin, 0), min(columns.max() + margin + 1, width)))
+        outer = (slice(max(rows.min() - 2*margin, 0), min(rows.max() + 2*margin + 1, height)),
+                 slice(max(columns.min() - 2*margin, 0), min(columns.max() + 2*margin + 1, width)))
+        grid = self.grid[outer].copy()
+        grid[rows - outer[0].start, columns - outer[1].start] = values
+        local = self.compute_closest_occ(grid, self.map.info.resolution)
+        local = local[inner[0].start - outer[0].start:inner[0].stop - outer[0].start,
+                      inner[1].start - outer[1].start:inner[1].stop - outer[1].start]
+
+        # beyond the update radius the closest obstacle may lie outside the window, so only a lower bound is known
+        closest_occ = np.where(local < self.update_radius, local,
+                               np.maximum(self.closest_occ[inner], np.float32(self.update_radius)))
+        return FieldUpdate(rows, columns, values, inner, closest_occ.astype(np.float32))
+
+    def apply_update(self, update):
+        """ Apply a FieldUpdate computed by prepare_update.  The arrays are written in place, so processes
+            sharing them (see parallel_scoring.share_array) see the change """
+        if update is None:
+            return
+        if not self._owns_grid:
+            self.grid = self.grid.copy()
+            self._owns_grid = True
+        if not self.closest_occ.flags.writeable:
+            # a memory map of the cache, which also keeps describing the static map
+            self.closest_occ = np.array(self.closest_occ)
+        self.grid[update.rows, update.columns] = update.values
+        self.closest_occ[update.window] = update.closest_occ
+        self.version += 1
+        self.change_log.append((self.version, update.window))
+        del self.change_log[:-self.MAX_CHANGE_LOG]
+        cells = np.unique(update.rows*self.grid.shape[1] + update.columns)
+        self.update_free_cells(cells, self.grid.ravel()[cells] == 0)
+
+    def changed_window(self, version):
+        """ The (row slice, column slice) bounding every cell of grid and closest_occ changed since version, for
+            refreshing what was derived from the field at that version.  Returns None if nothing changed, and
+            the whole grid if version is older than the change log """
+        if version >= self.version:
+            return None
+        if version < self.version - len(self.change_log):
+            return (slice(0, self.grid.shape[0]), slice(0, self.grid.shape[1]))
+        windows = [window for changed, window in self.change_log if changed > version]
+        return (slice(min(rows.start for rows, _ in windows), max(rows.stop for rows, _ in windows)),
+                slice(min(columns.start for _, columns in windows), max(columns.stop for _, columns in windows)))
+
+    def update_free_cells(self, cells, free):
+        """ Add the cells (distinct flat indices) where free is True to the free cell index and remove the others.
+            Removed cells are filled with cells from the end of the index, so the cost depends on the number of
+            cells changed rather than on the size of the map """
+        position = self.free_cell_position[cells]
+        removed = np.sort(position[~free & (position >= 0)])
+        added = cells[free & (position < 0)]
+
+        n = len(self.free_cells) - len(removed)
+        # the holes left before the new end are filled by the cells after it that stay
+        holes = removed[removed < n]
+        tail = np.arange(n, len(self.free_cells))
+        movers = tail[~np.isin(tail, removed)]
+        self.free_cell_position[self.free_cells[removed]] = -1
+        self.free_cells[holes] = self.free_cells[movers]
+        self.free_cell_position[self.free_cells[holes]] = holes
+        self.free_cells = self.free_cells[:n]
+        if len(added):
+            if n + len(added) > len(self.free_cell_buffer):
+                # grow geometrically, so appending stays cheap on average
+                buffer = np.empty(max(2*len(self.free_cell_buffer), n + len(added)), dtype=self.free_cells.dtype)
+                buffer[:n] = self.free_cells
+                self.free_cell_buffer = buffer
+            self.free_cell_buffer[n:n + len(added)] = added
+            self.free_cell_position[added] = np.arange(n, n + len(added), dtype=np.int32)
+            self.free_cells = self.free_cell_buffer[:n + len(added)]
+
+    def sample_free_poses(self, n, rng):
+        """ Draw n poses uniformly from the free space of the map, with uniform headings, using the numpy
+            RandomState rng.  Every pose is a draw from the free cell index followed by a uniform offset within
+            the cell, so the cost does not depend on how much of the map is free.  Returns the arrays
+            (x, y, theta), which are empty if the map has no free cells """
+        if not len(self.free_cells):
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        info = self.map.info
+        rows, columns = np.divmod(self.free_cells[rng.randint(len(self.free_cells), size=n)], info.width)
+        x = info.origin.position.x + (columns + rng.random_sample(n))*info.resolution
+        y = info.origin.position.y + (rows + rng.random_sample(n))*info.resolution
+        return x, y, rng.uniform(-math.pi, math.pi, n)
+
+    def update_cells(self, rows, columns, values):
+        """ Set the occupancy of the cells (rows, columns) to values (see prepare_update) and update the
+            distance field around them.  Returns the number of cells that changed """
+        update = self.prepare_update(rows, columns, values)
+        self.apply_update(update)
+        return len(update.rows) if update else 0
+
+    def set_occupied(self, x, y, occupied=True):
+        """ Mark the cells containing the map coordinates (x, y) (arrays) as occupied, or as free if occupied
+            is False.  Returns the number of cells that changed """
+        rows, columns, _ = self.map_cells(x, y)
+        return self.update_cells(rows, columns, 100 if occupied else 0)
@@ -0,0 +1,98 @@
+""" A parallel backend for the laser update.  The particle cloud is split into contiguous chunks that are
+    scored by a persistent pool of worker processes, and the log-likelihoods are merged back in order.
+
+    The workers are forked from the filter process and reach the occupancy field through shared memory,
+    so the map is never pickled per call: only the particle chunks and the prepared scan are sent.  This
+    relies on the fork start method, which is the default for multiprocessing on Linux """
+
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+from particle_set import ParticleSet
+
+# the laser model of a worker process, set up once by _init_worker
+_worker_model = None
+
+
+def share_array(array):
+    """ Copy array into shared memory and return a numpy array backed by it.  Writes to the returned array
+        are seen by every process forked afterwards """
+    array = np.ascontiguousarray(array)
+    raw = multiprocessing.RawArray(ctypes.c_ubyte, max(1, array.nbytes))
+    shared = np.ctypeslib.as_array(raw)[:array.nbytes].view(array.dtype).reshape(array.shape)
+    shared[...] = array
+    return shared
+
+
+def share_field(field):
+    """ Move the grid and distance field of the OccupancyField field into shared memory, unless that was done
+        before.  The filters of several robots may score against one field, each with its own pool, and the
+        pools forked earlier keep reading the shared arrays of the first move """
+    if field.shared_memory:
+        return
+    field.closest_occ = share_array(field.closest_occ)
+    field.grid = share_array(field.grid)
+    # updates of the field have to write into the shared grid rather than a private copy of it
+    field._owns_grid = True
+    field.shared_memory = True
+
+
+def _init_worker(model, seed):
+    global _worker_model
+    _worker_model = model
+    # scoring itself is deterministic, seeding only guards anything random a model might do
+    np.random.seed(seed)
+
+
+def _score_chunk(args):
+    x, y, theta, w, scan = args
+    return _worker_model.log_weights(ParticleSet(x, y, theta, w), scan)
+
+
+class ParallelScorer(object):
+    """ Scores particle clouds with a laser model on a pool of worker processes.  It has the same log_weights()
+        interface as the laser models, so it can stand in for one
+        Attributes:
+            model: the laser model (LikelihoodFieldModel or BeamModel) doing the scoring
+            processes: the number of worker processes
+            min_chunk: the smallest number of particles worth sending to a worker.  Smaller clouds are
+                       scored in the calling process
+            seed: the seed of the workers' random number generators
+    """
+
+    def __init__(self, model, processes=None, min_chunk=256, seed=0):
+        self.model = model
+        self.processes = processes or multiprocessing.cpu_count()
+        self.min_chunk = min_chunk
+        self.seed = seed
+
+        # move the map arrays into shared memory before forking, so the workers all see the same pages
+        share_field(model.occupancy_field)
+        range_table = getattr(model, 'range_table', None)
+        if range_table is not None:
+            # refreshed by this process (see log_weights), the workers only read it
+            range_table.table = share_array(range_table.table)
+        self.pool = multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(model, seed))
+
+    def log_weights(self, particles, scan):
+        """ Compute the log-likelihood of every particle in the ParticleSet particles given scan (a PreparedScan).
+            The split into chunks only depends on the number of particles and workers, so the result is the
+            same as scoring in a single process """
+        n_chunks = min(self.processes, len(particles) // self.min_chunk)
+        if n_chunks <= 1:
+            return self.model.log_weights(particles, scan)
+        # the workers' copies of the field never see its version change, so the shared arrays derived from
+        # it are brought up to date here
+        self.model.refresh()
+        bounds = np.linspace(0, len(particles), n_chunks + 1).astype(np.intp)
+        chunks = [(particles.x[start:stop], particles.y[start:stop], particles.theta[start:stop],
+                   particles.w[start:stop], scan)
+                  for start, stop in zip(bounds[:-1], bounds[1:])]
+        return np.concatenate(self.pool.map(_score_chunk, chunks))
+
+    def close(self):
+        """ Shut down the worker pool """
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,91 @@
+""" Publishes the particle cloud for visualization without rebuilding it every time.  The PoseArray
+    and its Pose messages are allocated once and refilled in place, the quaternions of all particles are
+    computed in one array operation, large clouds are cut down to a weight-stratified subsample, and
+    nothing is sent unless the cloud changed (at most max_rate times a second) and someone listens """
+
+import time
+
+import numpy as np
+
+from std_msgs.msg import Header
+from geometry_msgs.msg import PoseArray, Pose, Point, Quaternion
+
+from resampling import stratified_resample
+
+
+def stratified_subsample(weights, n, rng=np.random):
+    """ The sorted indices of at most n particles chosen with stratified resampling, so every part of the
+        cloud is represented in proportion to its weight.  Clouds of n particles or fewer are kept whole """
+    if len(weights) <= n:
+        return np.arange(len(weights))
+    if not np.sum(weights) > 0:
+        weights = np.ones(len(weights))
+    return np.unique(stratified_resample(weights, n, rng))
+
+
+class ParticleCloudPublisher(object):
+    """ Publishes ParticleSets as geometry_msgs/PoseArray
+        Attributes:
+            publisher: the rospy.Publisher of the PoseArray
+            frame_id: the frame the particles are expressed in
+            max_poses: the largest number of poses sent, bigger clouds are subsampled (0 sends every particle)
+            max_rate: the largest number of messages sent per second
+            changed: whether the cloud changed since it was last published, set by mark_changed
+            message: the reused PoseArray
+    """
+
+    def __init__(self, publisher, frame_id, max_poses=500, max_rate=5.0, rng=None):
+        self.publisher = publisher
+        self.frame_id = frame_id
+        self.max_poses = max_poses
+        self.max_rate = max_rate
+        self.rng = rng or np.random.RandomState(0)
+        self.changed = True
+        self.last_publish = 0.0
+        self.message = PoseArray(header=Header(frame_id=frame_id), poses=[])
+        self._pool = []
+
+    def mark_changed(self):
+        """ Note that the cloud changed, so the next call to publish sends it """
+        self.changed = True
+
+    def publish(self, particles, stamp):
+        """ Send the ParticleSet particles stamped with stamp, if it changed since the last message, the rate
+            limit allows it and the topic has subscribers.  Returns whether a message was sent """
+        now = time.time()
+        if not self.changed or (self.max_rate and now - self.last_publish < 1.0/self.max_rate):
+            return False
+        if not self.publisher.get_num_connections():
+            return False
+
+        if self.max_poses:
+            indices = stratified_subsample(particles.w, self.max_poses, self.rng)
+            x, y, theta = particles.x[indices], particles.y[indices], particles.theta[indices]
+        else:
+            x, y, theta = particles.x, particles.y, particles.theta
+        self.fill(x, y, theta)
+        self.message.header.stamp = stamp
+        self.publisher.publish(self.message)
+        self.changed = False
+        self.last_publish = now
+        return True
+
+    def fill(self, x, y, theta):
+        """ Write the poses (x, y, theta) (arrays) into the reused message, growing the pool of Pose messages
+            only when more poses are needed than ever before """
+        n = len(x)
+        while len(self._pool) < n:
+            self._pool.append(Pose(position=Point(x=0.0, y=0.0, z=0.0),
+                                   orientation=Quaternion(x=0.0, y=0.0, z=0.0, w=1.0)))
+        # the quaternion of a yaw is (0, 0, sin(yaw/2), cos(yaw/2))
+        half = 0.5*theta
+        for pose, px, py, qz, qw in zip(self._pool, x.tolist(), y.tolist(), np.sin(half).tolist(), np.cos(half).tolist()):
+            pose.position.x = px
+            pose.position.y = py
+            pose.orientation.z = qz
+            pose.orientation.w = qw
+        poses = self.message.poses
+        if len(poses) > n:
+            del poses[n:]
+        else:
+            poses.extend(self._pool[len(poses):n])
@@ -0,0 +1,150 @@
+""" A structure-of-arrays representation of the particle cloud.  Every filter stage operates on
+    the contiguous numpy arrays stored here instead of walking a list of Particle objects """
+
+import tf
+from geometry_msgs.msg import Pose, Point, Quaternion
+
+import numpy as np
+
+
+class ParticleSet(object):
+    """ Stores a set of pose hypotheses as parallel numpy arrays
+        Attributes:
+            x: the x-coordinates of the hypotheses relative to the map frame
+            y: the y-coordinates of the hypotheses relative to the map frame
+            theta: the yaws of the hypotheses relative to the map frame
+            w: the particle weights (the class does not ensure that particle weights are normalized)
+    """
+
+    def __init__(self, x=(), y=(), theta=(), w=None):
+        """ Construct a new ParticleSet from array-likes of equal length.  If w is omitted every
+            particle is given a weight of 1.0 """
+        self.x = np.array(x, dtype=np.float64)
+        self.y = np.array(y, dtype=np.float64)
+        self.theta = np.array(theta, dtype=np.float64)
+        if w is None:
+            self.w = np.ones(len(self.x))
+        else:
+            self.w = np.array(w, dtype=np.float64)
+
+    @classmethod
+    def empty(cls, n):
+        """ Create a set of n particles at the origin, all with weight 1.0 """
+        return cls(np.zeros(n), np.zeros(n), np.zeros(n))
+
+    @classmethod
+    def from_particles(cls, particles):
+        """ Build a ParticleSet from an iterable of Particle objects """
+        particles = list(particles)
+        return cls([p.x for p in particles],
+                   [p.y for p in particles],
+                   [p.theta for p in particles],
+                   [p.w for p in particles])
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Particle(particle_set=self, index=i)
+
+    def __getitem__(self, key):
+        """ An integer key returns a Particle view onto that entry, anything else (slice, index
+            array or boolean mask) gathers the selected entries into a new ParticleSet """
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError("particle index out of range")
+            return Particle(particle_set=self, index=key)
+        return self.take(key)
+
+    def take(self, indices):
+        """ Gather the particles at indices (slice, index array or boolean mask) into a new set.
+            The returned arrays are copies, so the result is independent of this set """
+        return ParticleSet(self.x[indices], self.y[indices], self.theta[indices], self.w[indices])
+
+    def put(self, indices, other):
+        """ Scatter the particles of the ParticleSet other into the entries at indices """
+        self.x[indices] = other.x
+        self.y[indices] = other.y
+        self.theta[indices] = other.theta
+        self.w[indices] = other.w
+
+    def copy(self):
+        """ Return an independent copy of this set """
+        return self.take(slice(None))
+
+    def as_particles(self):
+        """ Return a list of Particle views onto this set """
+        return list(self)
+
+    def as_poses(self):
+        """ Convert every particle to a geometry_msgs/Pose message, computing the quaternions of all yaws at once """
+        half = 0.5*self.theta
+        return [Pose(position=Point(x=x, y=y, z=0), orientation=Quaternion(x=0.0, y=0.0, z=qz, w=qw))
+                for x, y, qz, qw in zip(self.x.tolist(), self.y.tolist(), np.sin(half).tolist(), np.cos(half).tolist())]
+
+
+class Particle(object):
+    """ Represents a hypothesis (particle) of the robot's pose consisting of x,y and theta (yaw).
+        A Particle is a thin view onto one entry of a ParticleSet, so writing to its attributes
+        writes through to the underlying arrays.
+        Attributes:
+            x: the x-coordinate of the hypothesis relative to the map frame
+            y: the y-coordinate of the hypothesis relative ot the map frame
+            theta: the yaw of the hypothesis relative to the map frame
+            w: the particle weight (the class does not ensure that particle weights are normalized)
+    """
+
+    def __init__(self,x=0.0,y=0.0,theta=0.0,w=1.0,particle_set=None,index=0):
+        """ Construct a new Particle
+            x: the x-coordinate of the hypothesis relative to the map frame
+            y: the y-coordinate of the hypothesis relative ot the map frame
+            theta: the yaw of the hypothesis relative to the map frame
+            w: the particle weight (the class does not ensure that particle weights are normalized
+            particle_set: the ParticleSet to view into.  If omitted a private single entry set
+                          is created from x, y, theta and w
+            index: the entry of particle_set this particle refers to """
+        if particle_set is None:
+            particle_set = ParticleSet([x], [y], [theta], [w])
+            index = 0
+        self._set = particle_set
+        self._index = index
+
+    @property
+    def x(self):
+        return float(self._set.x[self._index])
+
+    @x.setter
+    def x(self, value):
+        self._set.x[self._index] = value
+
+    @property
+    def y(self):
+        return float(self._set.y[self._index])
+
+    @y.setter
+    def y(self, value):
+        self._set.y[self._index] = value
+
+    @property
+    def theta(self):
+        return float(self._set.theta[self._index])
+
+    @theta.setter
+    def theta(self, value):
+        self._set.theta[self._index] = value
+
+    @property
+    def w(self):
+        return float(self._set.w[self._index])
+
+    @w.setter
+    def w(self, value):
+        self._set.w[self._index] = value
+
+    def as_pose(self):
+        """ A helper function to convert a particle to a geometry_msgs/Pose message """
+        orientation_tuple = tf.transformations.quaternion_from_euler(0,0,self.theta)
+        return Pose(position=Point(x=self.x,y=self.y,z=0), orientation=Quaternion(x=orientation_tuple[0], y=orientation_tuple[1], z=orientation_tuple[2], w=orientation_tuple[3]))
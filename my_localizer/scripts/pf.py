@@ -8,379 +8,360 @@ To run, type the following in terminal
 
 import rospy
 
-from std_msgs.msg import Header, String
+from std_msgs.msg import Header
 from sensor_msgs.msg import LaserScan
-from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
-from nav_msgs.srv import GetMap
-from copy import deepcopy
+from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseWithCovariance, PoseArray, Pose, Point, Quaternion
+from nav_msgs.msg import OccupancyGrid
+from nav_msgs.srv import GetMap, GetMapResponse
+from std_srvs.srv import Empty, EmptyResponse
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
-import tf
+import tf.transformations
 from tf import TransformListener
 from tf import TransformBroadcaster
-from tf.transformations import euler_from_quaternion, rotation_matrix, quaternion_from_matrix
-from random import gauss
-from scipy.stats import norm
 
 import math
+import os
+import threading
 import time
 
 import numpy as np
-from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
 from occupancy_field import OccupancyField
-
-from helper_functions import (convert_pose_inverse_transform,
-                              convert_translation_rotation_to_pose,
-                              convert_pose_to_xy_and_theta,
+from map_cache import MapCache, default_cache_dir
+from map_loader import load_map
+from filter_core import ParticleFilterCore
+from stage_timing import StageTimer
+from scan_pipeline import ScanPipeline
+from particle_publisher import ParticleCloudPublisher
+from checkpoint import Checkpoint, CheckpointWriter, read_checkpoint
+
+import se2
+from helper_functions import (convert_pose_to_xy_and_theta,
                               angle_diff)
 
-class Particle(object):
-    """ Represents a hypothesis (particle) of the robot's pose consisting of x,y and theta (yaw)
+class SharedMap(object):
+    """ The map and the occupancy field built from it, loaded once per process and shared by the filters of
+        every robot localized in it (see multi_pf.py)
         Attributes:
-            x: the x-coordinate of the hypothesis relative to the map frame
-            y: the y-coordinate of the hypothesis relative ot the map frame
-            theta: the yaw of the hypothesis relative to the map frame
-            w: the particle weight (the class does not ensure that particle weights are normalized)
+            map: the map as a nav_msgs/GetMap response, the nav_msgs/OccupancyGrid is map.map
+            map_cache: the on-disk cache of arrays computed from the map (see MapCache)
+            occupancy_field: the OccupancyField of the map
+            field_lock: guards the occupancy field, held while it is updated and while any filter reads it
     """
 
-    def __init__(self,x=0.0,y=0.0,theta=0.0,w=1.0):
-        """ Construct a new Particle
-            x: the x-coordinate of the hypothesis relative to the map frame
-            y: the y-coordinate of the hypothesis relative ot the map frame
-            theta: the yaw of the hypothesis relative to the map frame
-            w: the particle weight (the class does not ensure that particle weights are normalized """
-        self.w = w
-        self.theta = theta
-        self.x = x
-        self.y = y
-
-    def as_pose(self):
-        """ A helper function to convert a particle to a geometry_msgs/Pose message """
-        orientation_tuple = tf.transformations.quaternion_from_euler(0,0,self.theta)
-        return Pose(position=Point(x=self.x,y=self.y,z=0), orientation=Quaternion(x=orientation_tuple[0], y=orientation_tuple[1], z=orientation_tuple[2], w=orientation_tuple[3]))
-
-    # TODO: define additional helper functions if needed
-
-class ParticleFilter:
-    """ The class that represents a Particle Filter ROS Node
+    def __init__(self, map_file='', map_frame="map", cache_dir=None, cache_max_bytes=512*1024*1024):
+        """ Load the map from the map_server YAML file map_file, or from the static_map service if it is '' """
+        if map_file:
+            # read the map straight from disk, its data stays a numpy array instead of a list of cells
+            self.map = GetMapResponse(map=load_map(map_file, map_frame))
+            rospy.loginfo("loaded map from %s", map_file)
+        else:
+            # request the map from the map server, the map should be of type nav_msgs/OccupancyGrid
+            get_map_from_server = rospy.ServiceProxy('static_map', GetMap) # 'static map' is the service that map_server publishes to.
+            self.map = get_map_from_server()
+            rospy.loginfo("got map") #Do not print the map itself, it is huge
+
+        # Create our occupancy field to reference later using the map we got, reusing the cached field if this map was seen before
+        self.map_cache = MapCache(cache_dir, cache_max_bytes)
+        self.occupancy_field = OccupancyField(self.map.map, cache=self.map_cache)
+        rospy.loginfo("created occupancy field")
+        # the filters of several robots may read the field while the obstacles of another one are written into it
+        self.field_lock = threading.Lock()
+
+
+class ParticleFilter(object):
+    """ The class that represents a Particle Filter ROS Node.  The filter itself lives in a ParticleFilterCore,
+        this class connects it to topics, tf and the map server.  Several of them can share a process, one per
+        robot, each with its own prefix (see multi_pf.py)
         Attributes list:
             initialized: a Boolean flag to communicate to other class methods that initializaiton is complete
+            prefix: the namespace of the robot's topics, frames and parameters, '' for a node localizing one robot
             base_frame: the name of the robot base coordinate frame (should be "base_link" for most robots)
             map_frame: the name of the map coordinate frame (should be "map" in most cases)
             odom_frame: the name of the odometry coordinate frame (should be "odom" in most cases)
             scan_topic: the name of the scan topic to listen to (should be "scan" in most cases)
-            n_particles: the number of particles in the filter
-            d_thresh: the amount of linear movement before triggering a filter update
-            a_thresh: the amount of angular movement before triggering a filter update
-            laser_max_distance: the maximum distance to an obstacle we should use in a likelihood calculation
+            filter: the ParticleFilterCore doing the odometry update, laser update, resampling and pose estimate
             pose_listener: a subscriber that listens for new approximate pose estimates (i.e. generated through the rviz GUI)
             particle_pub: a publisher for the particle cloud
+            particle_publisher: the ParticleCloudPublisher filling and rate limiting the particle cloud messages
             laser_subscriber: listens for new scan data on topic self.scan_topic
             tf_listener: listener for coordinate transforms
             tf_broadcaster: broadcaster for coordinate transforms
-            particle_cloud: a list of particles representing a probability distribution over robot poses
+            particle_cloud: a ParticleSet representing a probability distribution over robot poses (the cloud of filter)
             current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
                                    The pose is expressed as a list [x,y,theta] (where theta is the yaw)
             map: the map we will be localizing ourselves in.  The map should be of type nav_msgs/OccupancyGrid
+            map_file: the map_server YAML file the map is loaded from, or '' to request it from the static_map service
+            map_cache: the on-disk cache of arrays computed from the map (see MapCache)
+            timer: the StageTimer collecting the latency of each stage of the filter loop
+            metrics_pub: a publisher for the stage latencies as diagnostic_msgs/DiagnosticArray
+            scan_pipeline: the ScanPipeline running filter updates off the subscriber thread (or anything else with
+                           a submit method, such as the batching pipeline of multi_pf.py), or None when scans
+                           are processed in the callback
+            filter_lock: serializes the filter updates and re-initializations from rviz
+            field_lock: the SharedMap lock guarding the occupancy field, always taken after filter_lock
+            transform_lock: guards the map to odom transform shared with the main loop
+            global_localization_requested: whether the next scan should localize the robot over the whole map
+                                           rather than update the particle cloud
+            obstacle_topic: the topic of a nav_msgs/OccupancyGrid of local obstacles (e.g. a local costmap in the
+                            map frame) whose cells are written into the occupancy field, '' to keep the static map
+            obstacle_subscriber: listens for the local obstacle grids, or None
+            checkpoint_file: where the filter state is checkpointed and restored from on startup, '' to do neither
+            checkpoint_max_age: checkpoints older than this (seconds) are not restored, 0 for no limit
+            checkpoint_max_odom_jump, checkpoint_max_odom_turn: how far (meters, radians) the odometry may have
+                                                                moved from a checkpoint for it to be restored
+            checkpoint_writer: the CheckpointWriter saving the filter state in the background, or None
+            pending_checkpoint: the Checkpoint read on startup, restored on the first scan if the odometry
+                                continues from it (see apply_checkpoint), or None
     """
-    def __init__(self):
-        self.initialized = False        # make sure we don't perform updates before everything is setup
-        rospy.init_node('pf')           # tell roscore that we are creating a new node named "pf"
-
-        self.base_frame = "base_link"   # the frame of the robot base
-        self.map_frame = "map"          # the name of the map coordinate frame
-        self.odom_frame = "odom"        # the name of the odometry coordinate frame
-        self.scan_topic = "scan"        # the topic where we will get laser scans from
-
-        self.n_particles = 100          # the number of particles to use
-        self.select_particle_ratio = 10  # The ratio of total particles to selected particles in each resample
-        self.num_resamples = self.n_particles/self.select_particle_ratio    #number of particles to keep when resampling. 
-
-        #Good d_thresh: 0.2
-        self.d_thresh = 0.2             # the amount of linear movement before performing an update
-        self.a_thresh = math.pi/6       # the amount of angular movement before performing an update
 
-        self.laser_max_distance = 2.5   # maximum penalty to assess in the likelihood field model
+    def __init__(self, prefix='', shared_map=None, tf_listener=None, tf_broadcaster=None, scan_pipeline=None):
+        """ Set up the filter of the robot whose topics and frames are prefixed with prefix.  A node hosting
+            several robots passes the SharedMap, tf listener and broadcaster they share and the pipeline their
+            scans go to, and has already called rospy.init_node """
+        self.initialized = False        # make sure we don't perform updates before everything is setup
+        self.prefix = prefix
+        if shared_map is None:
+            rospy.init_node('pf')       # tell roscore that we are creating a new node named "pf"
+
+        self.base_frame = self.prefixed("base_link")    # the frame of the robot base
+        self.map_frame = "map"          # the name of the map coordinate frame, shared by all robots
+        self.odom_frame = self.prefixed("odom")         # the name of the odometry coordinate frame
+        self.scan_topic = self.prefixed("scan")         # the topic where we will get laser scans from
+
+        # parameters of the filter that differ from the ParticleFilterCore defaults, e.g. set in a launch file with
+        # <rosparam param="filter">{n_particles: 300, sensor_model: beam}</rosparam>
+        self.filter_params = self.get_param('filter', {})
+
+        self.map_file = self.get_param('map_file', '')  # load the map from this YAML file rather than from map_server
+        self.map_cache_dir = None       # where computed occupancy fields are cached, None uses $ROS_HOME/my_localizer
+        self.map_cache_max_bytes = 512*1024*1024    # evict least recently used cache entries beyond this size
+
+        # per-stage latency instrumentation of the filter loop, near free when switched off
+        self.timer = StageTimer(enabled=self.get_param('timing', True))
+        self.metrics_period = self.get_param('metrics_period', 5.0)  # seconds between publishing the latencies
+        self.metrics_file = self.get_param('metrics_file', '')        # also dump the latencies to this JSON file if set
+        self.last_metrics_time = time.time()
+        self.update_start = 0.0         # when the filter update in progress started, see begin_update
+
+        # run filter updates on their own thread, only ever working on the latest scan
+        self.async_scans = self.get_param('async_scans', True)
+        self.scan_pipeline = scan_pipeline
+        self.filter_lock = threading.Lock()
+        self.transform_lock = threading.Lock()
+
+        # localize over the whole map on the first scan instead of around the odometry, and whenever the
+        # global_localization service is called
+        self.global_localization_requested = self.get_param('global_localization_on_start', False)
 
         # Setup pubs and subs
-        self.robot_pose_pub = rospy.Publisher("robot_pose", Pose, queue_size=10)
+        self.robot_pose_pub = rospy.Publisher(self.prefixed("robot_pose"), Pose, queue_size=10)
+        # the pose estimate together with its covariance, as amcl publishes it
+        self.pose_covariance_pub = rospy.Publisher(self.prefixed("robot_pose_with_covariance"), PoseWithCovarianceStamped, queue_size=10)
         # pose_listener responds to selection of a new approximate robot location (for instance using rviz)
-        self.pose_listener = rospy.Subscriber("initialpose", PoseWithCovarianceStamped, self.update_initial_pose)
-        # publish the current particle cloud.  This enables viewing particles in rviz.
-        self.particle_pub = rospy.Publisher("particlecloud", PoseArray, queue_size=10)
+        self.pose_listener = rospy.Subscriber(self.prefixed("initialpose"), PoseWithCovarianceStamped, self.update_initial_pose)
+        # global_localization_service spreads the filter over the whole map, as amcl's service of the same name
+        self.global_localization_service = rospy.Service(self.prefixed("global_localization"), Empty, self.request_global_localization)
+        # publish the current particle cloud.  This enables viewing particles in rviz.  The cloud is only sent when it
+        # changed, so the publisher is latched for rviz instances started later
+        self.particle_pub = rospy.Publisher(self.prefixed("particlecloud"), PoseArray, queue_size=1, latch=True)
+        self.particle_publisher = ParticleCloudPublisher(
+            self.particle_pub, self.map_frame,
+            max_poses=self.get_param('particle_publish_max', 500),     # subsample larger clouds to this many poses, 0 sends all
+            max_rate=self.get_param('particle_publish_rate', 5.0))     # messages per second at most, 0 for no limit
+        # publish the latency of each stage of the filter loop
+        self.metrics_pub = rospy.Publisher("diagnostics", DiagnosticArray, queue_size=1)
+
+        # checkpoint the filter state every checkpoint_period seconds, so a restarted node carries on where it stopped
+        self.checkpoint_file = self.get_param('checkpoint_file', os.path.join(
+            default_cache_dir(), 'checkpoint_%s.bin' % (self.prefix.replace('/', '_') or 'pf')))
+        self.checkpoint_period = self.get_param('checkpoint_period', 1.0)
+        # a checkpoint is only restored if it is recent and the odometry carries on from it, so a robot that was
+        # moved or restarted its odometry while the node was down starts afresh rather than at a stale pose
+        self.checkpoint_max_age = self.get_param('checkpoint_max_age', 300.0)      # seconds, 0 for no limit
+        self.checkpoint_max_odom_jump = self.get_param('checkpoint_max_odom_jump', 0.5)    # meters
+        self.checkpoint_max_odom_turn = self.get_param('checkpoint_max_odom_turn', 0.5)    # radians
+        self.checkpoint_writer = None
+        self.pending_checkpoint = None
+
+        # cells of the map that changed since it was saved (doors, pallets), applied to the occupancy field as they arrive
+        self.obstacle_topic = self.get_param('obstacle_topic', '')
 
         # laser_subscriber listens for data from the lidar
-        self.laser_subscriber = rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received)
+        self.laser_subscriber = rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received, queue_size=1)
 
         # enable listening for and broadcasting coordinate transforms
-        self.tf_listener = TransformListener()
-        self.tf_broadcaster = TransformBroadcaster()
-
-        self.particle_cloud = []
-
-        self.current_odom_xy_theta = []     #current position of ourself in odom frame
-
-        # request the map from the map server, the map should be of type nav_msgs/OccupancyGrid
-        get_map_from_server = rospy.ServiceProxy('static_map', GetMap) # 'static map' is the service that map_server publishes to.
-        self.map = get_map_from_server()
-        print 'got map' #Do not print the map itself, it is huge
-
-        # Create our occupancy field to reference later using the map we got
-        self.occupancy_field = OccupancyField(self.map.map)
-        print 'created occupancy field'
+        self.tf_listener = tf_listener or TransformListener()
+        self.tf_broadcaster = tf_broadcaster or TransformBroadcaster()
+
+        if shared_map is None:
+            shared_map = SharedMap(self.map_file, self.map_frame, self.map_cache_dir, self.map_cache_max_bytes)
+        self.map = shared_map.map
+        self.map_cache = shared_map.map_cache
+        self.occupancy_field = shared_map.occupancy_field
+        self.field_lock = shared_map.field_lock
+
+        self.filter = ParticleFilterCore(self.occupancy_field, self.map_cache, self.timer, **self.filter_params)
+        # keep the distances the laser model tells apart exact when cells are updated
+        self.occupancy_field.update_radius = max(self.occupancy_field.update_radius, self.filter.laser_max_distance)
+        self.obstacle_subscriber = None
+        if self.obstacle_topic:
+            self.obstacle_subscriber = rospy.Subscriber(self.obstacle_topic, OccupancyGrid, self.obstacle_received, queue_size=1)
+        rospy.on_shutdown(self.filter.close)
+        if self.metrics_file:
+            rospy.on_shutdown(lambda: self.timer.dump(self.metrics_file))
+        if self.checkpoint_file:
+            self.restore_checkpoint()
+            self.checkpoint_writer = CheckpointWriter(self.checkpoint_file, self.checkpoint_period)
+            rospy.on_shutdown(self.checkpoint_writer.stop)
+        if self.async_scans and self.scan_pipeline is None:
+            self.scan_pipeline = ScanPipeline(self.process_scan, self.timer)
+            rospy.on_shutdown(self.scan_pipeline.stop)
 
         self.initialized = True
 
-    def update_robot_pose(self):
-        """ Update the estimate of the robot's pose given the updated particles.
-            There are two logical methods for this:
-                (1): compute the mean pose <--- currently doing this option
-                (2): compute the most likely pose (i.e. the mode of the distribution)
-                (3): Above a likelihood threshold, compute the mean of those
-                (4): Differentiate between clusters, compute mean in most likely cluster
-        """
-        # first make sure that the particle weights are normalized
-        self.normalize_particles()
-        choose = "mean"  #Which strategy to use 
-
-        if choose =="mode":
-            #Use the pose of the most likely particle
-            curr_weights = [i.w for i in self.particle_cloud]
-            idx = curr_weights.index(max(curr_weights))
-            mmPos_x = self.particle_cloud[idx].x
-            mmPos_y = self.particle_cloud[idx].y
-            average_angle = self.particle_cloud[idx].theta
-
-            # #Code to use the mean of the most likely particles: 
-            # for i in range(0, self.num_resamples):
-            #     most_common_particles.append(self.particle_cloud[idx])
-            #     curr_weights.pop(idx)
-        elif choose == "mean":
-            #Use the mean of all particles:
-            most_common_particles = []
-            for particle in self.particle_cloud:
-                if particle.w: #if the particle exists..... change me later to account for modes!
-                    most_common_particles.append(particle)
-            mmPos_x = np.mean([i.x for i in most_common_particles])        #mean of modes of x positions
-            mmPos_y = np.mean([i.y for i in most_common_particles])        #mean of modes of y positions
-
-            angle_x = 0
-            angle_y = 0
-            #Can not just average angles because (350, 10) would give 180. Thus, converting them to x,y
-            #and adding up x and y instead then converting back
-            for particle in most_common_particles:
-                angle_x += math.cos(particle.theta)    #particle.theta is in radians
-                angle_y += math.sin(particle.theta)    #particle.theta is in radians
-            angle_x/=len(most_common_particles)
-            angle_y/=len(most_common_particles)
-            average_angle = math.atan2(angle_y, angle_x)  
-
+    def prefixed(self, name):
+        """ The name of a topic or frame of this robot """
+        return self.prefix + "/" + name if self.prefix else name
+
+    def get_param(self, name, default):
+        """ Read the private parameter name, from this robot's namespace first when it has a prefix """
+        if self.prefix and rospy.has_param("~%s/%s" % (self.prefix, name)):
+            return rospy.get_param("~%s/%s" % (self.prefix, name))
+        return rospy.get_param("~" + name, default)
+
+    @property
+    def particle_cloud(self):
+        return self.filter.particle_cloud
+
+    @particle_cloud.setter
+    def particle_cloud(self, particle_cloud):
+        self.filter.particle_cloud = particle_cloud
+
+    @property
+    def current_odom_xy_theta(self):
+        return self.filter.current_odom_xy_theta
+
+    @current_odom_xy_theta.setter
+    def current_odom_xy_theta(self, xy_theta):
+        self.filter.current_odom_xy_theta = xy_theta
+
+    def update_robot_pose(self, msg=None):
+        """ Update the estimate of the robot's pose given the updated particles (see
+            ParticleFilterCore.update_robot_pose), convert it to a geometry_msgs/Pose and publish it.  If the
+            scan msg is given and scan matching is on, the estimate is refined against it first """
+        self.filter.update_robot_pose()
+        if msg is not None and self.filter.scan_matching:
+            with self.timer.stage("scan_match"):
+                self.filter.refine_pose(msg, convert_pose_to_xy_and_theta(self.laser_pose.pose))
+        mmPos_x, mmPos_y, average_angle = self.filter.pose
         orientation_tuple = tf.transformations.quaternion_from_euler(0,0,average_angle) #converts theta to quaternion
         self.robot_pose = Pose(position=Point(x=mmPos_x,y=mmPos_y,z=0),orientation=Quaternion(x=orientation_tuple[0], y=orientation_tuple[1], z=orientation_tuple[2], w=orientation_tuple[3]))
+        self.robot_pose_pub.publish(self.robot_pose)
 
-    def update_particles_with_odom(self, msg):
-        """ Update the particles using the newly given odometry pose.
-            The function computes the value delta which is a tuple (x,y,theta)
-            that indicates the change in position and angle between the odometry
-            when the particles were last updated and the current odometry.
-
-            msg: this is not really needed to implement this, but is here just in case. <-- ?
-        """
-        new_odom_xy_theta = convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        # compute the change in x,y,theta since our last update
-        if self.current_odom_xy_theta:
-            old_odom_xy_theta = self.current_odom_xy_theta
-            delta = (new_odom_xy_theta[0] - self.current_odom_xy_theta[0],
-                     new_odom_xy_theta[1] - self.current_odom_xy_theta[1],
-                     angle_diff(new_odom_xy_theta[2], self.current_odom_xy_theta[2]))
-
-            self.current_odom_xy_theta = new_odom_xy_theta
-        else:
-            self.current_odom_xy_theta = new_odom_xy_theta
-            return
-
-        #modify particles using delta
-        dx = delta[0]
-        dy = delta[1]
-        dtheta = delta[2]
-
-        #Figure out how much the robot moved relative to its original angle
-        angle_travel = math.atan2(dy,dx) #Angle of travel wrpt odom frame
-        r1 = angle_travel-self.current_odom_xy_theta[2]   #Rotation 1 to face toward the direction of movement
-        r2 = dtheta-r1  #Rotation 2 to final theta
-        d = math.sqrt(dy**2+dx**2) #Distance travelled
-
-        #Create a standard deviation proportional to each delta
-        # Increase or decrease the constants below based on confidence in odom, can have scales different for theta and x, y
-        sigma_d = d*0.3 #Good constant: 0.2
-        sigma_theta = dtheta*0.5 #good constant: 0.15
-
-        #update each particle using a normal distribution
-        for p in self.particle_cloud:
-            p.theta+=r1
-            noisy_d = gauss(d,sigma_d)
-            p.x+=noisy_d*math.cos(p.theta)
-            p.y+=noisy_d*math.sin(p.theta)
-            p.theta+=gauss(r2,sigma_theta)
+        # the covariance is 6x6 over (x, y, z, roll, pitch, yaw) in row major order, fill in the planar part
+        covariance = np.zeros((6, 6))
+        covariance[np.ix_([0, 1, 5], [0, 1, 5])] = self.filter.pose_covariance
+        self.pose_covariance_pub.publish(PoseWithCovarianceStamped(
+            header=Header(stamp=rospy.Time.now(), frame_id=self.map_frame),
+            pose=PoseWithCovariance(pose=self.robot_pose, covariance=covariance.ravel().tolist())))
 
-        # For added difficulty: Implement sample_motion_odometry (Prob Rob p 136) <-- ?
+    def update_particles_with_odom(self, msg):
+        """ Update the particles using the odometry pose of the robot at the time of the scan msg """
+        self.filter.update_particles_with_odom(convert_pose_to_xy_and_theta(self.odom_pose.pose))
 
     def map_calc_range(self,x,y,theta):
-        """ Difficulty Level 3: implement a ray tracing likelihood model... Let me know if you are interested """
-        # TO-DO: nothing, unless you want to try this alternate likelihood model
-        pass
+        """ Compute the range a beam starting at (x,y) with heading theta would measure in the map """
+        return self.filter.map_calc_range(x, y, theta)
 
     def resample_particles(self):
-        """ Resample the particles according to the new particle weights.
-            The weights stored with each particle should define the probability that a particular
-            particle is selected in the resampling step.  You may want to make use of the given helper
-            function draw_random_sample.
-        """
-        # make sure the distribution is normalized
-        self.normalize_particles()
-        # return
-        #initialize a new cloud to be adding selected particles to
-        new_cloud = []
-        num_top_picks = self.num_resamples/2 #ensure the X most likely particles get added to the new cloud.
-        curr_weights = [i.w for i in self.particle_cloud]
-
-        print curr_weights[0:num_top_picks]
-
-        #Make sure top weighted particles are in new cloud.
-        for i in range(0, num_top_picks):
-            idx = curr_weights.index(max(curr_weights))
-            new_cloud.append(self.particle_cloud[idx])
-            self.particle_cloud.pop(idx) #pop(id) removes the element at the index, remove(x) delete the element x
-            curr_weights.pop(idx)
-
-        #Add other particles at probability-biased "random"
-        self.normalize_particles()
-        curr_weights = [i.w for i in self.particle_cloud]
-        new_cloud.extend(ParticleFilter.draw_random_sample(self.particle_cloud, curr_weights, self.num_resamples-num_top_picks))
-
-        #set particle cloud to be current, but multiplied
-        self.particle_cloud = []
-        for i in range(self.select_particle_ratio):
-            self.particle_cloud.extend(deepcopy(new_cloud))
-
-        print "length of particle cloud", len(self.particle_cloud) 
-
-        #Add noise: modify particles using sigma
-        #Good sigma_scale: 0.2
-        sigma_scale = 0.2 # Increase or decrease this based on confidence in odom, can have scales different for theta and x, y
-        sigma_x = sigma_scale
-        sigma_y = sigma_scale
-        sigma_theta = sigma_scale*0.5 #Good multiplier: 0.5
-
-        #update each particle using a normal distribution around each delta
-        for p in self.particle_cloud:
-            p.x+=gauss(0,sigma_x)
-            p.y+=gauss(0,sigma_y)
-            p.theta+=gauss(0,sigma_theta)
-
+        """ Resample the particles according to the new particle weights """
+        self.filter.resample_particles()
 
     def update_particles_with_laser(self, msg):
         """ Updates the particle weights in response to the scan contained in the msg
             msg: Laser scan message in base_link frame (technically in base_laser_link, but we can just consider it to be in base_link"""
-        for p in self.particle_cloud: #For each particle:
-            prob_sum = 0
-            # for i,d in enumerate(msg.ranges[0:360:2]): # i is the angle index and d is the distance
-            for i,d in enumerate(msg.ranges):
-                #Map each laser scan measurement of the particle into a location in x, y, map frame
-                if d == 0:
-                    continue #Got an invalid measurement
-                x = p.x + d*math.cos(math.radians(i)+p.theta) #Adding the angle and position of the particle to account for transformation from base_particle to map
-                y = p.y + d*math.sin(math.radians(i)+p.theta)
-
-                #give each x,y position into occupancy field and get back a distance to the closest obstacle point
-                closest_dist = self.occupancy_field.get_closest_obstacle_distance(x,y)
-                if not closest_dist>0:
-                    continue #Ignore nans
-                #Find the probablity of seeing that laser scan at the particle's position
-                p_measurement = norm.pdf(closest_dist,loc = 0, scale = 0.005) #Using scipy's norm. loc is center, scale is sigma
-                #Good p_measurement standard deviation: 0.005
-                #Add this probablity to the total probablity of the particle
-                prob_sum += p_measurement**3
-            #Update the weight of the particles
-            p.w = prob_sum 
-
-    @staticmethod
-    def weighted_values(values, probabilities, size):
-        """ Return a random sample of size elements from the set values with the specified probabilities
-            values: the values to sample from (numpy.ndarray)
-            probabilities: the probability of selecting each element in values (numpy.ndarray)
-            size: the number of samples
-        """
-        bins = np.add.accumulate(probabilities)
-        return values[np.digitize(random_sample(size), bins)]
-
-    @staticmethod
-    def draw_random_sample(choices, probabilities, n):
-        """ Return a random sample of n elements from the set choices with the specified probabilities
-            choices: the values to sample from represented as a list
-            probabilities: the probability of selecting each element in choices represented as a list
-            n: the number of samples
-        """
-        values = np.array(range(len(choices)))
-        probs = np.array(probabilities)
-        bins = np.add.accumulate(probs)
-        inds = values[np.digitize(random_sample(n), bins)]
-        samples = []
-        for i in inds:
-            samples.append(deepcopy(choices[int(i)]))
-        return samples
+        self.filter.update_particles_with_laser(msg, convert_pose_to_xy_and_theta(self.laser_pose.pose))
 
     def update_initial_pose(self, msg):
         """ Callback function to handle re-initializing the particle filter based on a pose estimate.
             These pose estimates could be generated by another ROS Node or could come from the rviz GUI """
         xy_theta = convert_pose_to_xy_and_theta(msg.pose.pose)
-        self.initialize_particle_cloud(xy_theta)
-        self.fix_map_to_odom_transform(msg)
+        with self.filter_lock:
+            self.initialize_particle_cloud(xy_theta)
+            self.fix_map_to_odom_transform(msg)
+
+    def obstacle_received(self, msg):
+        """ Write the cells of a local obstacle grid (nav_msgs/OccupancyGrid) into the occupancy field: cells
+            above 50 become occupied, cells at 0 go back to the static map (so obstacles that left are cleared
+            but walls stay), and unknown or in between cells are left alone.  The
+            distance field is recomputed around the changed cells and swapped in under field_lock, which the
+            filters of every robot sharing the map hold while they read it (see OccupancyField.prepare_update) """
+        if not(self.initialized):
+            return
+        if msg.header.frame_id.lstrip('/') != self.map_frame:
+            rospy.logwarn_throttle(10.0, "ignoring obstacles in frame %s, expected %s" % (msg.header.frame_id, self.map_frame))
+            return
+        info = msg.info
+        data = np.asarray(msg.data, dtype=np.int8).reshape((info.height, info.width))
+        occupied = data > 50
+        known = occupied | (data == 0)
+        rows, columns = np.nonzero(known)
+        # sample every known cell often enough to reach all the map cells under it, then take the samples to
+        # the map frame (the local grid may be rotated)
+        k = max(1, int(math.ceil(info.resolution/self.occupancy_field.map.info.resolution)))
+        offsets = (np.arange(k) + 0.5)/k
+        rows = np.repeat(rows, k*k)
+        columns = np.repeat(columns, k*k)
+        u = (columns + np.tile(np.repeat(offsets, k), len(rows) // (k*k)))*info.resolution
+        v = (rows + np.tile(np.tile(offsets, k), len(rows) // (k*k)))*info.resolution
+        _, _, yaw = convert_pose_to_xy_and_theta(info.origin)
+        x = info.origin.position.x + math.cos(yaw)*u - math.sin(yaw)*v
+        y = info.origin.position.y + math.sin(yaw)*u + math.cos(yaw)*v
+
+        with self.timer.stage("obstacle_update"):
+            map_rows, map_columns, on_map = self.occupancy_field.map_cells(x, y)
+            values = np.maximum(self.occupancy_field.static_grid[map_rows, map_columns],
+                                np.where(occupied[rows, columns], 100, 0)[on_map])
+            with self.field_lock:
+                # prepared under the lock too, so another robot's update cannot land between reading the grid
+                # and writing the window computed from it
+                self.occupancy_field.apply_update(self.occupancy_field.prepare_update(map_rows, map_columns, values))
+
+    def request_global_localization(self, req):
+        """ Service handler asking for the particle cloud to be reinitialized over the whole map.  The search
+            needs a scan, so it runs on the next one """
+        self.global_localization_requested = True
+        return EmptyResponse()
 
     def initialize_particle_cloud(self, xy_theta=None):
         """ Initialize the particle cloud.
             Arguments
             xy_theta: a triple consisting of the mean x, y, and theta (yaw) to initialize the
-                      particle cloud around.  If this input is ommitted, the odometry will be used
-            Particles are created based on a normal distribution around the initial position using standard deviation of sigma for x and y
-            and sigma_theta for theta"""
+                      particle cloud around.  If this input is ommitted, the odometry will be used """
         if xy_theta == None:
             xy_theta = convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        self.particle_cloud = []
-
-        sigma = 1 
-        sigma_theta = 1 
-        for i in range(1,self.n_particles):
-            x = gauss(xy_theta[0],sigma)
-            y = gauss(xy_theta[1],sigma)
-            theta = gauss(xy_theta[2],sigma_theta)
-            self.particle_cloud.append(Particle(x,y,theta))
-
-        self.normalize_particles()
+        self.filter.initialize_particle_cloud(xy_theta)
         self.update_robot_pose()
+        self.particle_publisher.mark_changed()
 
     def normalize_particles(self):
         """ Make sure the particle weights define a valid distribution (i.e. sum to 1.0) """
-        weight_sum = 0
-        for p in self.particle_cloud:
-            weight_sum+=p.w
-        print "weight sum", weight_sum
-        for p in self.particle_cloud:
-            p.w = p.w * 1.0 / weight_sum
+        self.filter.normalize_particles()
 
     def publish_particles(self, msg):
-        particles_conv = []
-        for p in self.particle_cloud:
-            particles_conv.append(p.as_pose())
-        # actually send the message so that we can view it in rviz
-        self.particle_pub.publish(PoseArray(header=Header(stamp=rospy.Time.now(),
-                                            frame_id=self.map_frame),
-                                  poses=particles_conv))
+        """ Send the particle cloud so that we can view it in rviz, if it changed since it was last sent (see
+            ParticleCloudPublisher) """
+        with self.filter_lock:
+            if self.particle_cloud:
+                self.particle_publisher.publish(self.particle_cloud, msg.header.stamp)
 
     def scan_received(self, msg):
         """ This is the default logic for what to do when processing scan data.
             Feel free to modify this, however, I hope it will provide a good
-            guide.  The input msg is an object of type sensor_msgs/LaserScan """
+            guide.  The input msg is an object of type sensor_msgs/LaserScan
+            The transforms are looked up here, at the time the scan arrives, and the rest of the work is
+            handed to process_scan, on the scan pipeline thread unless async_scans is off """
         if not(self.initialized):
             # wait for initialization to complete
             return
@@ -395,63 +376,196 @@ class ParticleFilter:
             # this will eventually be published by either Gazebo or neato_node
             return
 
-        # calculate pose of laser relative to the robot base
-        p = PoseStamped(header=Header(stamp=rospy.Time(0),
-                                      frame_id=msg.header.frame_id))
-        self.laser_pose = self.tf_listener.transformPose(self.base_frame,p)
+        with self.timer.stage("tf_lookup"):
+            # calculate pose of laser relative to the robot base
+            p = PoseStamped(header=Header(stamp=rospy.Time(0),
+                                          frame_id=msg.header.frame_id))
+            laser_pose = self.tf_listener.transformPose(self.base_frame,p)
 
-        # find out where the robot thinks it is based on its odometry
-        p = PoseStamped(header=Header(stamp=msg.header.stamp,
-                                      frame_id=self.base_frame),
-                        pose=Pose())
-        self.odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
+            # find out where the robot thinks it is based on its odometry
+            p = PoseStamped(header=Header(stamp=msg.header.stamp,
+                                          frame_id=self.base_frame),
+                            pose=Pose())
+            odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
+
+        if self.scan_pipeline:
+            self.scan_pipeline.submit((msg, laser_pose, odom_pose))
+        else:
+            self.process_scan((msg, laser_pose, odom_pose))
+
+    def process_scan(self, scan):
+        """ Run the filter on scan, a (sensor_msgs/LaserScan, laser pose, odometry pose) tuple where the poses
+            were looked up when the scan arrived """
+        with self.filter_lock:
+            # the poses are also read by re-initializations from rviz (see initialize_particle_cloud)
+            msg, self.laser_pose, self.odom_pose = scan
+            with self.field_lock:
+                self.update_filter(msg)
+            self.checkpoint()
+        # publish particles (so things like rviz can see them)
+        with self.timer.stage("publish"):
+            self.publish_particles(msg)
+
+    def restore_checkpoint(self):
+        """ Read checkpoint_file, if it was taken in this map no longer than checkpoint_max_age ago.  The
+            checkpoint is kept in pending_checkpoint until the first scan, which applies it if the odometry
+            continues from it (see apply_checkpoint).  Returns whether a checkpoint is pending """
+        checkpoint = read_checkpoint(self.checkpoint_file, self.occupancy_field.map_hash)
+        if checkpoint is None or not len(checkpoint.particles):
+            return False
+        age = time.time() - checkpoint.stamp
+        if self.checkpoint_max_age > 0 and age > self.checkpoint_max_age:
+            rospy.loginfo("ignoring the checkpoint %s, it was taken %.0f s ago" % (self.checkpoint_file, age))
+            return False
+        self.pending_checkpoint = checkpoint
+        return True
+
+    def apply_checkpoint(self, odom_xy_theta):
+        """ Restore the particle cloud, the odometry pose of the last update and the map to odom transform from
+            pending_checkpoint if the odometry pose odom_xy_theta of the first scan continues from the one saved,
+            in the same odometry frame.  The first scan then updates the restored cloud rather than
+            initializing a new one.  Returns whether the checkpoint was restored """
+        checkpoint, self.pending_checkpoint = self.pending_checkpoint, None
+        saved = checkpoint.odom_xy_theta
+        jump = math.hypot(odom_xy_theta[0] - saved[0], odom_xy_theta[1] - saved[1])
+        turn = abs(angle_diff(odom_xy_theta[2], saved[2]))
+        if (checkpoint.odom_frame != self.odom_frame or jump > self.checkpoint_max_odom_jump or
+                turn > self.checkpoint_max_odom_turn):
+            rospy.logwarn("ignoring the checkpoint %s, the odometry does not continue from it (frame %s, moved %.2f m "
+                          "and %.2f rad)" % (self.checkpoint_file, checkpoint.odom_frame, jump, turn))
+            return False
+        self.particle_cloud = checkpoint.particles
+        self.current_odom_xy_theta = checkpoint.odom_xy_theta
+        self.update_robot_pose()
+        with self.transform_lock:
+            self.translation, self.rotation = checkpoint.translation, checkpoint.rotation
+        self.particle_publisher.mark_changed()
+        rospy.loginfo("restored %d particles from %s, taken %.1f s ago", len(checkpoint.particles),
+                      self.checkpoint_file, time.time() - checkpoint.stamp)
+        return True
+
+    def checkpoint(self):
+        """ Hand a copy of the filter state to the checkpoint writer if a checkpoint is due.  Called with
+            filter_lock held, so the state is consistent """
+        if (self.checkpoint_writer is None or not self.checkpoint_writer.due() or not self.particle_cloud or
+                len(self.current_odom_xy_theta) != 3):
+            return
+        with self.transform_lock:
+            if not(hasattr(self,'translation') and hasattr(self,'rotation')):
+                return
+            translation, rotation = self.translation, self.rotation
+        self.checkpoint_writer.submit(Checkpoint(self.occupancy_field.map_hash, time.time(), self.particle_cloud.copy(),
+                                                 self.odom_frame, self.current_odom_xy_theta, translation, rotation))
+
+    def update_filter(self, msg):
+        """ Initialize the particle cloud on the first scan (or over the whole map when global localization was
+            requested), then update it whenever the robot moved enough """
+        scan = self.begin_update(msg)
+        if scan is not None:
+            with self.timer.stage("laser"):
+                log_likelihoods = self.filter.laser_scorer.log_weights(self.particle_cloud, scan)
+            self.finish_update(msg, log_likelihoods)
+
+    def begin_update(self, msg):
+        """ The part of update_filter up to scoring the particles against the scan msg.  Returns the PreparedScan
+            to score them against, or None if msg does not call for a laser update.  The particles are scored
+            by the caller, so a node hosting several robots can score all of them at once """
         # store the the odometry pose in a more convenient format (x,y,theta)
         new_odom_xy_theta = convert_pose_to_xy_and_theta(self.odom_pose.pose)
-
-        if not(self.particle_cloud):
+        if self.pending_checkpoint is not None:
+            self.apply_checkpoint(new_odom_xy_theta)
+
+        if self.global_localization_requested:
+            # search the whole map for the poses that best explain the scan and seed the particle cloud there
+            self.global_localization_requested = False
+            with self.timer.stage("global_localization"):
+                self.filter.global_localize(msg, convert_pose_to_xy_and_theta(self.laser_pose.pose))
+            self.update_robot_pose()
+            self.particle_publisher.mark_changed()
+            self.current_odom_xy_theta = new_odom_xy_theta
+            self.fix_map_to_odom_transform(msg)
+        elif not(self.particle_cloud):
             # now that we have all of the necessary transforms we can update the particle cloud
             self.initialize_particle_cloud()
             # cache the last odometric pose so we can only update our particle filter if we move more than self.d_thresh or self.a_thresh
             self.current_odom_xy_theta = new_odom_xy_theta
             # update our map to odom transform now that the particles are initialized
             self.fix_map_to_odom_transform(msg)
-        elif (math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh or
-              math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh or
-              math.fabs(new_odom_xy_theta[2] - self.current_odom_xy_theta[2]) > self.a_thresh):
+        elif self.filter.moved_enough(new_odom_xy_theta):
             # we have moved far enough to do an update!
-            self.update_particles_with_odom(msg)    # update based on odometry
-            self.update_particles_with_laser(msg)   # update based on laser scan
-            self.update_robot_pose()                # update robot's pose
-            self.resample_particles()               # resample particles to focus on areas of high density
-            self.fix_map_to_odom_transform(msg)     # update map to odom transform now that we have new particles
-        # publish particles (so things like rviz can see them)
-        self.publish_particles(msg)
+            self.update_start = time.time()
+            with self.timer.stage("odom"):
+                self.update_particles_with_odom(msg)        # update based on odometry
+            with self.timer.stage("scan_prepare"):
+                return self.filter.prepare_scan(msg, convert_pose_to_xy_and_theta(self.laser_pose.pose))
+        else:
+            # remember the path between updates, so the next odometry update can follow it
+            self.filter.add_odometry(new_odom_xy_theta)
+        return None
+
+    def finish_update(self, msg, log_likelihoods):
+        """ The rest of update_filter once the particles are scored against the scan begin_update returned,
+            log_likelihoods holding the log-likelihood of each particle """
+        self.filter.weight_particles(log_likelihoods)   # update based on laser scan
+        with self.timer.stage("pose"):
+            self.update_robot_pose(msg)                 # update robot's pose, refined against the scan if scan matching is on
+        with self.timer.stage("resample"):
+            self.resample_particles()                   # resample particles to focus on areas of high density
+        with self.timer.stage("fix_transform"):
+            self.fix_map_to_odom_transform(msg)         # update map to odom transform now that we have new particles
+        if self.timer.enabled:
+            self.timer.record("update", time.time() - self.update_start)
+        self.particle_publisher.mark_changed()
 
     def fix_map_to_odom_transform(self, msg):
         """ This method constantly updates the offset of the map and
             odometry coordinate systems based on the latest results from
-            the localizer
-            TODO: if you want to learn a lot about tf, reimplement this... I can provide
-                  you with some hints as to what is going on here. """
-        (translation, rotation) = convert_pose_inverse_transform(self.robot_pose)
-        p = PoseStamped(pose=convert_translation_rotation_to_pose(translation,rotation),
-                        header=Header(stamp=msg.header.stamp,frame_id=self.base_frame))
-        self.tf_listener.waitForTransform(self.base_frame, self.odom_frame, msg.header.stamp, rospy.Duration(1.0))
-        self.odom_to_map = self.tf_listener.transformPose(self.odom_frame, p)
-        (self.translation, self.rotation) = convert_pose_inverse_transform(self.odom_to_map.pose)
+            the localizer.  The map to odom transform is the one placing the odometry pose of the robot
+            (looked up when the scan arrived) on the estimated pose: map->odom = map->base * (odom->base)^-1.
+            It is computed in the plane (see se2), without waiting on tf """
+        odom_pose = getattr(self, 'odom_pose', None)
+        if odom_pose is None:
+            # no scan has arrived yet, the first one sets the transform
+            return
+        map_to_odom = se2.compose(self.filter.pose, se2.invert(convert_pose_to_xy_and_theta(odom_pose.pose)))
+        translation, rotation = se2.to_translation_rotation(map_to_odom)
+        with self.transform_lock:
+            (self.translation, self.rotation) = (translation, rotation)
 
     def broadcast_last_transform(self):
         """ Make sure that we are always broadcasting the last map
             to odom transformation.  This is necessary so things like
-            move_base can work properly. """
-        if not(hasattr(self,'translation') and hasattr(self,'rotation')):
-            return
-        self.tf_broadcaster.sendTransform(self.translation,
-                                          self.rotation,
+            move_base can work properly.  This runs in the main loop, independently of the filter updates """
+        with self.transform_lock:
+            if not(hasattr(self,'translation') and hasattr(self,'rotation')):
+                return
+            translation, rotation = self.translation, self.rotation
+        self.tf_broadcaster.sendTransform(translation,
+                                          rotation,
                                           rospy.get_rostime(),
                                           self.odom_frame,
                                           self.map_frame)
 
+    def publish_metrics(self):
+        """ Publish the stage latencies on the diagnostics topic (and dump them to metrics_file if set) once
+            every metrics_period seconds """
+        now = time.time()
+        if not self.timer.enabled or now - self.last_metrics_time < self.metrics_period:
+            return
+        self.last_metrics_time = now
+        values = [KeyValue(key=name + "/" + key, value=str(stats[key]))
+                  for name, stats in self.timer.summary() for key in sorted(stats)]
+        if self.scan_pipeline:
+            values.append(KeyValue(key="dropped_scans", value=str(self.scan_pipeline.dropped)))
+        status = DiagnosticStatus(level=DiagnosticStatus.OK,
+                                  name=rospy.get_name() + ": " + (self.prefix + " " if self.prefix else "") + "stage latency",
+                                  message="latency of the filter loop stages in ms",
+                                  hardware_id=self.base_frame,
+                                  values=values)
+        self.metrics_pub.publish(DiagnosticArray(header=Header(stamp=rospy.Time.now()), status=[status]))
+        if self.metrics_file:
+            self.timer.dump(self.metrics_file)
+
 if __name__ == '__main__':
     n = ParticleFilter()
     r = rospy.Rate(5)
@@ -459,4 +573,5 @@ if __name__ == '__main__':
     while not(rospy.is_shutdown()):
         # in the main loop all we do is continuously broadcast the latest map to odom transform
         n.broadcast_last_transform()
+        n.publish_metrics()
         r.sleep()
@@ -0,0 +1,138 @@
+""" Groups the particle cloud into clusters of nearby poses, so the pose estimate can come from the
+    most likely cluster rather than from the mean of the whole cloud (which lands between the modes of a
+    multimodal cloud, often inside a wall).  Particles are hashed into (x, y, theta) cells and touching
+    occupied cells are joined into clusters as the connected components of a sparse graph, which takes
+    near-linear time in the number of particles """
+
+import math
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# cell indices are offset by this much so they are non-negative and hash to the same key in every update
+_INDEX_OFFSET = 2**20
+_ROW = 2**21
+
+# the offsets to half of the 26 neighbors of a cell, the other half is covered by symmetry
+_NEIGHBOR_OFFSETS = [(dx, dy, dt) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dt in (-1, 0, 1)
+                     if (dx, dy, dt) > (0, 0, 0)]
+
+
+class PoseCluster(object):
+    """ A cluster of particles
+        Attributes:
+            weight: the total weight of the particles in the cluster
+            pose: the weighted mean (x, y, theta) of the cluster
+            covariance: the 3x3 weighted covariance of (x, y, theta)
+            cells: the hash keys of the cells the cluster occupies
+            size: the number of particles in the cluster
+    """
+
+    def __init__(self, weight, pose, covariance, cells, size):
+        self.weight = weight
+        self.pose = pose
+        self.covariance = covariance
+        self.cells = cells
+        self.size = size
+
+
+def weighted_pose_statistics(x, y, theta, w):
+    """ The weighted mean (x, y, theta) and 3x3 covariance of poses, averaging theta on the circle """
+    total = w.sum()
+    if not total > 0:
+        w = np.ones(len(w))
+        total = float(len(w))
+    mean_x = np.dot(w, x)/total
+    mean_y = np.dot(w, y)/total
+    mean_theta = math.atan2(np.dot(w, np.sin(theta)), np.dot(w, np.cos(theta)))
+    deviations = np.vstack((x - mean_x, y - mean_y, np.angle(np.exp(1j*(theta - mean_theta)))))
+    covariance = np.dot(deviations*w, deviations.T)/total
+    return (float(mean_x), float(mean_y), float(mean_theta)), covariance
+
+
+class PoseClusterer(object):
+    """ Clusters particle clouds with a spatial hash.  Between updates it keeps following the cluster it
+        chose last time unless another one becomes clearly more likely
+        Attributes:
+            cell_size: the x and y size of a hash cell in meters
+            cell_angle: the theta size of a hash cell in radians
+            hysteresis: how many times heavier than the current cluster another one has to be to take over
+            selected_cells: the cells of the cluster selected by the last call to estimate
+    """
+
+    def __init__(self, cell_size=0.25, cell_angle=math.radians(30), hysteresis=1.5):
+        self.cell_size = cell_size
+        self.cell_angle = cell_angle
+        self.hysteresis = hysteresis
+        self.n_angles = int(math.ceil(2*math.pi/cell_angle))
+        self.selected_cells = None
+
+    def cell_keys(self, particles):
+        """ The hash key of the (x, y, theta) cell of every particle in the ParticleSet particles """
+        cx = np.floor(particles.x/self.cell_size).astype(np.int64) + _INDEX_OFFSET
+        cy = np.floor(particles.y/self.cell_size).astype(np.int64) + _INDEX_OFFSET
+        ct = np.floor(np.mod(particles.theta, 2*math.pi)/self.cell_angle).astype(np.int64) % self.n_angles
+        return (cx*_ROW + cy)*self.n_angles + ct
+
+    def cluster(self, particles):
+        """ Label the particles in the ParticleSet particles by cluster.  Returns (labels, keys, cell_labels)
+            where labels holds the cluster of each particle, keys the sorted hash keys of the occupied cells
+            and cell_labels the cluster of each of those cells """
+        keys, inverse = np.unique(self.cell_keys(particles), return_inverse=True)
+        cell_labels = self._connect(keys)
+        return cell_labels[inverse], keys, cell_labels
+
+    def _connect(self, keys):
+        """ Label the occupied cells keys by connected component of the 26-neighborhood """
+        kt = keys % self.n_angles
+        kxy = keys // self.n_angles
+        kx = kxy // _ROW
+        ky = kxy % _ROW
+        sources = []
+        targets = []
+        for dx, dy, dt in _NEIGHBOR_OFFSETS:
+            neighbors = ((kx + dx)*_ROW + ky + dy)*self.n_angles + (kt + dt) % self.n_angles
+            position = np.minimum(np.searchsorted(keys, neighbors), len(keys) - 1)
+            found = keys[position] == neighbors
+            sources.append(np.flatnonzero(found))
+            targets.append(position[found])
+        sources = np.concatenate(sources)
+        targets = np.concatenate(targets)
+        graph = coo_matrix((np.ones(len(sources)), (sources, targets)), shape=(len(keys), len(keys)))
+        return connected_components(graph, directed=False)[1]
+
+    def clusters(self, particles):
+        """ Split the ParticleSet particles into PoseClusters, heaviest first """
+        if not len(particles):
+            return []
+        labels, keys, cell_labels = self.cluster(particles)
+        weights = np.bincount(labels, weights=particles.w)
+        return [self._make_cluster(particles, label, labels, keys, cell_labels, weights[label])
+                for label in np.argsort(-weights, kind='mergesort')]
+
+    def estimate(self, particles):
+        """ Return the PoseCluster the pose estimate should come from: the heaviest cluster, unless a cluster
+            overlapping the one selected last time is within hysteresis of it.  Only the statistics of the
+            returned cluster are computed """
+        if not len(particles):
+            return None
+        labels, keys, cell_labels = self.cluster(particles)
+        weights = np.bincount(labels, weights=particles.w)
+        best = int(np.argmax(weights))
+        if self.selected_cells is not None:
+            previous = np.unique(cell_labels[np.isin(keys, self.selected_cells, assume_unique=True)])
+            if len(previous):
+                follow = previous[np.argmax(weights[previous])]
+                if weights[follow]*self.hysteresis >= weights[best]:
+                    best = int(follow)
+        cluster = self._make_cluster(particles, best, labels, keys, cell_labels, weights[best])
+        self.selected_cells = cluster.cells
+        return cluster
+
+    @staticmethod
+    def _make_cluster(particles, label, labels, keys, cell_labels, weight):
+        members = labels == label
+        pose, covariance = weighted_pose_statistics(particles.x[members], particles.y[members],
+                                                    particles.theta[members], particles.w[members])
+        return PoseCluster(float(weight), pose, covariance, keys[cell_labels == label], int(members.sum()))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+""" Runs the particle filter offline, without a ROS master.  The map is loaded straight from a map_server
+    YAML/PGM pair and the filter is fed a recorded or synthetic sequence of odometry poses and scans.
+    To run, type the following in terminal
+        rosrun my_localizer replay.py --map path to the yaml file [--sequence recording.npz]
+"""
+
+import argparse
+import math
+
+import numpy as np
+
+from sensor_msgs.msg import LaserScan
+
+from map_loader import load_map
+from map_cache import MapCache
+from occupancy_field import OccupancyField
+from filter_core import ParticleFilterCore
+from stage_timing import StageTimer
+from beam_model import cast_rays
+from helper_functions import angle_diff
+
+STAGES = ("odom", "laser", "pose", "resample")
+
+
+class Sequence(object):
+    """ A recorded or synthetic run of the robot
+        Attributes:
+            odom: the odometry pose (x, y, theta) at each step as a (steps, 3) array
+            ranges: the laser ranges at each step as a (steps, beams) array
+            angle_min, angle_increment, range_min, range_max: the geometry of the laser scans
+            truth: the true pose (x, y, theta) in the map frame at each step as a (steps, 3) array, or None
+    """
+
+    def __init__(self, odom, ranges, angle_min, angle_increment, range_min, range_max, truth=None):
+        self.odom = np.asarray(odom, dtype=np.float64)
+        self.ranges = np.asarray(ranges, dtype=np.float32)
+        self.angle_min = float(angle_min)
+        self.angle_increment = float(angle_increment)
+        self.range_min = float(range_min)
+        self.range_max = float(range_max)
+        self.truth = None if truth is None else np.asarray(truth, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.odom)
+
+    def scan(self, i):
+        """ The scan of step i as a sensor_msgs/LaserScan """
+        return LaserScan(angle_min=self.angle_min,
+                         angle_max=self.angle_min + self.angle_increment*(self.ranges.shape[1] - 1),
+                         angle_increment=self.angle_increment,
+                         range_min=self.range_min,
+                         range_max=self.range_max,
+                         ranges=self.ranges[i])
+
+    @classmethod
+    def load(cls, path):
+        """ Load a sequence saved with save() """
+        data = np.load(path)
+        truth = data['truth'] if 'truth' in data.files else None
+        return cls(data['odom'], data['ranges'], data['angle_min'], data['angle_increment'],
+                   data['range_min'], data['range_max'], truth)
+
+    def save(self, path):
+        """ Save the sequence as a compressed numpy archive """
+        arrays = dict(odom=self.odom, ranges=self.ranges, angle_min=self.angle_min,
+                      angle_increment=self.angle_increment, range_min=self.range_min, range_max=self.range_max)
+        if self.truth is not None:
+            arrays['truth'] = self.truth
+        np.savez_compressed(path, **arrays)
+
+
+def synthesize_sequence(occupancy_field, steps, rng, n_beams=360, range_max=5.0, step_length=0.05,
+                        range_noise=0.01, odom_noise=0.05, clearance=0.3):
+    """ Drive a simulated robot through the free space of occupancy_field and record what it sees.  The
+        robot moves step_length per step, turning away whenever it gets within clearance of an obstacle.
+        Odometry drifts by odom_noise (relative) per step and ranges get Gaussian noise of range_noise """
+    info = occupancy_field.map.info
+    free_rows, free_columns = np.nonzero((occupancy_field.grid == 0) & (occupancy_field.closest_occ > clearance))
+    if not len(free_rows):
+        raise ValueError("the map has no free space with %.2f m of clearance" % clearance)
+    start = rng.randint(len(free_rows))
+    pose = np.array([info.origin.position.x + (free_columns[start] + 0.5)*info.resolution,
+                     info.origin.position.y + (free_rows[start] + 0.5)*info.resolution,
+                     rng.uniform(-math.pi, math.pi)])
+    odom = np.zeros(3)
+    angles = np.arange(n_beams)*2*math.pi/n_beams
+
+    truth_log, odom_log, ranges_log = [], [], []
+    for i in range(steps):
+        truth_log.append(pose.copy())
+        odom_log.append(odom.copy())
+        ranges = cast_rays(occupancy_field, pose[0], pose[1], pose[2] + angles, range_max)
+        no_return = ranges >= range_max
+        ranges = ranges + rng.normal(0, range_noise, n_beams)
+        ranges[no_return] = 0
+        ranges_log.append(ranges)
+
+        # pick the next motion, turning on the spot when the way ahead is blocked
+        turn = rng.normal(0, 0.1)
+        forward = step_length
+        ahead = pose[:2] + forward*np.array([math.cos(pose[2] + turn), math.sin(pose[2] + turn)])
+        if not occupancy_field.get_closest_obstacle_distance(ahead[0], ahead[1]) > clearance:
+            turn = rng.uniform(math.pi/4, math.pi)*rng.choice([-1, 1])
+            forward = 0.0
+        pose[2] += turn
+        pose[:2] += forward*np.array([math.cos(pose[2]), math.sin(pose[2])])
+
+        # the odometry sees the motion in the robot frame with some error and integrates it in its own frame
+        noisy_forward = forward*(1 + rng.normal(0, odom_noise))
+        noisy_turn = turn + abs(turn)*rng.normal(0, odom_noise)
+        odom[2] += noisy_turn
+        odom[:2] += noisy_forward*np.array([math.cos(odom[2]), math.sin(odom[2])])
+
+    return Sequence(odom_log, ranges_log, 0.0, 2*math.pi/n_beams, 0.0, range_max, truth_log)
+
+
+class ReplayResult(object):
+    """ The outcome of replaying a sequence
+        Attributes:
+            updates: the number of filter updates performed
+            wall_time: the total time spent in filter updates in seconds
+            stage_times: a dict from stage name to the list of times (in seconds) spent in it per update
+            errors: the position error (in meters) after each update, if the sequence has ground truth
+            heading_errors: the absolute heading error (in radians) after each update
+            particle_counts: the size of the cloud after each update
+    """
+
+    def __init__(self):
+        self.updates = 0
+        self.wall_time = 0.0
+        self.stage_times = dict((stage, []) for stage in STAGES)
+        self.errors = []
+        self.heading_errors = []
+        self.particle_counts = []
+
+    def updates_per_second(self):
+        return self.updates/self.wall_time if self.wall_time else float('nan')
+
+    def summary(self):
+        """ A one line description of the result """
+        latency = ", ".join("%s %.2f ms" % (stage, 1000*np.mean(self.stage_times[stage]) if self.stage_times[stage] else 0)
+                            for stage in STAGES)
+        line = "%d updates, %.1f updates/s (%s)" % (self.updates, self.updates_per_second(), latency)
+        if self.errors:
+            line += ", error mean %.3f m final %.3f m heading %.1f deg" % (np.mean(self.errors), self.errors[-1],
+                                                                         math.degrees(self.heading_errors[-1]))
+        return line
+
+
+def replay(core, sequence, initial_pose=None, laser_xy_theta=(0.0, 0.0, 0.0)):
+    """ Feed sequence to the ParticleFilterCore core, timing each stage of every update.  The cloud is
+        initialized around initial_pose, or the first true pose of the sequence if it is omitted.  The scan
+        match, if enabled, is timed as part of the pose stage """
+    if initial_pose is None:
+        if sequence.truth is None:
+            raise ValueError("the sequence has no ground truth, an initial pose is needed")
+        initial_pose = sequence.truth[0]
+    core.initialize_particle_cloud(tuple(initial_pose))
+    core.current_odom_xy_theta = tuple(sequence.odom[0])
+
+    result = ReplayResult()
+    # the stages are timed by ParticleFilterCore.update, into a timer keeping every update of the sequence
+    timer, core.timer = core.timer, StageTimer(window=len(sequence))
+    try:
+        for i in range(1, len(sequence)):
+            if not core.update(tuple(sequence.odom[i]), sequence.scan(i), laser_xy_theta):
+                continue
+            result.updates += 1
+            result.particle_counts.append(len(core.particle_cloud))
+            if sequence.truth is not None:
+                x, y, theta = core.pose
+                result.errors.append(math.hypot(x - sequence.truth[i][0], y - sequence.truth[i][1]))
+                result.heading_errors.append(abs(angle_diff(theta, sequence.truth[i][2])))
+        stage_times = dict((stage, histogram.values()) for stage, histogram in core.timer.histograms.items())
+    finally:
+        core.timer = timer
+    if "scan_match" in stage_times:
+        stage_times["pose"] = stage_times["pose"] + stage_times["scan_match"]
+    for stage in STAGES:
+        result.stage_times[stage] = list(stage_times.get(stage, []))
+    result.wall_time = sum(sum(times) for times in result.stage_times.values())
+    return result
+
+
+def load_field(map_path, use_cache=True):
+    """ Load the map at map_path and build its OccupancyField """
+    return OccupancyField(load_map(map_path), cache=MapCache() if use_cache else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--map', required=True, help="the map_server YAML file of the map")
+    parser.add_argument('--sequence', help="a recording saved by --save, a synthetic run is generated if omitted")
+    parser.add_argument('--save', help="save the replayed sequence to this .npz file")
+    parser.add_argument('--steps', type=int, default=200, help="the length of a synthetic run")
+    parser.add_argument('--particles', type=int, default=300, help="the number of particles (disables KLD-sampling)")
+    parser.add_argument('--seed', type=int, default=0, help="the random seed of the run and the filter")
+    parser.add_argument('--scan-matching', action='store_true', help="refine the pose estimate with a scan match")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the occupancy field cache")
+    args = parser.parse_args()
+
+    field = load_field(args.map, not args.no_cache)
+    if args.sequence:
+        sequence = Sequence.load(args.sequence)
+    else:
+        sequence = synthesize_sequence(field, args.steps, np.random.RandomState(args.seed))
+    if args.save:
+        sequence.save(args.save)
+
+    core = ParticleFilterCore(field, n_particles=args.particles, adaptive_particles=False, random_seed=args.seed,
+                              scan_matching=args.scan_matching)
+    try:
+        print replay(core, sequence).summary()
+    finally:
+        core.close()
+
+
+if __name__ == '__main__':
+    main()
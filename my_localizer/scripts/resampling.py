@@ -0,0 +1,79 @@
+""" Resampling schemes for the particle filter.  Every scheme takes the particle weights and returns
+    the indices of the particles to keep, so that resampling is a single gather over the particle
+    arrays (see ParticleSet.take) rather than a copy of particle objects """
+
+import numpy as np
+
+
+def effective_sample_size(weights):
+    """ Return the effective sample size 1/sum(w**2) of the (not necessarily normalized) weights """
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+    if not total > 0:
+        return 0.0
+    weights = weights/total
+    return 1.0/np.dot(weights, weights)
+
+
+def _cumulative(weights):
+    """ The normalized cumulative weights, with the last entry pinned to exactly 1.0 """
+    cumulative = np.cumsum(weights, dtype=np.float64)
+    cumulative /= cumulative[-1]
+    cumulative[-1] = 1.0
+    return cumulative
+
+
+def multinomial_resample(weights, n, rng=np.random):
+    """ Draw n independent samples with probability proportional to weights """
+    cumulative = _cumulative(weights)
+    return np.searchsorted(cumulative, rng.random_sample(n), side='right')
+
+
+def stratified_resample(weights, n, rng=np.random):
+    """ Draw one sample from each of n equal strata of the cumulative weights """
+    cumulative = _cumulative(weights)
+    positions = (np.arange(n) + rng.random_sample(n))/n
+    return np.searchsorted(cumulative, positions, side='right')
+
+
+def systematic_resample(weights, n, rng=np.random):
+    """ Draw n evenly spaced samples of the cumulative weights with a single random offset (low variance
+        resampling).  Each particle is kept as many times as the number of sample points falling on its share
+        of the weight, so the indices are built by counting rather than searching """
+    cumulative = _cumulative(weights)
+    offset = rng.random_sample()
+    # the number of sample points (k + offset)/n at or below each cumulative weight
+    below = np.floor(cumulative*n - offset).astype(np.intp) + 1
+    below = np.clip(below, 0, n)
+    counts = np.diff(np.concatenate(([0], below)))
+    return np.repeat(np.arange(len(cumulative)), counts)
+
+
+def residual_resample(weights, n, rng=np.random):
+    """ Keep floor(n*w) copies of every particle deterministically and draw the remainder from the
+        residual weights with multinomial resampling """
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights/weights.sum()
+    counts = np.floor(n*weights).astype(np.intp)
+    indices = np.repeat(np.arange(len(weights)), counts)
+    remainder = n - len(indices)
+    if remainder > 0:
+        residual = n*weights - counts
+        indices = np.concatenate((indices, multinomial_resample(residual, remainder, rng)))
+    return indices
+
+
+RESAMPLERS = {
+    "multinomial": multinomial_resample,
+    "stratified": stratified_resample,
+    "systematic": systematic_resample,
+    "residual": residual_resample,
+}
+
+
+def get_resampler(name):
+    """ Look up a resampling scheme by name """
+    try:
+        return RESAMPLERS[name]
+    except KeyError:
+        raise ValueError("unknown resampler %r, expected one of %s" % (name, ", ".join(sorted(RESAMPLERS))))
@@ -0,0 +1,76 @@
+""" Correlative scan matching (Olson, "Real-Time Correlative Scan Matching", 2009) to refine the pose
+    estimate of the filter.  The poses in a small x, y, theta window around the estimate are scored
+    against the pyramid of the occupancy field, coarse-to-fine as in the global localization, so the
+    estimate is no longer limited to the spacing of the particles """
+
+import math
+
+import numpy as np
+
+from global_localization import GlobalLocalizer
+from pose_clustering import weighted_pose_statistics
+
+
+class CorrelativeScanMatcher(GlobalLocalizer):
+    """ Finds the pose near a guess that best explains a scan
+        Attributes:
+            window_xy: how far the search reaches in x and y either side of the guess, in meters
+            window_theta: how far the search reaches in theta either side of the guess, in radians
+            angular_step: the heading spacing of the finest level, in radians
+            n_hypotheses: the number of candidates kept at each level
+            The scoring attributes are those of GlobalLocalizer
+    """
+
+    def __init__(self, occupancy_field, window_xy=0.1, window_theta=math.radians(5), angular_step=math.radians(0.5),
+                 n_levels=3, n_hypotheses=16, sigma=0.02, z_hit=0.95, z_rand=0.05, max_range=5.0, max_batch=2**20):
+        super(CorrelativeScanMatcher, self).__init__(occupancy_field, n_levels, 1, n_hypotheses, sigma,
+                                                     z_hit, z_rand, max_range, max_batch)
+        self.window_xy = window_xy
+        self.window_theta = window_theta
+        self.angular_step = angular_step
+
+    def match(self, scan, pose):
+        """ Search the window around pose (an (x, y, theta) tuple) for the pose best explaining scan (a
+            PreparedScan).  Returns the refined (x, y, theta) tuple, the 3x3 covariance of the candidates
+            weighted by their likelihood, and whether the refined pose explains the scan better than pose.  The
+            refined pose is the weighted mean of the candidates if it scores better than pose, otherwise the
+            best candidate """
+        self.pyramid.refresh()
+        top = len(self.pyramid.levels) - 1
+        cell_size = self.pyramid.levels[top].cell_size
+        heading_step = self.angular_step*2**top
+        # a lattice of the coarsest cells and headings covering the window, centered on the guess
+        n_xy = int(math.ceil(self.window_xy/cell_size))
+        n_theta = int(math.ceil(self.window_theta/heading_step))
+        dx, dy, dtheta = np.meshgrid(np.arange(-n_xy, n_xy + 1)*cell_size, np.arange(-n_xy, n_xy + 1)*cell_size,
+                                     np.arange(-n_theta, n_theta + 1)*heading_step, indexing='ij')
+        x = pose[0] + dx.ravel()
+        y = pose[1] + dy.ravel()
+        theta = pose[2] + dtheta.ravel()
+        scores = self.score(top, x, y, theta, scan, heading_step)
+
+        for level in range(top - 1, -1, -1):
+            best = self._best(scores)
+            x, y, theta = x[best], y[best], theta[best]
+            # split every candidate into the 2 x 2 cells and 2 headings below it
+            offset = 0.25*self.pyramid.levels[level + 1].cell_size
+            heading_step *= 0.5
+            dx = np.repeat([-offset, offset, -offset, offset], 2)
+            dy = np.repeat([-offset, -offset, offset, offset], 2)
+            dtheta = np.tile([-0.5*heading_step, 0.5*heading_step], 4)
+            x = np.repeat(x, 8) + np.tile(dx, len(x))
+            y = np.repeat(y, 8) + np.tile(dy, len(y))
+            theta = np.repeat(theta, 8) + np.tile(dtheta, len(theta))
+            scores = self.score(level, x, y, theta, scan, heading_step)
+
+        guess_score = self.score(0, np.array([pose[0]]), np.array([pose[1]]), np.array([pose[2]]), scan, heading_step)[0]
+        if not len(scores) or not scores.max() > guess_score:
+            return tuple(pose), np.zeros((3, 3)), False
+        # the likelihood weighted mean of the candidates resolves the pose finer than the lattice, unless it
+        # lands between separate modes, so it is only returned if it also explains the scan better
+        mean, covariance = weighted_pose_statistics(x, y, theta, np.exp(scores - scores.max()))
+        mean_score = self.score(0, np.array([mean[0]]), np.array([mean[1]]), np.array([mean[2]]), scan, heading_step)[0]
+        if mean_score > guess_score:
+            return mean, covariance, True
+        best = int(np.argmax(scores))
+        return (float(x[best]), float(y[best]), float(theta[best])), covariance, True
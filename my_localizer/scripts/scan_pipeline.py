@@ -0,0 +1,188 @@
+""" Moves the filter update off the subscriber callback.  Scans are handed to a dedicated processing thread
+    through a slot holding only the latest scan: a scan arriving while the previous one is still waiting is
+    dropped instead of queued, so when updates are slower than the laser the filter works on the freshest
+    data and the published pose never falls behind by more than one update """
+
+import logging
+import threading
+import time
+
+# a child of rospy's logger, so inside a node the messages reach rosout
+logger = logging.getLogger("rosout." + __name__)
+
+
+class LatestOnlySlot(object):
+    """ A mailbox holding at most one item, where a new item replaces the one not yet taken
+        Attributes:
+            dropped: the number of items replaced before anyone took them
+            closed: whether close() was called, after which get() returns None
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.full = False
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        """ Store item, dropping the item still in the slot if there is one """
+        with self.condition:
+            if self.full:
+                self.dropped += 1
+            self.item = item
+            self.full = True
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """ Take the item in the slot, waiting up to timeout seconds (forever if None) for one to arrive.
+            Returns None if the wait timed out or the slot was closed """
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.full and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            if self.closed:
+                return None
+            item = self.item
+            self.item = None
+            self.full = False
+            return item
+
+    def close(self):
+        """ Wake up and turn away any thread waiting in get() """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class ScanPipeline(object):
+    """ Calls process(item) on a worker thread for the latest item submitted
+        Attributes:
+            process: the function run on every item taken from the slot
+            slot: the LatestOnlySlot between submit() and the worker thread
+            timer: an optional StageTimer recording how long items wait in the slot as stage "queue_wait"
+            thread: the worker thread
+    """
+
+    def __init__(self, process, timer=None, name="scan_pipeline"):
+        self.process = process
+        self.slot = LatestOnlySlot()
+        self.timer = timer
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        """ Hand item to the worker thread, replacing any item it has not started on yet """
+        self.slot.put((time.time(), item))
+
+    @property
+    def dropped(self):
+        """ The number of items dropped because a newer one arrived first """
+        return self.slot.dropped
+
+    def _run(self):
+        while True:
+            entry = self.slot.get()
+            if entry is None:
+                return
+            submitted, item = entry
+            if self.timer is not None and self.timer.enabled:
+                self.timer.record("queue_wait", time.time() - submitted)
+            try:
+                self.process(item)
+            except Exception:
+                # one bad scan must not stop the filter
+                logger.exception("processing a scan failed")
+
+    def stop(self, timeout=None):
+        """ Stop the worker thread once it has finished the item it is working on """
+        self.slot.close()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+
+class BatchPipeline(object):
+    """ Calls process_batch(items) on a worker thread for the latest item submitted by each of several
+        producers (the robots of multi_pf.py), taking whatever items are waiting at once.  Each producer
+        submits through its own submitter, which keeps the interface of a ScanPipeline
+        Attributes:
+            process_batch: the function run on every batch, a list of (producer index, item) pairs
+            timer: an optional StageTimer recording how long items wait as stage "queue_wait"
+            items: the item waiting from each producer, None for none
+            dropped: the number of items of each producer dropped because a newer one arrived first
+            thread: the worker thread
+    """
+
+    def __init__(self, process_batch, n_producers, timer=None, name="batch_pipeline"):
+        self.process_batch = process_batch
+        self.timer = timer
+        self.condition = threading.Condition()
+        self.items = [None]*n_producers
+        self.dropped = [0]*n_producers
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, index, item):
+        """ Hand item from producer index to the worker thread, replacing the one it sent before if the worker
+            has not started on it yet """
+        with self.condition:
+            if self.items[index] is not None:
+                self.dropped[index] += 1
+            self.items[index] = (time.time(), item)
+            self.condition.notify()
+
+    def submitter(self, index):
+        """ An object with the submit method and dropped count of a ScanPipeline feeding producer index """
+        return _BatchSubmitter(self, index)
+
+    def _take(self):
+        with self.condition:
+            while not self.closed and all(entry is None for entry in self.items):
+                self.condition.wait()
+            if self.closed:
+                return None
+            batch = [(index, entry) for index, entry in enumerate(self.items) if entry is not None]
+            self.items = [None]*len(self.items)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            if self.timer is not None and self.timer.enabled:
+                now = time.time()
+                for _, (submitted, _) in batch:
+                    self.timer.record("queue_wait", now - submitted)
+            try:
+                self.process_batch([(index, item) for index, (_, item) in batch])
+            except Exception:
+                logger.exception("processing a batch of scans failed")
+
+    def stop(self, timeout=None):
+        """ Stop the worker thread once it has finished the batch it is working on """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+
+class _BatchSubmitter(object):
+
+    def __init__(self, pipeline, index):
+        self.pipeline = pipeline
+        self.index = index
+
+    def submit(self, item):
+        self.pipeline.submit(self.index, item)
+
+    @property
+    def dropped(self):
+        return self.pipeline.dropped[self.index]
@@ -0,0 +1,129 @@
+""" Turns sensor_msgs/LaserScan messages into the compact form consumed by the laser models.
+    Invalid returns are dropped and beams are decimated once per scan (rather than once per
+    particle), and the trigonometry of the scan geometry is computed once and cached """
+
+import numpy as np
+
+
+class PreparedScan(object):
+    """ The beams of one laser scan that take part in the measurement update
+        Attributes:
+            ranges: the measured range of each selected beam
+            angles: the angle of each selected beam relative to the robot base frame
+            x: the x-coordinate of each beam endpoint in the robot base frame
+            y: the y-coordinate of each beam endpoint in the robot base frame
+            range_max: the maximum range the laser can report
+            laser_x: the x-coordinate of the laser (the origin of every beam) in the robot base frame
+            laser_y: the y-coordinate of the laser in the robot base frame
+            at_max: a mask of the beams reporting no return (range_max), only kept with keep_max_range
+    """
+
+    def __init__(self, ranges, angles, x, y, range_max=float('inf'), laser_x=0.0, laser_y=0.0, at_max=None):
+        self.ranges = ranges
+        self.angles = angles
+        self.x = x
+        self.y = y
+        self.range_max = range_max
+        self.laser_x = laser_x
+        self.laser_y = laser_y
+        self.at_max = np.zeros(len(ranges), dtype=bool) if at_max is None else at_max
+
+    def __len__(self):
+        return len(self.ranges)
+
+
+class ScanPreprocessor(object):
+    """ Prepares laser scans for scoring
+        Attributes:
+            decimation: how beams are subsampled.  One of
+                "none": use every valid beam
+                "stride": use every stride-th beam of the scan
+                "uniform": use at most max_beams valid beams spread evenly over the field of view
+                "informative": use the max_beams valid beams with the largest range discontinuity to
+                               their neighbors (corners and edges constrain the pose the most)
+            stride: the beam stride used by the "stride" decimation
+            max_beams: the number of beams kept by the "uniform" and "informative" decimations
+            max_cached_geometries: the number of scan geometries whose angle tables are kept
+            keep_max_range: keep the beams reporting range_max (no return) instead of dropping them, so a
+                            measurement model can score them with its max-range term
+    """
+    DECIMATIONS = ("none", "stride", "uniform", "informative")
+
+    def __init__(self, decimation="none", stride=1, max_beams=None, max_cached_geometries=8, keep_max_range=False):
+        if decimation not in self.DECIMATIONS:
+            raise ValueError("unknown decimation %r, expected one of %s" % (decimation, ", ".join(self.DECIMATIONS)))
+        if decimation in ("uniform", "informative") and not max_beams:
+            raise ValueError("the %s decimation needs max_beams" % decimation)
+        self.decimation = decimation
+        self.stride = max(1, int(stride))
+        self.max_beams = max_beams
+        self.max_cached_geometries = max_cached_geometries
+        self.keep_max_range = keep_max_range
+        self._tables = {}
+
+    def angle_tables(self, angle_min, angle_increment, n, laser_yaw=0.0):
+        """ Return the (angles, cos, sin) tables of a scan geometry, where angles are expressed in the robot
+            base frame.  Tables are cached, so a laser with a fixed geometry only computes them once """
+        key = (angle_min, angle_increment, n, laser_yaw)
+        tables = self._tables.get(key)
+        if tables is None:
+            if len(self._tables) >= self.max_cached_geometries:
+                self._tables.clear()
+            angles = laser_yaw + angle_min + angle_increment*np.arange(n)
+            tables = (angles, np.cos(angles), np.sin(angles))
+            self._tables[key] = tables
+        return tables
+
+    def prepare(self, msg, laser_pose=(0.0, 0.0, 0.0)):
+        """ Prepare the sensor_msgs/LaserScan msg for scoring
+            laser_pose: the (x, y, theta) of the laser relative to the robot base frame
+            Returns a PreparedScan """
+        ranges = np.asarray(msg.ranges, dtype=np.float64)
+        angles, cos, sin = self.angle_tables(msg.angle_min, msg.angle_increment, len(ranges), laser_pose[2])
+
+        # a range of 0 (or below range_min) marks an invalid measurement, as does anything at or beyond range_max
+        at_max = np.zeros(len(ranges), dtype=bool)
+        if msg.range_max > 0:
+            at_max = ranges >= msg.range_max
+        valid = np.isfinite(ranges) & (ranges > 0) & (ranges >= msg.range_min) & ~at_max
+        if self.keep_max_range:
+            valid |= at_max
+            ranges = np.minimum(ranges, msg.range_max)
+        selected = self.select_beams(ranges, angles, valid)
+
+        r = ranges[selected]
+        return PreparedScan(r,
+                            angles[selected],
+                            laser_pose[0] + r*cos[selected],
+                            laser_pose[1] + r*sin[selected],
+                            msg.range_max if msg.range_max > 0 else float('inf'),
+                            laser_pose[0],
+                            laser_pose[1],
+                            at_max[selected])
+
+    def select_beams(self, ranges, angles, valid):
+        """ Return the indices of the beams to use, given the mask of valid beams """
+        if self.decimation == "stride":
+            valid = valid.copy()
+            valid[np.arange(len(valid)) % self.stride != 0] = False
+        indices = np.flatnonzero(valid)
+        if self.decimation in ("none", "stride") or len(indices) <= self.max_beams:
+            return indices
+
+        if self.decimation == "uniform":
+            # split the field of view into max_beams equal sectors and keep the first valid beam of each
+            span = angles[-1] - angles[0]
+            if span == 0:
+                return indices[:self.max_beams]
+            sectors = np.floor((angles[indices] - angles[0])/span*(self.max_beams - 1e-9)).astype(np.intp)
+            _, first = np.unique(sectors, return_index=True)
+            return indices[first]
+
+        # informative: rank beams by how far their range departs from their valid neighbors
+        r = ranges[indices]
+        discontinuity = np.zeros(len(r))
+        jumps = np.abs(np.diff(r))
+        discontinuity[1:] += jumps
+        discontinuity[:-1] += jumps
+        best = np.argpartition(-discontinuity, self.max_beams - 1)[:self.max_beams]
+        return indices[np.sort(best)]
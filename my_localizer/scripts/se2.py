@@ -0,0 +1,46 @@
+""" Rigid transforms of the plane, SE(2).  A transform is an (x, y, theta) triple: the pose of a child frame
+    in its parent frame, which maps child coordinates to parent coordinates.  Every function works on plain
+    floats as well as on numpy arrays of transforms or points, which are broadcast against each other, so
+    one call can move the beam endpoints of a whole particle cloud.  Only the yaw of 3-D poses matters to
+    the filter, so this replaces the 4x4 matrices and quaternions of tf.transformations in the update path """
+
+import math
+
+import numpy as np
+
+
+def normalize_angle(theta):
+    """ Wrap theta (a float or an array) to [-pi, pi] """
+    if isinstance(theta, np.ndarray):
+        return np.arctan2(np.sin(theta), np.cos(theta))
+    return math.atan2(math.sin(theta), math.cos(theta))
+
+
+def compose(a, b):
+    """ The transform applying b and then a, i.e. the pose b given in the frame of a expressed in the parent
+        frame of a """
+    x, y = transform_points(a, b[0], b[1])
+    return (x, y, normalize_angle(a[2] + b[2]))
+
+
+def invert(a):
+    """ The inverse of transform a, mapping parent coordinates back to child coordinates """
+    x, y, theta = a
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+    return (-cos_theta*x - sin_theta*y, sin_theta*x - cos_theta*y, normalize_angle(-theta))
+
+
+def transform_points(a, x, y):
+    """ Map the points (x, y) from the child frame of transform a to its parent frame.  The components of a
+        and the points may be arrays, for instance a column of particle poses against a row of beam
+        endpoints gives the endpoints of every beam for every particle """
+    cos_theta = np.cos(a[2])
+    sin_theta = np.sin(a[2])
+    return a[0] + cos_theta*x - sin_theta*y, a[1] + sin_theta*x + cos_theta*y
+
+
+def to_translation_rotation(a, z=0.0):
+    """ The translation (x, y, z) and quaternion (x, y, z, w) of transform a, as tf's sendTransform takes them """
+    half = 0.5*a[2]
+    return (float(a[0]), float(a[1]), float(z)), (0.0, 0.0, math.sin(half), math.cos(half))
@@ -0,0 +1,153 @@
+""" Lightweight latency instrumentation for the stages of the filter loop.  Each stage is wrapped in
+        with timer.stage("laser"):
+            ...
+    and its durations are kept in a rolling window, summarized as a histogram and percentiles.  A disabled
+    StageTimer hands out a shared do-nothing context, so instrumented code costs one method call per stage """
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# histogram bin edges in seconds: 0.1 ms to 10 s, three bins per decade
+DEFAULT_EDGES = np.concatenate(([0.0], np.logspace(-4, 1, 16), [np.inf]))
+
+
+class RollingHistogram(object):
+    """ The most recent samples of a duration, summarized over fixed bin edges
+        Attributes:
+            samples: a ring buffer holding the last window samples (in seconds)
+            count: the total number of samples ever added
+            total: the sum of all samples ever added
+            edges: the histogram bin edges in seconds
+    """
+
+    def __init__(self, window=1000, edges=DEFAULT_EDGES):
+        self.samples = np.zeros(window)
+        self.count = 0
+        self.total = 0.0
+        self.edges = edges
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+        self.total += value
+
+    def values(self):
+        """ The samples currently in the window (in no particular order) """
+        return self.samples[:min(self.count, len(self.samples))]
+
+    def histogram(self):
+        """ The number of samples in the window falling into each bin """
+        return np.histogram(self.values(), self.edges)[0]
+
+    def summary(self):
+        """ A dict of statistics of the window in milliseconds, plus the total sample count """
+        values = self.values()
+        if not len(values):
+            return dict(count=0)
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return dict(count=self.count,
+                    mean_ms=1000*float(np.mean(values)),
+                    p50_ms=1000*float(p50),
+                    p95_ms=1000*float(p95),
+                    p99_ms=1000*float(p99),
+                    max_ms=1000*float(np.max(values)))
+
+
+class _NullStage(object):
+    """ The context handed out by a disabled StageTimer """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.name, time.time() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """ Times named stages of the filter loop
+        Attributes:
+            enabled: whether durations are recorded at all
+            window: the number of recent samples each stage keeps
+            histograms: a dict from stage name to its RollingHistogram
+            stages: the stage names in the order they were first recorded
+        Stages may be recorded and summarized from different threads.
+    """
+
+    def __init__(self, enabled=True, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.histograms = {}
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        """ A context manager recording the time spent in its body as stage name """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        """ Record a duration of stage name measured elsewhere """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = RollingHistogram(self.window)
+                self.stages.append(name)
+            histogram.add(seconds)
+
+    def summary(self):
+        """ A list of (stage name, statistics dict) pairs, see RollingHistogram.summary """
+        with self.lock:
+            return [(name, self.histograms[name].summary()) for name in self.stages]
+
+    def report(self):
+        """ A human readable multi-line summary """
+        lines = []
+        for name, stats in self.summary():
+            if stats['count']:
+                lines.append("%-14s n=%-6d mean %7.2f ms  p50 %7.2f  p95 %7.2f  p99 %7.2f  max %7.2f" %
+                             (name, stats['count'], stats['mean_ms'], stats['p50_ms'], stats['p95_ms'],
+                              stats['p99_ms'], stats['max_ms']))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """ Write the summary and histograms to path as JSON.  The file is replaced atomically so readers
+            never see a partial dump """
+        data = dict(time=time.time(),
+                    edges_s=[float(edge) for edge in DEFAULT_EDGES[:-1]] + ["inf"],
+                    stages=[dict(stats, name=name) for name, stats in self.summary()])
+        with self.lock:
+            for stage in data['stages']:
+                stage['histogram'] = [int(c) for c in self.histograms[stage['name']].histogram()]
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,31 @@
+""" What the tests share: the node scripts on the import path, the test map and seeded inputs built on it """
+
+import os
+import sys
+
+import numpy as np
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+MAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps', 'ac109_1.yaml')
+sys.path.insert(0, SCRIPTS_DIR)
+
+from particle_set import ParticleSet
+from replay import load_field, synthesize_sequence
+from scan_processing import ScanPreprocessor
+
+
+def fresh_field():
+    """ A fresh OccupancyField of the test map, built without the on-disk cache """
+    return load_field(MAP_FILE, use_cache=False)
+
+
+def particles_around(xy_theta, n, rng, spread=0.5):
+    """ A ParticleSet of n particles with equal weights scattered around the pose xy_theta """
+    return ParticleSet(xy_theta[0] + spread*rng.randn(n), xy_theta[1] + spread*rng.randn(n),
+                       xy_theta[2] + spread*rng.randn(n), np.full(n, 1.0/n))
+
+
+def prepared_scan(field, steps=2, seed=0):
+    """ The true pose and PreparedScan of the last step of a short synthetic run in field """
+    sequence = synthesize_sequence(field, steps, np.random.RandomState(seed))
+    return sequence.truth[-1], ScanPreprocessor().prepare(sequence.scan(steps - 1), (0.0, 0.0, 0.0))
@@ -0,0 +1,65 @@
+""" Checkpoints have to survive a round trip and be rejected when damaged or taken in another map """
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import numpy as np
+
+from localizer_fixtures import particles_around
+from checkpoint import MAGIC, Checkpoint, read_checkpoint, write_checkpoint
+
+MAP_HASH = 'a'*40
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checkpoint = Checkpoint(MAP_HASH, 1234.5, particles_around((1.0, 2.0, 0.5), 500, np.random.RandomState(0)),
+                                     'robot1/odom', (1.0, 2.0, 3.0), (0.5, -0.5, 0.0), (0.0, 0.0, 0.1, 0.995))
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertCheckpointsEqual(self, restored, checkpoint):
+        for attribute in ('map_hash', 'stamp', 'odom_frame', 'odom_xy_theta', 'translation', 'rotation'):
+            self.assertEqual(getattr(restored, attribute), getattr(checkpoint, attribute), attribute)
+        for attribute in ('x', 'y', 'theta', 'w'):
+            np.testing.assert_array_equal(getattr(restored.particles, attribute),
+                                          getattr(checkpoint.particles, attribute))
+
+    def test_round_trip(self):
+        self.assertCheckpointsEqual(Checkpoint.from_bytes(self.checkpoint.to_bytes()), self.checkpoint)
+        write_checkpoint(self.path, self.checkpoint)
+        self.assertCheckpointsEqual(read_checkpoint(self.path, MAP_HASH), self.checkpoint)
+
+    def test_damaged(self):
+        data = self.checkpoint.to_bytes()
+        for offset in (0, 100, len(data) - 1):
+            corrupted = bytearray(data)
+            corrupted[offset] ^= 1
+            self.assertRaises(ValueError, Checkpoint.from_bytes, bytes(corrupted))
+        self.assertRaises(ValueError, Checkpoint.from_bytes, data[:20])
+        self.assertRaises(ValueError, Checkpoint.from_bytes, data[:-100] + data[-4:])
+        with open(self.path, 'wb') as f:
+            f.write(data[:-1])
+        self.assertIsNone(read_checkpoint(self.path))
+
+    def test_other_version(self):
+        payload = b'PFCKPT\x00\x01' + self.checkpoint.to_bytes()[len(MAGIC):-4]
+        data = payload + struct.pack('<I', zlib.crc32(payload) & 0xffffffff)
+        self.assertRaises(ValueError, Checkpoint.from_bytes, data)
+
+    def test_other_map_or_missing(self):
+        write_checkpoint(self.path, self.checkpoint)
+        self.assertIsNone(read_checkpoint(self.path, 'b'*40))
+        self.assertIsNone(read_checkpoint(os.path.join(self.directory, 'missing.bin')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+""" The likelihood pyramid refreshed after map updates has to match one built from the updated map """
+
+import unittest
+
+import numpy as np
+
+from localizer_fixtures import fresh_field
+from global_localization import LikelihoodPyramid
+
+
+class LikelihoodPyramidTest(unittest.TestCase):
+
+    def test_refresh_matches_rebuild(self):
+        field = fresh_field()
+        pyramid = LikelihoodPyramid(field, 4)
+        rng = np.random.RandomState(1)
+        for i in range(4):
+            x, y = rng.uniform(-3, 3, 2)
+            field.set_occupied(x + rng.uniform(0, 0.5, 100), y + rng.uniform(0, 0.5, 100), occupied=i % 2 == 0)
+            pyramid.refresh()
+            rebuilt = LikelihoodPyramid(field, 4)
+            for level, expected in zip(pyramid.levels, rebuilt.levels):
+                np.testing.assert_array_equal(level.closest_occ, expected.closest_occ)
+                np.testing.assert_array_equal(level.free, expected.free)
+
+
+if __name__ == '__main__':
+    unittest.main()
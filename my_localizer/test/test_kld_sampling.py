@@ -0,0 +1,51 @@
+""" KLD-sampling has to keep the cloud within its bounds and stop where sequential sampling would """
+
+import math
+import unittest
+
+import numpy as np
+
+from localizer_fixtures import particles_around
+from kld_sampling import KLDSampler, kld_sample_size
+
+
+class KLDSamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sampler = KLDSampler(100, 5000)
+
+    def test_sample_size(self):
+        self.assertEqual(kld_sample_size(1), 1)
+        sizes = kld_sample_size(np.arange(1, 500))
+        self.assertTrue((np.diff(sizes) > 0).all())
+        # (k - 1)/(2 epsilon) is the chi-square mean, the 1 - delta quantile lies above it
+        self.assertTrue((sizes[1:] > np.arange(1, 499)/(2*0.05)).all())
+
+    def test_bounds(self):
+        rng = np.random.RandomState(0)
+        # inside a single histogram bin, and spread over far more bins than max_particles covers
+        center = (0.25, 0.25, 0.1)
+        self.assertEqual(self.sampler.sample_size(particles_around(center, 5000, rng, spread=1e-3)), 100)
+        self.assertEqual(self.sampler.sample_size(particles_around(center, 5000, rng, spread=20.0)), 5000)
+        self.assertEqual(self.sampler.select(particles_around(center, 5000, rng, spread=1e-3)), 100)
+        self.assertEqual(self.sampler.select(particles_around(center, 5000, rng, spread=20.0)), 5000)
+
+    def test_select_matches_sequential_sampling(self):
+        candidates = particles_around((1.0, 2.0, 0.5), 5000, np.random.RandomState(1), spread=0.3)
+        bins = self.sampler.histogram_bins(candidates)
+        seen = set()
+        for n, key in enumerate(bins, 1):
+            seen.add(key)
+            if n >= max(kld_sample_size(len(seen)), self.sampler.min_particles):
+                break
+        self.assertEqual(self.sampler.select(candidates), n)
+        self.assertTrue(100 < n < 5000)
+
+    def test_heading_bins_wrap(self):
+        candidates = particles_around((0.0, 0.0, math.pi), 1000, np.random.RandomState(2), spread=0.0)
+        candidates.theta[::2] = -math.pi
+        self.assertEqual(len(np.unique(self.sampler.histogram_bins(candidates))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+""" Windowed updates of the occupancy field have to match rebuilding its distance field from scratch """
+
+import unittest
+
+import numpy as np
+
+from localizer_fixtures import fresh_field
+from occupancy_field import OccupancyField
+
+
+class OccupancyFieldUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.field = fresh_field()
+        self.field.update_radius = 1.0
+        self.rng = np.random.RandomState(0)
+
+    def assertMatchesRebuild(self):
+        field = self.field
+        full = OccupancyField.compute_closest_occ(field.grid, field.map.info.resolution)
+        # exact below update_radius, and never below it where the rebuild is not
+        exact = full < field.update_radius
+        np.testing.assert_allclose(field.closest_occ[exact], full[exact], atol=1e-5)
+        self.assertTrue((field.closest_occ[~exact] >= field.update_radius - 1e-6).all())
+        np.testing.assert_array_equal(np.sort(field.free_cells), np.flatnonzero(field.grid.ravel() == 0))
+
+    def test_add_obstacles(self):
+        free = np.argwhere(self.field.grid == 0)
+        for row, column in free[self.rng.choice(len(free), 5, replace=False)]:
+            rows, columns = np.mgrid[row:row + 6, column:column + 4]
+            self.assertGreater(self.field.update_cells(rows, columns, 100), 0)
+            self.assertMatchesRebuild()
+
+    def test_remove_walls(self):
+        walls = np.argwhere(self.field.grid > 0)
+        for row, column in walls[self.rng.choice(len(walls), 5, replace=False)]:
+            rows, columns = np.mgrid[max(row - 5, 0):row + 5, max(column - 5, 0):column + 5]
+            self.field.update_cells(rows, columns, 0)
+            self.assertMatchesRebuild()
+        self.assertEqual(self.field.version, 5)
+
+    def test_unchanged_cells(self):
+        walls = np.argwhere(self.field.grid > 0)[:10]
+        self.assertEqual(self.field.update_cells(walls[:, 0], walls[:, 1], 100), 0)
+        self.assertEqual(self.field.version, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+""" Scoring the laser update on a pool of worker processes has to match scoring in the filter process """
+
+import unittest
+
+import numpy as np
+
+from localizer_fixtures import fresh_field, particles_around, prepared_scan
+from laser_model import LikelihoodFieldModel
+from parallel_scoring import ParallelScorer
+
+
+class ParallelScorerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.field = fresh_field()
+        pose, self.scan = prepared_scan(self.field)
+        self.particles = particles_around(pose, 400, np.random.RandomState(1))
+        self.scorers = []
+
+    def tearDown(self):
+        for scorer in self.scorers:
+            scorer.close()
+
+    def scorer(self):
+        scorer = ParallelScorer(LikelihoodFieldModel(self.field), 2, min_chunk=10)
+        self.scorers.append(scorer)
+        return scorer
+
+    def assertScoresMatch(self, scorer):
+        expected = scorer.model.log_weights(self.particles, self.scan)
+        np.testing.assert_array_equal(scorer.log_weights(self.particles, self.scan), expected)
+
+    def test_matches_in_process_scoring(self):
+        scorer = self.scorer()
+        self.assertScoresMatch(scorer)
+        # the workers read the updated cells through shared memory
+        rows, columns = np.nonzero(self.field.grid == 0)
+        self.field.update_cells(rows[::50], columns[::50], np.full(len(rows[::50]), 100))
+        self.assertScoresMatch(scorer)
+
+    def test_robots_sharing_a_field(self):
+        # every robot of multi_pf.py builds its own pool on the one field of their SharedMap
+        first = self.scorer()
+        second = self.scorer()
+        self.assertScoresMatch(first)
+        self.assertScoresMatch(second)
+        rows, columns = np.nonzero(self.field.grid == 0)
+        self.field.update_cells(rows[::50], columns[::50], np.full(len(rows[::50]), 100))
+        self.assertScoresMatch(first)
+        self.assertScoresMatch(second)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+""" The resampling schemes have to draw valid indices in proportion to the weights """
+
+import unittest
+
+import numpy as np
+
+import localizer_fixtures  # puts the scripts on the import path
+from resampling import RESAMPLERS, effective_sample_size, get_resampler, residual_resample, systematic_resample
+
+
+class ResamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.weights = np.random.RandomState(0).gamma(0.5, size=200)
+        self.weights[::7] = 0.0
+        self.expected = 1000*self.weights/self.weights.sum()
+
+    def test_indices(self):
+        for name, resample in sorted(RESAMPLERS.items()):
+            indices = resample(self.weights, 1000, np.random.RandomState(1))
+            self.assertEqual(len(indices), 1000, name)
+            self.assertTrue(((indices >= 0) & (indices < len(self.weights))).all(), name)
+            self.assertFalse(np.isin(indices, np.flatnonzero(self.weights == 0)).any(), name)
+            # seeded runs repeat
+            np.testing.assert_array_equal(indices, resample(self.weights, 1000, np.random.RandomState(1)))
+
+    def test_proportions(self):
+        for name, resample in sorted(RESAMPLERS.items()):
+            counts = np.bincount(resample(self.weights, 1000, np.random.RandomState(2)), minlength=len(self.weights))
+            # within a few standard deviations of the multinomial, which has the largest variance
+            self.assertLess(np.abs(counts - self.expected).max(), 5*np.sqrt(self.expected.max()), name)
+
+    def test_low_variance_schemes(self):
+        counts = np.bincount(systematic_resample(self.weights, 1000, np.random.RandomState(3)),
+                             minlength=len(self.weights))
+        self.assertTrue((counts >= np.floor(self.expected)).all() and (counts <= np.ceil(self.expected)).all())
+        counts = np.bincount(residual_resample(self.weights, 1000, np.random.RandomState(3)),
+                             minlength=len(self.weights))
+        self.assertTrue((counts >= np.floor(self.expected)).all())
+
+    def test_rounding_at_the_last_particle(self):
+        # the cumulative sum of these weights falls short of 1.0, the draws must still land on a particle
+        weights = np.full(10, 0.1)
+        weights[-1] = 1e-300
+        for name, resample in sorted(RESAMPLERS.items()):
+            indices = resample(weights, 5000, np.random.RandomState(4))
+            self.assertTrue((indices < len(weights)).all(), name)
+
+    def test_effective_sample_size(self):
+        self.assertAlmostEqual(effective_sample_size(np.ones(50)), 50.0)
+        self.assertAlmostEqual(effective_sample_size([0.0, 3.0, 0.0]), 1.0)
+        self.assertEqual(effective_sample_size(np.zeros(5)), 0.0)
+
+    def test_unknown_resampler(self):
+        self.assertRaises(ValueError, get_resampler, "bogus")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+""" The planar transforms have to agree with composing homogeneous matrices """
+
+import math
+import unittest
+
+import numpy as np
+
+import localizer_fixtures  # puts the scripts on the import path
+import se2
+
+
+def matrix(a):
+    """ The 3x3 homogeneous matrix of the transform a """
+    c, s = math.cos(a[2]), math.sin(a[2])
+    return np.array([[c, -s, a[0]], [s, c, a[1]], [0.0, 0.0, 1.0]])
+
+
+def from_matrix(m):
+    return (m[0, 2], m[1, 2], math.atan2(m[1, 0], m[0, 0]))
+
+
+class SE2Test(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.transforms = [tuple(t) for t in np.column_stack((rng.uniform(-10, 10, (20, 2)),
+                                                                rng.uniform(-math.pi, math.pi, 20)))]
+
+    def assertTransformsEqual(self, a, b):
+        np.testing.assert_allclose(a[:2], b[:2], atol=1e-9)
+        self.assertAlmostEqual(se2.normalize_angle(a[2] - b[2]), 0.0, places=9)
+
+    def test_compose(self):
+        for a, b in zip(self.transforms, self.transforms[1:]):
+            self.assertTransformsEqual(se2.compose(a, b), from_matrix(matrix(a).dot(matrix(b))))
+
+    def test_invert(self):
+        for a in self.transforms:
+            self.assertTransformsEqual(se2.invert(a), from_matrix(np.linalg.inv(matrix(a))))
+            self.assertTransformsEqual(se2.compose(a, se2.invert(a)), (0.0, 0.0, 0.0))
+
+    def test_broadcasting(self):
+        poses = np.array(self.transforms)
+        x, y = se2.transform_points((poses[:, 0:1], poses[:, 1:2], poses[:, 2:3]), np.array([1.0, 0.0, -2.0]),
+                                    np.array([0.0, 3.0, 0.5]))
+        self.assertEqual(x.shape, (len(poses), 3))
+        for i, a in enumerate(self.transforms):
+            expected = matrix(a).dot([[1.0, 0.0, -2.0], [0.0, 3.0, 0.5], [1.0, 1.0, 1.0]])
+            np.testing.assert_allclose(x[i], expected[0], atol=1e-9)
+            np.testing.assert_allclose(y[i], expected[1], atol=1e-9)
+
+    def test_normalize_angle(self):
+        self.assertAlmostEqual(se2.normalize_angle(3*math.pi/2), -math.pi/2)
+        np.testing.assert_allclose(se2.normalize_angle(np.array([0.0, 2*math.pi + 0.1, -7.0])),
+                                   [0.0, 0.1, 2*math.pi - 7.0], atol=1e-12)
+
+    def test_to_translation_rotation(self):
+        translation, rotation = se2.to_translation_rotation((1.0, 2.0, math.pi/2))
+        self.assertEqual(translation, (1.0, 2.0, 0.0))
+        np.testing.assert_allclose(rotation, (0.0, 0.0, math.sqrt(0.5), math.sqrt(0.5)))
+
+
+if __name__ == '__main__':
+    unittest.main()